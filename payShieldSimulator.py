@@ -0,0 +1,542 @@
+# payShield simulator by Marco S. Zuppone - msz@msz.eu
+# This utility is released under AGPL 3.0 license.
+# Please refer to the LICENSE file for more information about licensing
+# and to the README.md file for more information about the usage of it.
+
+import socket
+import socketserver
+import ssl
+import sys
+import time
+import random
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from struct import pack
+from typing import Callable, Dict, Tuple
+
+VERSION = "1.5.2"
+
+
+def parse_service_time(spec: str) -> Callable[[], float]:
+    """
+    It creates the function that returns the service time of each command, from its textual description:
+     - fixed:SECONDS every command takes SECONDS
+     - uniform:MIN:MAX the service time is uniformly distributed between MIN and MAX seconds
+     - exp:MEAN the service time is exponentially distributed with mean MEAN seconds
+     - normal:MEAN:STDDEV the service time is normally distributed, negative values are considered 0
+
+    Parameters
+    ----------
+    spec : str
+        The textual description of the distribution
+
+    Returns
+    -------
+    Callable[[], float]
+        The function returning a service time in seconds every time it is invoked
+
+    Raises
+    ------
+    ValueError
+        If the description is not valid.
+    """
+    fields = spec.split(':')
+    try:
+        values = [float(field) for field in fields[1:]]
+    except ValueError:
+        raise ValueError("invalid number in the service time " + spec)
+    if any(value < 0 for value in values):
+        raise ValueError("the values of the service time must not be negative")
+    kind = fields[0].lower()
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'exp' and len(values) == 1:
+        if values[0] == 0:
+            return lambda: 0.0
+        return lambda: random.expovariate(1 / values[0])
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    raise ValueError("invalid service time " + spec +
+                     ", expected fixed:SECONDS, uniform:MIN:MAX, exp:MEAN or normal:MEAN:STDDEV")
+
+
+class SimulatedHsm:
+    """It is the simulated payShield: it processes the commands and builds the responses.
+        It keeps the counters needed to answer J2 (HSM loading) and J4 (host command volumes) with the real
+        activity of the simulator.
+
+        Attributes
+        ----------
+        header_len : int
+            The length of the message header.
+        threads : int
+            The number of commands processed at the same time, like the host threads of the payShield.
+        service_time : Callable[[], float]
+            The function returning the service time of each command in seconds.
+        error_rate : float
+            The fraction of the commands, between 0 and 1, that are answered with one of the error_codes.
+        error_codes : list[str]
+            The error codes injected.
+        serial_number : str
+            The serial number returned by J2, J4, J8 and JK.
+        """
+    FIRMWARE = "1500-0023"
+    LMK_CRC = "2686241103560919"
+    # J2 reports how many seconds the utilisation of the HSM was in each of these ranges
+    LOAD_RANGES = [(start, start + 10) for start in range(0, 100, 10)]
+
+    def __init__(self, header_len: int = 4, threads: int = 64, service_time: Callable[[], float] = lambda: 0.0,
+                 error_rate: float = 0.0, error_codes: list[str] | None = None):
+        """
+        Constructor for the SimulatedHsm class.
+
+        Parameters
+        ----------
+        header_len : int, optional
+            The length of the message header. The default is 4.
+        threads : int, optional
+            The number of commands processed at the same time. The default is 64.
+        service_time : Callable[[], float], optional
+            The function returning the service time of each command in seconds. The default is no delay.
+        error_rate : float, optional
+            The fraction of the commands answered with an error code. The default is 0.
+        error_codes : list[str], optional
+            The error codes injected. The default is ['15'].
+        """
+        self.header_len = header_len
+        self.threads = threads
+        self.service_time = service_time
+        self.error_rate = error_rate
+        self.error_codes = error_codes if error_codes else ['15']
+        self.serial_number = "SIMULATOR001"
+        self.start_time = datetime.now()
+        self._lock = threading.Lock()
+        self._volumes: Dict[str, int] = {}
+        self._busy_seconds = 0.0
+        self._load_seconds = [0] * len(self.LOAD_RANGES)
+        self._sampler_stop = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def start_sampler(self):
+        """
+        It starts the thread that, every second, accounts the utilisation of the last second for J2.
+        """
+        threading.Thread(target=self._sample_load, daemon=True).start()
+
+    def stop_sampler(self):
+        """
+        It stops the thread started by start_sampler.
+        """
+        self._sampler_stop.set()
+
+    def _sample_load(self):
+        last_busy = 0.0
+        while not self._sampler_stop.wait(1):
+            with self._lock:
+                busy = self._busy_seconds
+            utilisation = min(99.9, (busy - last_busy) * 100 / self.threads)
+            last_busy = busy
+            with self._lock:
+                self._load_seconds[int(utilisation // 10)] += 1
+
+    def process(self, message: bytes) -> bytes:
+        """
+        It processes one command and returns the response, waiting for the service time.
+
+        Parameters
+        ----------
+        message : bytes
+            The command received, without the two bytes of the length
+
+        Returns
+        -------
+        bytes
+            The response, including the two bytes of the length
+        """
+        header = message[:self.header_len]
+        verb = message[self.header_len:self.header_len + 2].decode('ascii', 'replace')
+        body = message[self.header_len + 2:]
+        start = time.perf_counter()
+        delay = self.service_time()
+        if delay > 0:
+            time.sleep(delay)
+        if len(verb) < 2:
+            response_verb = 'ZZ'
+        else:
+            response_verb = verb[0] + chr(ord(verb[1]) + 1)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            response = response_verb.encode() + random.choice(self.error_codes).encode()
+        else:
+            response = response_verb.encode() + self.build_response(verb, body)
+        with self._lock:
+            self._volumes[verb] = self._volumes.get(verb, 0) + 1
+            self._busy_seconds += time.perf_counter() - start
+        response = header + response
+        return pack('>H', len(response)) + response
+
+    def build_response(self, verb: str, body: bytes) -> bytes:
+        """
+        It returns the error code and the fields of the response of the command, with the same layout of
+        the payShield 10k.
+
+        Parameters
+        ----------
+        verb : str
+            The command verb, e.g. NC
+        body : bytes
+            The fields of the command following the verb
+
+        Returns
+        -------
+        bytes
+            The response, from the error code on
+        """
+        builder = getattr(self, "_response_" + verb.lower(), None)
+        if builder is None:
+            return b'67'
+        try:
+            return builder(body)
+        except (ValueError, IndexError):
+            return b'15'
+
+    def _dates(self) -> str:
+        now = datetime.now()
+        return (self.start_time.strftime("%d%m%y%H%M%S") + now.strftime("%d%m%y%H%M%S") +
+                now.strftime("%d%m%y%H%M%S"))
+
+    def _seconds(self) -> str:
+        return str(int((datetime.now() - self.start_time).total_seconds())).zfill(10)
+
+    def _response_nc(self, body: bytes) -> bytes:
+        return ('00' + self.LMK_CRC + self.FIRMWARE).encode()
+
+    def _response_no(self, body: bytes) -> bytes:
+        if body[:2] == b'01':
+            return b'001'
+        # 2 = 16K bytes buffer, 1 = TCP, 4 digits of TCP sockets as in firmware 1.8a and later
+        return ('00' + '2' + '1' + '0064' + self.FIRMWARE + '0' + '0000').encode()
+
+    def _response_ni(self, body: bytes) -> bytes:
+        record = '1' + '1500' + '7F000001' + '4E20' + '0' + '00000100'
+        counters = ''.join(format(random.randint(0, 0xFFFFFFFF), '016X') for _ in range(2))
+        counters = counters + ''.join(format(random.randint(0, 0xFFFF), '08X') for _ in range(9))
+        return ('00' + '0001' + record + counters).encode()
+
+    def _response_j2(self, body: bytes) -> bytes:
+        with self._lock:
+            load_seconds = list(self._load_seconds)
+        ranges = ''.join(str(start).zfill(3) + str(end).zfill(3) + str(seconds).zfill(10) + ';'
+                         for (start, end), seconds in zip(self.LOAD_RANGES, load_seconds))
+        return ('00' + self.serial_number + self._dates() + self._seconds() + ranges).encode()
+
+    def _response_j4(self, body: bytes) -> bytes:
+        with self._lock:
+            volumes = sorted(self._volumes.items())
+        counts = ''.join(verb + str(count).zfill(12) for verb, count in volumes)
+        return ('00' + self.serial_number + self._dates() + self._seconds() + counts).encode()
+
+    def _response_j8(self, body: bytes) -> bytes:
+        return ('00' + self.serial_number + self._dates() + '0000000001' + '0000000000' + '0000000' + '00000' +
+                '00000000').encode()
+
+    def _response_jk(self, body: bytes) -> bytes:
+        now = datetime.now()
+        lmk = '00' + '1' + '00' + 'K' + '2' + 'L' + 'Simulated LMK'
+        return ('00' + self.serial_number + now.strftime("%d%m%y%H%M%S") + '1' + '1' + '1' + '3' + '0' + '0' +
+                '1' + '01' + '00' + '00' + '\x14' + lmk + '\x15' + '00').encode()
+
+    def _response_b2(self, body: bytes) -> bytes:
+        payload_len = int(body[:4], 16)
+        if len(body) - 4 != payload_len:
+            return b'80'
+        return b'00' + body[4:]
+
+    def _response_n0(self, body: bytes) -> bytes:
+        random_len = int(body[:3])
+        if not 1 <= random_len <= 256:
+            return b'01'
+        return b'00' + random.randbytes(random_len)
+
+    def _response_ja(self, body: bytes) -> bytes:
+        return ('00' + ''.join(random.choice('0123456789ABCDEF') for _ in range(33))).encode()
+
+    def _response_ei(self, body: bytes) -> bytes:
+        key_bits = int(body[1:5])
+        if not 320 <= key_bits <= 4096:
+            return b'02'
+        modulus = b'\x00' + random.randbytes(key_bits // 8)
+        public_key = b'\x30\x82' + pack('>H', len(modulus) + 9) + b'\x02\x82' + pack('>H', len(modulus)) + \
+            modulus + b'\x02\x03\x01\x00\x01'
+        private_key = random.randbytes(key_bits // 4)
+        return b'00' + public_key + str(len(private_key)).zfill(4).encode() + private_key
+
+    def _response_fy(self, body: bytes) -> bytes:
+        key_bytes = {b'0': 65, b'1': 97, b'2': 133}.get(body[3:4], 133)
+        public_key = b'\x04' + random.randbytes(key_bytes - 1)
+        return b'00' + str(len(public_key)).zfill(4).encode() + public_key + b'S' + random.randbytes(key_bytes + 40)
+
+
+# End Class
+
+class _StreamHandler(socketserver.BaseRequestHandler):
+    """It serves one tcp or tls connection: every command is processed by the thread pool of the HSM,
+        so the commands pipelined on the same connection are processed concurrently, and the responses
+        can be returned in a different order."""
+
+    def handle(self):
+        hsm: SimulatedHsm = self.server.hsm
+        write_lock = threading.Lock()
+        stream = self.request
+
+        def serve(message: bytes):
+            response = hsm.process(message)
+            with write_lock:
+                try:
+                    stream.sendall(response)
+                except OSError:
+                    pass
+
+        try:
+            while True:
+                size = self._read_exactly(stream, 2)
+                if size is None:
+                    return
+                message = self._read_exactly(stream, int.from_bytes(size, byteorder='big', signed=False))
+                if message is None:
+                    return
+                hsm.executor.submit(serve, message)
+        except (OSError, ssl.SSLError):
+            return
+
+    @staticmethod
+    def _read_exactly(stream: socket.socket, length: int) -> bytes | None:
+        data = bytearray()
+        while len(data) < length:
+            chunk = stream.recv(length - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+
+class _StreamServer(socketserver.ThreadingTCPServer):
+    """It is the tcp server, optionally with tls, with one thread per connection."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], hsm: SimulatedHsm, context: ssl.SSLContext | None = None):
+        self.hsm = hsm
+        self.context = context
+        super().__init__(address, _StreamHandler)
+
+    def get_request(self):
+        connection, address = super().get_request()
+        if self.context is not None:
+            # the handshake happens on the first read, in the thread of the connection
+            connection = self.context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False)
+        return connection, address
+
+
+class _DatagramServer:
+    """It is the udp server: every datagram contains one command, processed by the thread pool of the HSM.
+        A fraction drop_rate of the datagrams is discarded, as if lost in the network."""
+
+    def __init__(self, address: Tuple[str, int], hsm: SimulatedHsm, drop_rate: float = 0.0):
+        self.hsm = hsm
+        self.drop_rate = drop_rate
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.server_address = self.socket.getsockname()
+        self._running = True
+
+    def serve_forever(self):
+        while self._running:
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except OSError:
+                return
+            if self.drop_rate > 0 and random.random() < self.drop_rate:
+                continue
+            if len(data) >= 2:
+                self.hsm.executor.submit(self._serve, data[2:], address)
+
+    def _serve(self, message: bytes, address):
+        try:
+            self.socket.sendto(self.hsm.process(message), address)
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self._running = False
+        self.socket.close()
+
+    def server_close(self):
+        pass
+
+
+class PayShieldSimulator:
+    """It runs the simulated payShield on the protocols requested, each one in its own thread.
+
+        Attributes
+        ----------
+        hsm : SimulatedHsm
+            The simulated payShield serving all the protocols.
+        ports : Dict[str, int]
+            For each protocol started, the port it listens on.
+        udp_drop_rate : float
+            The fraction of the udp datagrams discarded without a response.
+        """
+
+    def __init__(self, hsm: SimulatedHsm, host: str = "127.0.0.1", port: int = 1500, tls_port: int = 2500,
+                 protocols: list[str] | None = None, keyfile: str | None = None, crtfile: str | None = None,
+                 udp_drop_rate: float = 0.0):
+        """
+        Constructor for the PayShieldSimulator class.
+
+        Parameters
+        ----------
+        hsm : SimulatedHsm
+            The simulated payShield
+        host : str, optional
+            The address to listen on. The default is 127.0.0.1
+        port : int, optional
+            The tcp and udp port. The default is 1500. If 0, a free port is chosen
+        tls_port : int, optional
+            The tls port. The default is 2500. If 0, a free port is chosen
+        protocols : list[str], optional
+            The protocols to start among tcp, udp and tls. The default is tcp and udp
+        keyfile : str, optional
+            The server key file, required for tls
+        crtfile : str, optional
+            The server certificate file, required for tls
+        udp_drop_rate : float, optional
+            The fraction of the udp datagrams, between 0 and 1, discarded without a response. The default is 0
+
+        Raises
+        ------
+        ValueError
+            If tls is requested without keyfile and crtfile, or a protocol is unknown.
+        """
+        self.hsm = hsm
+        self.host = host
+        self.port = port
+        self.tls_port = tls_port
+        self.protocols = protocols if protocols else ['tcp', 'udp']
+        self.keyfile = keyfile
+        self.crtfile = crtfile
+        self.udp_drop_rate = udp_drop_rate
+        self.ports: Dict[str, int] = {}
+        self._servers = []
+        for protocol in self.protocols:
+            if protocol not in ['udp', 'tcp', 'tls']:
+                raise ValueError("protocol must me udp, tcp or tls")
+        if 'tls' in self.protocols and ((keyfile is None) or (crtfile is None)):
+            raise ValueError("keyfile and crtfile parameters are both required for tls")
+
+    def start(self) -> 'PayShieldSimulator':
+        """
+        It starts the servers, each one in a daemon thread, and returns immediately.
+
+        Returns
+        -------
+        PayShieldSimulator
+            This instance, to allow chaining
+        """
+        for protocol in self.protocols:
+            if protocol == 'tcp':
+                server = _StreamServer((self.host, self.port), self.hsm)
+            elif protocol == 'udp':
+                server = _DatagramServer((self.host, self.ports.get('tcp', self.port)), self.hsm, self.udp_drop_rate)
+            else:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                context.load_cert_chain(certfile=self.crtfile, keyfile=self.keyfile)
+                server = _StreamServer((self.host, self.tls_port), self.hsm, context)
+            self.ports[protocol] = server.server_address[1]
+            self._servers.append(server)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.hsm.start_sampler()
+        return self
+
+    def stop(self):
+        """
+        It stops all the servers.
+        """
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        self.hsm.stop_sampler()
+
+
+# End Class
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulates a payShield 10k host port, to benchmark pressureTest.py without an appliance.",
+        epilog="For any questions, feedback, suggestions or sending money (yes...it's a dream, I know), you can contact "
+               "the author at msz@msz.eu")
+    parser.add_argument("--host", help="Address to listen on. If not specified the default is 127.0.0.1.",
+                        default="127.0.0.1")
+    parser.add_argument("--port", "-p", help="The tcp and udp port. If not specified the default is 1500.",
+                        default=1500, type=int)
+    parser.add_argument("--tls-port", help="The tls port. If not specified the default is 2500.",
+                        default=2500, type=int)
+    parser.add_argument("--proto", help="Protocols to serve. The default is tcp and udp.", nargs='+',
+                        default=["tcp", "udp"], choices=["tcp", "udp", "tls"], type=str.lower)
+    parser.add_argument("--keyfile", help="Server key file, used if the protocol is TLS.", type=Path,
+                        default="server.key")
+    parser.add_argument("--crtfile", help="Server certificate file, used if the protocol is TLS.", type=Path,
+                        default="server.crt")
+    parser.add_argument("--header-len", help="Length of the message header. If not specified the default is 4.",
+                        default=4, type=int)
+    parser.add_argument("--threads", help="How many commands are processed at the same time. "
+                                          "If not specified the default is 64.", default=64, type=int)
+    parser.add_argument("--service-time", help="Service time of each command: fixed:SECONDS, uniform:MIN:MAX, "
+                                               "exp:MEAN or normal:MEAN:STDDEV. The default is fixed:0.",
+                        default="fixed:0", type=str)
+    parser.add_argument("--error-rate", help="Fraction of the commands, between 0 and 1, answered with an error "
+                                             "code. If not specified the default is 0.", default=0.0, type=float)
+    parser.add_argument("--error-codes", help="Comma separated error codes to inject. The default is 15.",
+                        default="15", type=str)
+    parser.add_argument("--udp-drop-rate", help="Fraction of the udp datagrams, between 0 and 1, discarded without "
+                                                "a response, as if lost. If not specified the default is 0.",
+                        default=0.0, type=float)
+    args = parser.parse_args()
+    if args.threads <= 0:
+        parser.error("--threads must be a positive integer (greater than 0).")
+    if not 0 <= args.error_rate <= 1:
+        parser.error("--error-rate must be between 0 and 1.")
+    if not 0 <= args.udp_drop_rate <= 1:
+        parser.error("--udp-drop-rate must be between 0 and 1.")
+    if args.header_len < 0 or args.header_len > 255:
+        parser.error("--header-len must be between 0 and 255.")
+    try:
+        service_time = parse_service_time(args.service_time)
+    except ValueError as e:
+        parser.error("--service-time: " + str(e))
+    error_codes = [code.strip().upper() for code in args.error_codes.split(',')]
+    if any(len(code) != 2 for code in error_codes):
+        parser.error("--error-codes must be a comma separated list of codes 2 characters long.")
+
+    print("payShield simulator, version " + VERSION + ", by Marco S. Zuppone - msz@msz.eu - https://msz.eu")
+    hsm = SimulatedHsm(args.header_len, args.threads, service_time, args.error_rate, error_codes)
+    try:
+        simulator = PayShieldSimulator(hsm, args.host, args.port, args.tls_port, args.proto,
+                                       args.keyfile, args.crtfile, args.udp_drop_rate).start()
+    except (ValueError, OSError, ssl.SSLError) as e:
+        print("The simulator cannot be started:", e)
+        sys.exit(1)
+    for protocol, port in simulator.ports.items():
+        print("Listening on", args.host, "port", port, "(" + protocol + ")")
+    print("Press CTRL-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+        print("Stopped")
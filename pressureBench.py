@@ -0,0 +1,315 @@
+# payShield pressure test benchmark by Marco S. Zuppone - msz@msz.eu
+# This utility is released under AGPL 3.0 license.
+# Please refer to the LICENSE file for more information about licensing
+# and to the README.md file for more information about the usage of it.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Any
+
+import pressureTest
+from payShieldSimulator import SimulatedHsm, PayShieldSimulator
+
+HEADER = "HEAD"
+
+# the commands used by the benchmarks, without the header
+COMMANDS = {
+    'NC': 'NC',
+    'NO': 'NO00',
+    'NI': 'NI11',
+    'J2': 'J2',
+    'J4': 'J4',
+    'J8': 'J8',
+    'JK': 'JK',
+    'B2': 'B2000B' + 'PressureTst',
+    'N0': 'N0008',
+    'JA': 'JA1234567890128;05',
+    'FY': 'FY0102' + '03#S00S00',
+}
+
+DECODERS = {
+    'NC': pressureTest.decode_nc,
+    'NO': pressureTest.decode_no,
+    'NI': pressureTest.decode_ni,
+    'J2': pressureTest.decode_j2,
+    'J4': pressureTest.decode_j4,
+    'J8': pressureTest.decode_j8,
+    'JK': pressureTest.decode_jk,
+    'B2': pressureTest.decode_b2,
+    'N0': pressureTest.decode_n0,
+    'JA': pressureTest.decode_ja,
+    'FY': pressureTest.decode_ecc,
+}
+
+
+def time_call(funct: Callable[[], Any], min_time: float = 0.2, repeat: int = 5) -> Dict[str, float]:
+    """
+        It measures how long a call of funct takes. The number of calls of each round is chosen so that a round
+        lasts at least min_time seconds, and the fastest of the rounds is kept, as it is the least disturbed.
+
+        Parameters
+        ----------
+         funct: Callable[[], Any]
+            The function to measure, called without parameters
+         min_time: float
+            The minimum duration of a round in seconds
+         repeat: int
+            The number of rounds
+
+        Returns
+        -------
+        result : Dict[str, float]
+            The nanoseconds per call and the calls per second
+    """
+    timer = timeit.Timer(funct)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number = number * 10
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {"ns_per_call": round(best * 1e9, 1), "calls_per_second": round(1 / best, 1)}
+
+
+def sample_responses(header: str = HEADER) -> Dict[str, bytes]:
+    """
+        It builds, for each command of the benchmarks, a response with the layout returned by the payShield,
+        using the simulator.
+
+        Parameters
+        ----------
+         header: str
+            The header of the messages
+
+        Returns
+        -------
+        result : Dict[str, bytes]
+            The response, including the two bytes of the length, for each verb
+    """
+    hsm = SimulatedHsm(header_len=len(header))
+    return {verb: hsm.process((header + command).encode()) for verb, command in COMMANDS.items()}
+
+
+def run_micro_benchmarks(min_time: float) -> Dict[str, Dict[str, float]]:
+    """
+        It measures the cost of the client side functions executed for each command: the framing of the
+        command, the checks of the response, the parsers and the decoders.
+        The decoders print the fields they decode, so their output is sent to the null device to measure the
+        formatting without the cost of the console.
+
+        Parameters
+        ----------
+         min_time: float
+            The minimum duration of a measure round in seconds
+
+        Returns
+        -------
+        result : Dict[str, Dict[str, float]]
+            The measures for each benchmark
+    """
+    head_len = len(HEADER)
+    command = HEADER + COMMANDS['NC']
+    responses = sample_responses()
+    response = responses['NC']
+    results = {}
+    benchmarks = {
+        "build_frame": lambda: pressureTest.build_frame(command),
+        "check_return_message": lambda: pressureTest.check_return_message(response, head_len),
+        "check_returned_command_verb": lambda: pressureTest.check_returned_command_verb(response, head_len,
+                                                                                       command),
+        "test_printable": lambda: pressureTest.test_printable(response.decode('ascii', 'replace')),
+        "payshield_error_codes": lambda: pressureTest.payshield_error_codes('15'),
+    }
+    for name, funct in benchmarks.items():
+        results[name] = time_call(funct, min_time)
+    for verb, parser in pressureTest.PARSERS.items():
+        if verb in responses:
+            verb_response = responses[verb]
+            results[parser.__name__ + " (" + verb + ")"] = time_call(
+                lambda: parser(verb_response, head_len), min_time)
+    with open(os.devnull, 'w') as null_device, contextlib.redirect_stdout(null_device):
+        results["common_parser"] = time_call(lambda: pressureTest.common_parser(response, head_len), min_time)
+        for verb, decoder in DECODERS.items():
+            verb_response = responses[verb]
+            results[decoder.__name__ + " (" + verb + ")"] = time_call(
+                lambda: decoder(verb_response, head_len), min_time)
+    return results
+
+
+def run_end_to_end(protocol: str, port: int, times: int, connections: int, pipeline: int | None,
+                   keyfile: str | None, crtfile: str | None) -> Dict[str, Any]:
+    """
+        It sends NC commands to the simulator, without printing anything, and measures the throughput and the
+        latency of the client.
+
+        Parameters
+        ----------
+         protocol: str
+            tcp, udp or tls
+         port: int
+            The port of the simulator
+         times: int
+            The number of commands
+         connections: int
+            The number of connections
+         pipeline: int | None
+            If not None, the asyncio engine is used with this number of commands in flight per connection
+         keyfile: str | None
+            The client key file, used with tls
+         crtfile: str | None
+            The client certificate file, used with tls
+
+        Returns
+        -------
+        result : Dict[str, Any]
+            The throughput, the errors and the latency percentiles
+    """
+    host_command = HEADER + COMMANDS['NC']
+    stats_list = [pressureTest.LoadStats() for _ in range(connections)]
+    if pipeline is None:
+        connectors = [pressureTest.PayConnector("127.0.0.1", port, protocol, keyfile, crtfile)
+                      for _ in range(connections)]
+    else:
+        connectors = [pressureTest.AsyncPayConnector("127.0.0.1", port, protocol, keyfile, crtfile, len(HEADER),
+                                                     pipeline) for _ in range(connections)]
+    start = time.perf_counter()
+    if pipeline is None:
+        pressureTest.run_load(connectors, host_command, len(HEADER), times, stats_list, verbose=False)
+    else:
+        pressureTest.run_async_load(connectors, host_command, len(HEADER), times, stats_list)
+    elapsed = time.perf_counter() - start
+    for connector in connectors:
+        if pipeline is None:
+            connector.close()
+    total = pressureTest.LoadStats()
+    for stats in stats_list:
+        total.merge(stats)
+    return {
+        "operations": total.operations,
+        "errors": total.errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(total.operations / elapsed, 1),
+        "latency_ms": {name: round(total.latency.percentile(p) / 1000, 3)
+                       for name, p in [("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9)]}
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """
+        It prints how much each benchmark changed from the baseline results. A positive change means slower.
+
+        Parameters
+        ----------
+         results: Dict[str, Any]
+            The results of this run
+         baseline: Dict[str, Any]
+            The results of a previous run, as saved in the JSON file
+    """
+    print("")
+    print("Compared with the baseline of", baseline.get("timestamp"), "(version " + str(baseline.get("version")) + ")")
+    for name, measure in results["micro"].items():
+        previous = baseline.get("micro", {}).get(name)
+        if previous:
+            change = (measure["ns_per_call"] - previous["ns_per_call"]) * 100 / previous["ns_per_call"]
+            print(" {:45} {:+7.1f}%".format(name, change))
+    for name, measure in results["end_to_end"].items():
+        previous = baseline.get("end_to_end", {}).get(name)
+        if previous and "throughput" in previous and "throughput" in measure:
+            # the time per operation is the inverse of the throughput
+            change = (previous["throughput"] / measure["throughput"] - 1) * 100
+            print(" {:45} {:+7.1f}%".format(name + " (time per operation)", change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measures the cost per command of the payShield pressure test client, "
+                    "against a local payShield simulator.",
+        epilog="For any questions, feedback, suggestions or sending money (yes...it's a dream, I know), you can contact "
+               "the author at msz@msz.eu")
+    parser.add_argument("--output", "-o", help="JSON file where the results are saved. "
+                                               "If not specified the default is pressureBench.json.",
+                        default="pressureBench.json", type=Path)
+    parser.add_argument("--baseline", help="JSON file of a previous run, to compare the results with.", type=Path)
+    parser.add_argument("--times", help="Commands sent by each end to end benchmark. "
+                                        "If not specified the default is 20000.", default=20000, type=int)
+    parser.add_argument("--connections", help="Connections used by the end to end benchmarks. "
+                                              "If not specified the default is 4.", default=4, type=int)
+    parser.add_argument("--pipeline", help="Commands in flight per connection in the pipelined end to end benchmarks. "
+                                           "If not specified the default is 16.", default=16, type=int)
+    parser.add_argument("--proto", help="Protocols of the end to end benchmarks. The default is tcp, udp and tls.",
+                        nargs='+', default=["tcp", "udp", "tls"], choices=["tcp", "udp", "tls"], type=str.lower)
+    parser.add_argument("--keyfile", help="Key file used by the simulator and by the client for tls.", type=Path,
+                        default="server.key")
+    parser.add_argument("--crtfile", help="Certificate file used by the simulator and by the client for tls.",
+                        type=Path, default="server.crt")
+    parser.add_argument("--min-time", help="Minimum duration in seconds of each measure round of the function "
+                                           "benchmarks. If not specified the default is 0.2.", default=0.2, type=float)
+    parser.add_argument("--skip-end-to-end", help="Only measures the functions, without the simulator.",
+                        action="store_true")
+    args = parser.parse_args()
+    if args.times <= 0 or args.connections <= 0 or args.pipeline <= 0:
+        parser.error("--times, --connections and --pipeline must be positive integers (greater than 0).")
+    if args.times < args.connections:
+        parser.error("--times must be at least --connections.")
+    if args.min_time <= 0:
+        parser.error("--min-time must be greater than 0.")
+
+    print("payShield pressure test benchmark, version " + pressureTest.VERSION +
+          ", by Marco S. Zuppone - msz@msz.eu - https://msz.eu")
+    results = {
+        "version": pressureTest.VERSION,
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "micro": {},
+        "end_to_end": {}
+    }
+    print("")
+    print("Cost per call of the client functions")
+    results["micro"] = run_micro_benchmarks(args.min_time)
+    for name, measure in results["micro"].items():
+        print(" {:45} {:12.1f} ns {:14.1f} calls/s".format(name, measure["ns_per_call"],
+                                                            measure["calls_per_second"]))
+
+    if not args.skip_end_to_end:
+        protocols = list(args.proto)
+        if 'tls' in protocols and not (args.keyfile.is_file() and args.crtfile.is_file()):
+            print("")
+            print("The tls benchmarks are skipped: the files", args.keyfile, "and", args.crtfile, "are required")
+            results["end_to_end"]["tls"] = {"skipped": "key or certificate file not found"}
+            protocols.remove('tls')
+        simulator = PayShieldSimulator(SimulatedHsm(len(HEADER)), port=0, tls_port=0, protocols=protocols,
+                                       keyfile=str(args.keyfile), crtfile=str(args.crtfile)).start()
+        print("")
+        print("End to end NC commands against the local simulator (" + str(args.times) + " commands, " +
+              str(args.connections) + " connections)")
+        try:
+            for protocol in protocols:
+                for pipeline in [None, args.pipeline]:
+                    name = protocol + (" pipeline " + str(pipeline) if pipeline else "")
+                    measure = run_end_to_end(protocol, simulator.ports[protocol], args.times, args.connections,
+                                             pipeline, str(args.keyfile), str(args.crtfile))
+                    results["end_to_end"][name] = measure
+                    print(" {:20} {:10.1f} TPS errors: {} latency p50={} p99={} ms".format(
+                        name, measure["throughput"], measure["errors"], measure["latency_ms"]["p50"],
+                        measure["latency_ms"]["p99"]))
+        finally:
+            simulator.stop()
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("")
+    print("Results saved in", args.output)
+    if args.baseline is not None:
+        try:
+            with open(args.baseline) as baseline_file:
+                compare(results, json.load(baseline_file))
+        except (OSError, ValueError) as e:
+            print("The baseline cannot be read:", e)
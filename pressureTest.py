@@ -3,31 +3,123 @@
 # Please refer to the LICENSE file for more information about licensing
 # and to the README.md file for more information about the usage of it.
 
+import asyncio
 import socket
 import ssl
 import binascii
 import string
 import sys
 import time
+import random
+import bisect
 from struct import *
 import argparse
 from pathlib import Path
-from typing import Tuple, Dict, Any, Callable
+from typing import Tuple, Dict, Any, Callable, NamedTuple
 from types import FunctionType
 # for autoupdate
 import requests
 import threading
+import multiprocessing
+import queue
 from datetime import datetime, timedelta
 from packaging.version import Version
 import os
 import json
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import csv
+import gzip
 # for the Logging feature
 import logging
 from logging.handlers import RotatingFileHandler
 
+# optional, only needed to read the scenario files in YAML
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 VERSION = "1.5.2"
 
 
+def build_frame(host_command: str) -> bytes:
+    """
+    It frames the command as expected by the payShield host port: the two bytes of the length, big-endian,
+    followed by the command.
+
+    Parameters
+    ----------
+    host_command : str
+        The command complete of the header part
+
+    Returns
+    -------
+    bytes
+        The framed message
+    """
+    return pack('>h', len(host_command)) + host_command.encode()
+
+
+def reconnect_delay(failures: int, backoff: float, backoff_max: float) -> float:
+    """
+        It returns how long to wait before opening the connection again, after the number of consecutive failures
+        specified. The delay doubles at every failure up to backoff_max, and a random jitter of up to half of it
+        is subtracted, so the connections of a pool do not reconnect all at the same moment.
+
+        Parameters
+        ----------
+         failures: int
+            The number of consecutive failures of the connection
+         backoff: float
+            The delay after the first failure in seconds
+         backoff_max: float
+            The maximum delay in seconds
+
+        Returns
+        -------
+        result : float
+            The delay in seconds, 0 if there were no failures
+    """
+    if failures <= 0:
+        return 0.0
+    delay = min(backoff_max, backoff * (2 ** min(failures - 1, 32)))
+    return delay - random.uniform(0, delay / 2)
+
+
+_tls_contexts: Dict[Tuple[str, str], ssl.SSLContext] = {}
+_tls_contexts_lock = threading.Lock()
+
+
+def tls_client_context(keyfile: str, crtfile: str) -> ssl.SSLContext:
+    """
+        It returns the SSLContext used by the tls connections to the payShield.
+        The context is created, and the certificate chain loaded, only the first time: all the connections with the
+        same key and certificate share it, together with its session cache.
+
+        Parameters
+        ----------
+         keyfile: str
+            The full path of the client key file
+         crtfile: str
+            The full path of the client certificate file
+
+        Returns
+        -------
+        result : ssl.SSLContext
+            The context shared by all the connections using keyfile and crtfile
+    """
+    with _tls_contexts_lock:
+        context = _tls_contexts.get((keyfile, crtfile))
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_cert_chain(certfile=crtfile, keyfile=keyfile)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            _tls_contexts[(keyfile, crtfile)] = context
+        return context
+
+
 class PayConnector:
     """It represents the connection with the payShield host port. It supports tcp,udp, and tls.
 
@@ -51,10 +143,51 @@ class PayConnector:
         crtfile : str
             In the case of tls protocol, this is the full path of the client certificate file.
         context : ssl.SSLContext
-            The SSLContext object.
+            The SSLContext object, shared by all the connections. See tls_client_context.
+        resume_sessions : bool
+            In the case of tls protocol, when True the TLS session of the previous connection is resumed.
+        connects : int
+            How many times the connection has been opened.
+        reconnects : int
+            How many times the connection has been opened again after the first time.
+        connect_latency : LatencyHistogram
+            How long it took to open the tcp connection, in microseconds.
+        handshake_latency : LatencyHistogram
+            How long the TLS handshake took, in microseconds.
+        resumed : int
+            How many TLS handshakes resumed the previous session.
+        connect_us : int
+            The total microseconds spent opening the connection, to exclude them from the latency of the commands.
+        open_us : int
+            The total microseconds the connections stayed open, from the start of the connection to its close.
+        timeouts : int
+            How many times the payShield did not respond within read_timeout.
+        late : int
+            How many responses arrived after read_timeout. It is always 0, as the connection is opened again after
+            a timeout, and a late response is never read.
+        reordered : int
+            How many responses arrived after the response of a command sent later. It is always 0, as only one
+            command at a time is in flight.
+        resets : int
+            How many times the connection was closed or reset by the host while in use.
+        connect_errors : int
+            How many times the connection could not be opened.
+        connect_timeout : float | None
+            The seconds to wait for the connection, and the TLS handshake, to complete. None waits forever.
+        read_timeout : float | None
+            The seconds to wait for a response. None waits forever.
+        backoff : float
+            The seconds to wait before opening the connection again after the first failure.
+            The delay doubles at every consecutive failure.
+        backoff_max : float
+            The maximum seconds to wait before opening the connection again.
         """
+    # maximum number of framed messages kept by send_command
+    FRAME_CACHE_SIZE = 256
 
-    def __init__(self, host: str, port: int, protocol: str, keyfile: str | None = None, crtfile: str | None = None):
+    def __init__(self, host: str, port: int, protocol: str, keyfile: str | None = None, crtfile: str | None = None,
+                 connect_timeout: float | None = 5, read_timeout: float | None = 10, backoff: float = 0.1,
+                 backoff_max: float = 10, resume_sessions: bool = True):
         """
         Constructor for the PayConnector class. It sets all the initial parameters.
 
@@ -70,7 +203,16 @@ class PayConnector:
             In the case of tls protocol, this is the full path of the client key file.
         crtfile : str, optional
             In the case of tls protocol, this is the full path of the client certificate file.
-
+        connect_timeout : float, optional
+            The seconds to wait for the connection to be opened. The default is 5, None waits forever.
+        read_timeout : float, optional
+            The seconds to wait for a response. The default is 10, None waits forever.
+        backoff : float, optional
+            The seconds to wait before opening the connection again after the first failure. The default is 0.1.
+        backoff_max : float, optional
+            The maximum seconds to wait before opening the connection again. The default is 10.
+        resume_sessions : bool, optional
+            In the case of tls protocol, whether the TLS session is resumed when reconnecting. The default is True.
 
         Raises
         ------
@@ -89,16 +231,87 @@ class PayConnector:
         self.port = port
         self.protocol = protocol
         self.connected = False
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.resume_sessions = resume_sessions
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_latency = LatencyHistogram()
+        self.handshake_latency = LatencyHistogram()
+        self.resumed = 0
+        self.connect_us = 0
+        self.open_us = 0
+        self._opened_at = 0
+        self.timeouts = 0
+        self.late = 0
+        self.reordered = 0
+        self.resets = 0
+        self.connect_errors = 0
+        # consecutive failures, and when the connection can be opened again
+        self._failures = 0
+        self._retry_time = 0.0
+        # the TLS session of the last connection, resumed by the next one
+        self._session = None
+        # framed messages of the commands already sent, indexed by command
+        self._frames: Dict[str, bytes] = {}
+        # preallocated buffer able to hold the largest message the length prefix can describe
+        self._buffer = bytearray(2 + 0xFFFF)
+        self._view = memoryview(self._buffer)
         if protocol not in ['udp', 'tcp', 'tls']:
             raise ValueError("protocol must me udp, tcp or tls")
         if protocol == 'tls':
             if (keyfile is None) or (crtfile is None):
                 raise ValueError("keyfile and crtfile parameters are both required")
 
+    def _receive_message(self, stream: socket.socket) -> bytes:
+        """
+        It reads from the stream exactly one message: the two bytes of the length, big-endian,
+        followed by the number of bytes they state.
+        The data is read in the preallocated buffer of the instance, so replies split over several segments
+        are reassembled, and the bytes of a following reply coalesced in the same segment are left in the stream.
+
+        Parameters
+        ----------
+        stream : socket.socket
+            The tcp socket or the SSLSocket to read from
+
+        Returns
+        -------
+        bytes
+            The message, including the two bytes of the length.
+
+        Raises
+        ------
+        ConnectionError
+            If the host closes the connection before the whole message is received.
+        """
+        view = self._view
+        received = 0
+        expected = 2
+        while received < expected:
+            chunk_len = stream.recv_into(view[received:expected])
+            if chunk_len == 0:
+                raise ConnectionError("Connection closed by the host")
+            received = received + chunk_len
+            if received == 2 and expected == 2:
+                expected = 2 + int.from_bytes(view[:2], byteorder='big', signed=False)
+        return bytes(view[:expected])
+
+    def _count_connect(self):
+        """
+        It accounts a connection just opened.
+        """
+        if self.connects > 0:
+            self.reconnects += 1
+        self.connects += 1
+
     def send_command(self, host_command: str) -> bytes:
         """
         sends the command specified in the parameter to the payShield and return the response.
-        If establishes the connection if it's not established yet, otherwise reuses the open connection
+        If establishes the connection if it's not established yet, otherwise reuses the open connection.
+        The framed message of each command is built once and then reused every time the same command is sent.
 
         Parameters
         ----------
@@ -110,68 +323,132 @@ class PayConnector:
         bytes
             The response from the host.
         """
-        size = pack('>h', len(host_command))
+        message = self._frames.get(host_command)
+        if message is None:
+            message = build_frame(host_command)
+            # commands that change for every request are not worth caching
+            if len(self._frames) < self.FRAME_CACHE_SIZE:
+                self._frames[host_command] = message
+        return self.send_frame(message)
+
+    def send_frame(self, message: bytes | bytearray | memoryview) -> bytes:
+        """
+        sends the message, already framed with the two bytes of the length, to the payShield and return the response.
+        If establishes the connection if it's not established yet, otherwise reuses the open connection.
+        The message is completely sent before the method returns.
 
-        # join everything together in python3
-        message = size + host_command.encode()
-        # Connect to the host and gather the reply in TCP or UDP
-        buffer_size = 4096
+        Parameters
+        ----------
+        message : bytes | bytearray | memoryview
+            The message to send, as returned by build_frame
+
+        Returns
+        -------
+        bytes
+            The response from the host.
+        """
+        # Connect to the host, waiting for the backoff if the connection failed before
         try:
-            if self.protocol == 'tcp':
-                if not self.connected:
-                    self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.connection.connect((self.host, self.port))
-                # send message
-                self.connection.send(message)
-                # receive data
-                data: bytes = self.connection.recv(buffer_size)
-                self.connected = True
-                return data
+            if not self.connected:
+                self._connect()
+        except FileNotFoundError as e:
+            print("The client certificate file or the client key file cannot be found or accessed.\n" +
+                  "Check value passed to the parameters --keyfile and --crtfile", e)
+            return None
+        except ssl.SSLError as e:
+            self._failed('connect_errors')
+            raise ssl.SSLError("TLS connection error: ", e)
+        except OSError as e:
+            print("Connection issue: ", e)
+            self._failed('connect_errors')
+            return None
+        except Exception as e:
+            print("Unexpected issue: ", e)
+            self._failed('connect_errors')
+            return None
 
-            elif self.protocol == "tls":
-                # creates the TCP TLS socket
-                if not self.connected:
-                    # Let's set the context
-                    self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                    self.context.load_cert_chain(certfile=self.crtfile, keyfile=self.keyfile)
-                    self.context.check_hostname = False
-                    self.context.verify_mode = ssl.CERT_NONE
-                    self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.ssl_sock = self.context.wrap_socket(self.connection, server_side=False)
-                    self.ssl_sock.connect((self.host, self.port))
-                # send message
-                self.ssl_sock.send(message)
-                # receive data
-                data: bytes = self.ssl_sock.recv(buffer_size)
-                self.connected = True
-                return data
-            elif self.protocol == 'udp':
-                if not self.connected:
-                    # create the UDP socket
-                    self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    self.connected = True
-                # send data
+        # send the message and gather the reply in TCP or UDP
+        try:
+            if self.protocol == 'udp':
                 self.connection.sendto(message, (self.host, self.port))
-                # receive data
-                self.connection.settimeout(5)
-                data_tuple = self.connection.recvfrom(buffer_size)
-                data: bytes = data_tuple[0]
-                return data
+                # receive data, a datagram always contains one whole message
+                received, _ = self.connection.recvfrom_into(self._buffer)
+                data: bytes = bytes(self._view[:received])
+            else:
+                stream = self.ssl_sock if self.protocol == 'tls' else self.connection
+                stream.sendall(message)
+                data: bytes = self._receive_message(stream)
+            self._failures = 0
+            return data
+
+        except TimeoutError:
+            # a late response would be taken as the response of the next command, so the connection is dropped
+            if self.protocol == 'udp':
+                # the datagram is lost: the timeout already delayed the next command, there is no need of backoff
+                self.timeouts += 1
+                self.close()
+            else:
+                print("Connection issue: no response within", self.read_timeout, "seconds")
+                self._failed('timeouts')
 
-        except (ConnectionError, TimeoutError) as e:
+        except ConnectionError as e:
             print("Connection issue: ", e)
-            self.connected = False
-
-        except FileNotFoundError as e:
-            print("The client certificate file or the client key file cannot be found or accessed.\n" +
-                  "Check value passed to the parameters --keyfile and --crtfile", e)
+            self._failed('resets')
 
         except ssl.SSLError as e:
+            self._failed('resets')
             raise ssl.SSLError("TLS connection error: ", e)
 
         except Exception as e:
             print("Unexpected issue: ", e)
-            self.connected = False
+            self._failed('resets')
+
+    def _connect(self):
+        """
+        It opens the connection, after waiting for the backoff if the previous attempts failed.
+        The connect_timeout applies to the connection and to the TLS handshake, the read_timeout to the responses.
+        """
+        delay = self._retry_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        start_time = time.perf_counter_ns()
+        try:
+            if self.protocol == 'udp':
+                # create the UDP socket
+                self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            else:
+                self.connection = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+                connected_time = time.perf_counter_ns()
+                self.connect_latency.record((connected_time - start_time) // 1000)
+                if self.protocol == 'tls':
+                    # the context is shared, so the certificate chain is loaded only once
+                    self.context = tls_client_context(self.keyfile, self.crtfile)
+                    try:
+                        self.ssl_sock = self.context.wrap_socket(self.connection, server_side=False,
+                                                                 session=self._session)
+                    except BaseException:
+                        self.connection.close()
+                        raise
+                    self.handshake_latency.record((time.perf_counter_ns() - connected_time) // 1000)
+                    if self.ssl_sock.session_reused:
+                        self.resumed += 1
+        finally:
+            self.connect_us += (time.perf_counter_ns() - start_time) // 1000
+        # after wrap_socket the tcp socket is detached, and the timeout is set on the SSLSocket
+        (self.ssl_sock if self.protocol == 'tls' else self.connection).settimeout(self.read_timeout)
+        self.connected = True
+        self._opened_at = start_time
+        self._count_connect()
+
+    def _failed(self, counter: str):
+        """
+        It closes the connection after a failure, accounts it in the counter specified, and sets when the
+        connection can be opened again.
+        """
+        setattr(self, counter, getattr(self, counter) + 1)
+        self.close()
+        self._failures += 1
+        self._retry_time = time.monotonic() + reconnect_delay(self._failures, self.backoff, self.backoff_max)
 
     def close(self):
         """
@@ -179,10 +456,17 @@ class PayConnector:
         """
 
         if self.connected:
-            if self.ssl_sock:
-                self.ssl_sock.close()
+            self.open_us += (time.perf_counter_ns() - self._opened_at) // 1000
+        if self.ssl_sock:
+            if self.resume_sessions and self.ssl_sock.session is not None:
+                # with TLS 1.3 the session ticket arrives after the handshake, so it is taken when closing
+                self._session = self.ssl_sock.session
+            self.ssl_sock.close()
+            self.ssl_sock = None
+        if self.connection:
             self.connection.close()
-            self.connected = False
+            self.connection = None
+        self.connected = False
 
     def __del__(self):
         """
@@ -195,801 +479,5044 @@ class PayConnector:
 
 # End Class
 
-def decode_n0(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command N0 and prints the meaning of the returned output
+class AsyncPayConnector:
+    """It represents an asyncio connection with the payShield host port. It supports tcp, udp, and tls.
+        Differently from PayConnector, it keeps up to *window* commands in flight on the same connection.
+        The header of every command is replaced with a rolling sequence number, and the header echoed back by the
+        payShield is used to match each response with its request.
 
-    Parameters
-    ----------
-    response_to_decode : bytes
-        The response returned by the payShield
+        Attributes
+        ----------
+        host : str
+            The host ip or hostname.
+        port : int
+            The tcp/udp port to connect with.
+        protocol: str
+            The protol to use to connect to the host. Can be only tcp, tls,or udp.
+        header_len : int
+            The length of the header, that is the number of digits of the sequence number.
+        window : int
+            The maximum number of commands in flight on the connection.
+        connected: bool
+            When True, the connection has been established already, and there is no need to open a new one.
+            When False, the connection needs to be opened.
+        keyfile : str
+            In the case of tls protocol, this is the full path of the client key file.
+        crtfile : str
+            In the case of tls protocol, this is the full path of the client certificate file.
+        connect_timeout : float | None
+            The seconds to wait for the connection, and the TLS handshake, to complete. None waits forever.
+        read_timeout : float | None
+            How many seconds to wait for a response before considering it lost. None waits forever.
+        backoff : float
+            The seconds to wait before opening the connection again after the first failure.
+            The delay doubles at every consecutive failure.
+        backoff_max : float
+            The maximum seconds to wait before opening the connection again.
+        connects : int
+            How many times the connection has been opened.
+        reconnects : int
+            How many times the connection has been opened again after the first time.
+        connect_latency : LatencyHistogram
+            How long it took to open the tcp connection, in microseconds.
+        handshake_latency : LatencyHistogram
+            How long the TLS handshake took, in microseconds.
+        resumed : int
+            How many TLS handshakes resumed a previous session. It is always 0, as asyncio does not support the
+            resumption of TLS sessions.
+        connect_us : int
+            The total microseconds spent opening the connection, to exclude them from the latency of the commands.
+        open_us : int
+            The total microseconds the connections stayed open, from the start of the connection to its close.
+        timeouts : int
+            How many responses did not arrive within read_timeout. With udp, they are the datagrams lost.
+        late : int
+            How many responses arrived after read_timeout, when their request was already considered lost.
+        reordered : int
+            How many responses arrived after the response of a command sent later.
+        resets : int
+            How many times the connection was closed or reset by the host while in use.
+        connect_errors : int
+            How many times the connection could not be opened.
+        """
 
-    head_len : int
-        The length of the header
+    def __init__(self, host: str, port: int, protocol: str, keyfile: str | None = None, crtfile: str | None = None,
+                 header_len: int = 4, window: int = 16, connect_timeout: float | None = 5,
+                 read_timeout: float | None = 10, backoff: float = 0.1, backoff_max: float = 10):
+        """
+        Constructor for the AsyncPayConnector class. It sets all the initial parameters.
 
-    Returns
-    ----------
-    nothing
-    """
-    response_to_decode_str, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode_str[str_pointer:str_pointer + 2] == '01':
-        print("Invalid Random Value Length")
-    elif response_to_decode_str[str_pointer:str_pointer + 2] == '00':
-        print("Random payload:(HEX)",
-              bytes.hex(response_to_decode[6 + head_len:]))
+        Parameters
+        ----------
+        host : str
+            The host ip or hostname.
+        port : int
+            The tcp/udp port to connect with.
+        protocol : str
+            The protol to use to connect to the host. Can be only tcp, tls, or udp.
+        keyfile : str, optional
+            In the case of tls protocol, this is the full path of the client key file.
+        crtfile : str, optional
+            In the case of tls protocol, this is the full path of the client certificate file.
+        header_len : int, optional
+            The length of the header. The default is 4, the factory value of the payShield 10k.
+        window : int, optional
+            The maximum number of commands in flight on the connection. The default is 16.
+        connect_timeout : float, optional
+            The seconds to wait for the connection to be opened. The default is 5, None waits forever.
+        read_timeout : float, optional
+            The seconds to wait for a response. The default is 10, None waits forever.
+        backoff : float, optional
+            The seconds to wait before opening the connection again after the first failure. The default is 0.1.
+        backoff_max : float, optional
+            The maximum seconds to wait before opening the connection again. The default is 10.
 
+        Raises
+        ------
+        ValueError
+            If the protocol is not 'tcp', 'tls', or 'udp'.
+        ValueError
+            If the protocol is 'tls' but keyfile or crtfile is not provided.
+        ValueError
+            If the header is too short to hold a sequence number for every command in the window.
+        """
+        self.keyfile = keyfile
+        self.crtfile = crtfile
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.header_len = header_len
+        self.window = window
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.connected = False
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_latency = LatencyHistogram()
+        self.handshake_latency = LatencyHistogram()
+        self.resumed = 0
+        self.connect_us = 0
+        self.open_us = 0
+        self._opened_at = 0
+        self.timeouts = 0
+        self.resets = 0
+        self.connect_errors = 0
+        # consecutive failures, and when the connection can be opened again
+        self._failures = 0
+        self._retry_time = 0.0
+        self._reader = None
+        self._writer = None
+        self._transport = None
+        self._reader_task = None
+        # the requests in flight, indexed by header, with the order they were sent in
+        self._pending: Dict[bytes, Tuple[asyncio.Future, int]] = {}
+        # the headers of the requests timed out, whose response would arrive late
+        self._expired: set = set()
+        self._sent = 0
+        self._highest_received = 0
+        self.late = 0
+        self.reordered = 0
+        self._sequence = 0
+        self._slots = None
+        self._connect_lock = None
+        # framed messages of the commands already sent, indexed by command
+        self._frames: Dict[str, bytes] = {}
+        if protocol not in ['udp', 'tcp', 'tls']:
+            raise ValueError("protocol must me udp, tcp or tls")
+        if protocol == 'tls':
+            if (keyfile is None) or (crtfile is None):
+                raise ValueError("keyfile and crtfile parameters are both required")
+        if window <= 0 or header_len <= 0 or window >= 10 ** header_len:
+            raise ValueError("the header must have enough digits to number all the commands in the window")
 
-def decode_no(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command NO and prints the meaning of the returned output
+    async def connect(self):
+        """
+        It opens the connection and, for tcp and tls, starts the task that reads the responses.
+        If the connection is already open, it does nothing, so it can be invoked by all the commands in flight.
+        If the previous attempts failed, it waits for the backoff before opening the connection.
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connected:
+                return
+            # release what is left of a previous broken connection
+            await self._release()
+            delay = self._retry_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            start_time = time.perf_counter_ns()
+            try:
+                if self.protocol == 'udp':
+                    loop = asyncio.get_running_loop()
+                    self._transport, _ = await loop.create_datagram_endpoint(
+                        lambda: _AsyncPayDatagramProtocol(self), remote_addr=(self.host, self.port))
+                else:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.connect_timeout)
+                    connected_time = time.perf_counter_ns()
+                    self.connect_latency.record((connected_time - start_time) // 1000)
+                    if self.protocol == 'tls':
+                        # the handshake is started apart, to measure it separately from the tcp connection
+                        await asyncio.wait_for(self._writer.start_tls(tls_client_context(self.keyfile, self.crtfile)),
+                                               self.connect_timeout)
+                        self.handshake_latency.record((time.perf_counter_ns() - connected_time) // 1000)
+                    self._reader_task = asyncio.create_task(self._read_responses())
+            except FileNotFoundError:
+                raise
+            except asyncio.TimeoutError:
+                self._failed('connect_errors')
+                raise ConnectionError("connection not opened within " + str(self.connect_timeout) + " seconds")
+            except OSError:
+                self._failed('connect_errors')
+                raise
+            finally:
+                self.connect_us += (time.perf_counter_ns() - start_time) // 1000
+            self.connected = True
+            self._opened_at = start_time
+            if self.connects > 0:
+                self.reconnects += 1
+            self.connects += 1
+
+    async def _read_responses(self):
+        """
+        It reads the length-prefixed responses from the stream and hands each one to the request waiting for it.
+        When the connection breaks, all the requests in flight fail with ConnectionError.
+        """
+        try:
+            while True:
+                size = await self._reader.readexactly(2)
+                payload = await self._reader.readexactly(int.from_bytes(size, byteorder='big', signed=False))
+                self._dispatch(size + payload)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            self._failed('resets')
+            self._fail_pending(ConnectionError("connection lost: " + str(e)))
+
+    def _failed(self, counter: str):
+        """
+        It accounts a failure of the connection in the counter specified, and sets when the connection can be
+        opened again.
+        """
+        setattr(self, counter, getattr(self, counter) + 1)
+        self._failures += 1
+        self._retry_time = time.monotonic() + reconnect_delay(self._failures, self.backoff, self.backoff_max)
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+    def _dispatch(self, data: bytes):
+        """
+        It resolves the request whose header matches the header of the response.
+        Responses that do not match any request in flight are discarded, and accounted as late if their request
+        timed out.
 
-    Returns
-    ----------
-    nothing
-    """
-    BUFFER_SIZE: Dict[str, str] = {
-        '0': '2K bytes', '1': '8K bytes', '2': '16K bytes', '3': '32K bytes'}
-    NET_PROTO: Dict[str, str] = {'0': 'UDP', '1': 'TCP'}
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':  # No errors
-        if len(response_to_decode) >= (24 + head_len):  # Mode 00
-            # I obtained the value 24 in this way: 2 for the response len, 2 for the error code and the rest is for the
-            # sum of the field len as indicated by the Core Host Command Manual
-            str_pointer = str_pointer + 2
-            print("I/O buffer size: ", BUFFER_SIZE.get(response_to_decode[str_pointer:str_pointer + 1], "Unknown"))
-            str_pointer = str_pointer + 1
-            print("Type of connection: ", NET_PROTO.get(response_to_decode[str_pointer:str_pointer + 1], "Unknown"))
-            str_pointer = str_pointer + 1
-            if len(response_to_decode) > (24 + head_len):  # FW 1.8a or more
-                socket_field_len = 4  # From FW 1.8a the Number of TCP sockets is 4 character long instead of 2
-            else:
-                socket_field_len = 2
-            print("Number of TCP sockets: ", response_to_decode[str_pointer:str_pointer + socket_field_len])
-            str_pointer = str_pointer + socket_field_len
-            print("Firmware number: ", response_to_decode[str_pointer:str_pointer + 9])
-            str_pointer = str_pointer + 9
-            print("Reserved: ", response_to_decode[str_pointer:str_pointer + 1])
-            str_pointer = str_pointer + 1
-            print("Reserved: ", response_to_decode[str_pointer:str_pointer + 4])
+        Parameters
+        ----------
+        data : bytes
+            The response received from the payShield, including the two bytes of the length.
+        """
+        header = data[2:2 + self.header_len]
+        entry = self._pending.pop(header, None)
+        if entry is None:
+            if header in self._expired:
+                self._expired.discard(header)
+                self.late += 1
+            return
+        future, order = entry
+        if order < self._highest_received:
+            self.reordered += 1
+        else:
+            self._highest_received = order
+        if not future.done():
+            future.set_result(data)
 
-        else:  # Mode 01
-            str_pointer = str_pointer + 2
-            if response_to_decode[str_pointer:str_pointer + 1] == '0':
-                print(
-                    "Some of the security settings relevant to PCI HSM compliance have non-compliant values.\n"
-                    "\"The Enforce key type 002 separation for PCI HSM compliance\" setting is one of these.")
+    def _fail_pending(self, exception: Exception):
+        """
+        It marks the connection as closed and fails all the requests in flight with the exception passed.
+        """
+        self.connected = False
+        pending = self._pending
+        self._pending = {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(exception)
 
-            elif response_to_decode[str_pointer:str_pointer + 1] == '1':
-                print("All security settings relevant to PCI HSM compliance have compliant values.")
+    def _next_header(self) -> bytes:
+        """
+        It returns the next sequence number, formatted as a header, skipping the ones still in flight.
+        """
+        while True:
+            self._sequence = (self._sequence + 1) % (10 ** self.header_len)
+            header = str(self._sequence).zfill(self.header_len).encode()
+            if header not in self._pending:
+                # a response still missing for this header can no longer be told apart from the new one
+                self._expired.discard(header)
+                return header
+
+    async def send_command(self, host_command: str) -> bytes | None:
+        """
+        sends the command specified in the parameter to the payShield and return the response.
+        The header of the command is replaced with the sequence number used to match the response.
+        It waits if there are already *window* commands in flight.
 
-            elif response_to_decode[str_pointer:str_pointer + 1] == '2':
-                print(
-                    "Some of the security settings relevant to PCI HSM compliance have non-compliant values.\n"
-                    "\"The Enforce key type 002 separation for PCI HSM compliance\" setting is not one of these.")
+        Parameters
+        ----------
+        host_command : str
+            The command to send to the payShield host port, complete of the header part.
 
+        Returns
+        -------
+        bytes | None
+            The response from the host, or None if the connection failed.
+        """
+        message = self._frames.get(host_command)
+        if message is None:
+            message = build_frame(host_command)
+            # commands that change for every request are not worth caching
+            if len(self._frames) < PayConnector.FRAME_CACHE_SIZE:
+                self._frames[host_command] = message
+        return await self.send_frame(message)
+
+    async def send_frame(self, message: bytes | bytearray | memoryview) -> bytes | None:
+        """
+        sends the message, already framed with the two bytes of the length, to the payShield and return the response.
+        The header of the message is replaced with the sequence number used to match the response, without
+        modifying the message passed.
+        It waits if there are already *window* commands in flight.
 
-def decode_ni(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command NI and prints the meaning of the returned output
+        Parameters
+        ----------
+        message : bytes | bytearray | memoryview
+            The message to send, as returned by build_frame
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+        Returns
+        -------
+        bytes | None
+            The response from the host, or None if the connection failed.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.window)
+        async with self._slots:
+            try:
+                await self.connect()
+                header = self._next_header()
+                # the length and the command after the header are the same for every request
+                view = memoryview(message)
+                message = b''.join((view[:2], header, view[2 + self.header_len:]))
+                future = asyncio.get_running_loop().create_future()
+                self._sent += 1
+                self._pending[header] = (future, self._sent)
+                if self.protocol == 'udp':
+                    self._transport.sendto(message)
+                else:
+                    self._writer.write(message)
+                    await self._writer.drain()
+                try:
+                    data = await asyncio.wait_for(future, self.read_timeout)
+                except asyncio.TimeoutError:
+                    self._pending.pop(header, None)
+                    self._expired.add(header)
+                    self._failed('timeouts')
+                    raise TimeoutError("no response received within " + str(self.read_timeout) + " seconds")
+                self._failures = 0
+                return data
 
-    Returns
-    ----------
-    nothing
-    """
-    NET_PROTO: Dict[str, str] = {'0': 'TCP', '1': 'UDP'}
-    SPECIFIC_ERROR: Dict[str, str] = {'01': 'Failed to execute NETSTAT',
-                                      '82': 'Invalid Ethernet Statistics value'}
-    NET_CONNECTION_STATUS: Dict[str, str] = {'0': 'ESTABLISHED', '1': 'CLOSED'}
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':  # No errors
-        str_pointer = str_pointer + 2
-        print("Records to follow: ", response_to_decode[str_pointer:str_pointer + 4])
-        records_to_follow = int(response_to_decode[str_pointer:str_pointer + 4])
-        str_pointer = str_pointer + 4
-        for record in range(records_to_follow):
-            print("Protocol: ", NET_PROTO.get(response_to_decode[str_pointer:str_pointer + 1],
-                                              "Unknown"))
-            str_pointer = str_pointer + 1
-            print("Local port number: ", response_to_decode[str_pointer:str_pointer + 4])
-            str_pointer = str_pointer + 4
-            print("IP Address: ", hex2ip(response_to_decode[str_pointer:str_pointer + 8]))
-            str_pointer = str_pointer + 8
-            print("Remote port number: ", response_to_decode[str_pointer:str_pointer + 4])
-            str_pointer = str_pointer + 4
-            print("Connection Status: ", NET_CONNECTION_STATUS.get(response_to_decode[str_pointer:str_pointer + 1],
-                                                                   'Reserved'))
-            str_pointer = str_pointer + 1
-            print("Duration: ", response_to_decode[str_pointer:str_pointer + 8])
-            str_pointer = str_pointer + 8
-        print("Total Bytes Sent: ", int(response_to_decode[str_pointer:str_pointer + 16], 16))
-        str_pointer = str_pointer + 16
-        print("Total Bytes Received: ", int(response_to_decode[str_pointer:str_pointer + 16], 16))
-        str_pointer = str_pointer + 16
-        print("Total Unicast Packets Sent: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Unicast Packets Received: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Non-unicast packets Sent: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Non-unicast packets Received: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Packets Discarded During Send: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Packets Discarded During Receive: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Errors During Send: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Errors During Receive: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
-        print("Total Unknown Packets: ", int(response_to_decode[str_pointer:str_pointer + 8], 16))
-        str_pointer = str_pointer + 8
+            except TimeoutError as e:
+                # a lost datagram is accounted in the delivery counters, but a silent stream is likely half open
+                if self.protocol != 'udp':
+                    print("Connection issue: ", e)
+                    await self.close()
 
-    else:
-        if SPECIFIC_ERROR.get(response_to_decode[str_pointer:str_pointer + 2]) is not None:
-            print("Command specific error: ", SPECIFIC_ERROR.get(response_to_decode[str_pointer:str_pointer + 2]))
+            except FileNotFoundError as e:
+                print("The client certificate file or the client key file cannot be found or accessed.\n" +
+                      "Check value passed to the parameters --keyfile and --crtfile", e)
 
+            except ssl.SSLError as e:
+                raise ssl.SSLError("TLS connection error: ", e)
 
-def decode_nc(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command NC and prints the meaning of the returned output
-    The message trailer is not considered
+            except (ConnectionError, OSError) as e:
+                print("Connection issue: ", e)
+                if self.connected and self.protocol != 'udp':
+                    # the reset was noticed while sending, before the task that reads the responses
+                    self._failed('resets')
+                    await self.close()
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+            except Exception as e:
+                print("Unexpected issue: ", e)
+                await self.close()
 
-    Returns
-    ----------
-    nothing
-    """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("LMK CRC:", response_to_decode[str_pointer:str_pointer + 16])
-        str_pointer = str_pointer + 16
-        print("Firmware number:", response_to_decode[str_pointer:str_pointer + 9])
+    async def _release(self):
+        """
+        It closes the sockets and stops the task that reads the responses.
+        """
+        if self._opened_at:
+            self.open_us += (time.perf_counter_ns() - self._opened_at) // 1000
+            self._opened_at = 0
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError, ssl.SSLError):
+                pass
+            self._writer = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
 
+    async def close(self):
+        """
+        It closes the connection and fails the requests still in flight.
+        """
+        await self._release()
+        self._fail_pending(ConnectionError("connection closed"))
 
-def decode_ja(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command JA and prints the meaning of the returned output
-    The message trailer is not considered
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+class _AsyncPayDatagramProtocol(asyncio.DatagramProtocol):
+    """It forwards the datagrams received on the udp socket to the AsyncPayConnector that owns it."""
 
-    Returns
-    ----------
-    nothing
-    """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("Pin under the LMK:", response_to_decode[str_pointer:str_pointer + 33])
+    def __init__(self, connector: AsyncPayConnector):
+        self.connector = connector
 
+    def datagram_received(self, data: bytes, addr):
+        self.connector._dispatch(data)
 
-def decode_j8(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command J8 and prints the meaning of the returned output
-    The message trailer is not considered
+    def error_received(self, exc: Exception):
+        self.connector._fail_pending(ConnectionError(str(exc)))
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
 
-    Returns
-    ----------
-    nothing
-    """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("Serial Number: ", response_to_decode[str_pointer:str_pointer + 12])
-        str_pointer = str_pointer + 12
-        print("Start Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Start Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Reboots: ", response_to_decode[str_pointer:str_pointer + 10])
-        str_pointer = str_pointer + 10
-        print("Tampers: ", response_to_decode[str_pointer:str_pointer + 10])
-        str_pointer = str_pointer + 10
-        print("Pin verifies/minute: ", response_to_decode[str_pointer:str_pointer + 7])
-        str_pointer = str_pointer + 7
-        print("Pin verifies/hour: ", response_to_decode[str_pointer:str_pointer + 5])
-        str_pointer = str_pointer + 5
-        print("Pin attacks: ", response_to_decode[str_pointer:str_pointer + 8])
-
-
-def decode_b2(response_to_decode: bytes, head_len: int):
-    """
-    It decodes the result of the command B2 and prints the meaning of the returned output
+# End Class
+
+class TargetPool:
+    """It spreads the commands among the payShields of a cluster. It is shared by all the connections of the
+        process, so the policy balances the whole load and not the load of each connection.
+
+        Attributes
+        ----------
+        targets : list[Tuple[str, int, int]]
+            The host, the port and the weight of each payShield.
+        names : list[str]
+            The payShields as host:port, in the same order of targets.
+        policy : str
+            How the payShield of each command is chosen: round-robin, least-outstanding or weighted.
+        outstanding : list[int]
+            The commands sent to each payShield and still waiting for the response.
+        """
+    POLICIES = ('round-robin', 'least-outstanding', 'weighted')
+
+    def __init__(self, targets: list[Tuple[str, int, int]], policy: str = 'round-robin'):
+        """
+        Constructor for the TargetPool class.
+
+        Parameters
+        ----------
+        targets : list[Tuple[str, int, int]]
+            The host, the port and the weight of each payShield
+        policy : str, optional
+            round-robin sends the commands to each payShield in turn, least-outstanding to the payShield with the
+            fewest commands in flight compared with its weight, weighted to each payShield in proportion to its
+            weight. The default is round-robin
+
+        Raises
+        ------
+        ValueError
+            If the policy is not known, there are no targets, or a weight is not positive.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("the policy must be one of " + ", ".join(self.POLICIES))
+        if not targets:
+            raise ValueError("at least one target is required")
+        if any(weight <= 0 for _, _, weight in targets):
+            raise ValueError("the weights must be greater than 0")
+        self.targets = [(host, int(port), int(weight)) for host, port, weight in targets]
+        self.names = [f"{host}:{port}" for host, port, _ in self.targets]
+        self.policy = policy
+        self.outstanding = [0] * len(self.targets)
+        self._weights = [weight for _, _, weight in self.targets]
+        self._total_weight = sum(self._weights)
+        # the credit of each target in the smooth weighted round-robin used by the weighted policy
+        self._credits = [0] * len(self.targets)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> int:
+        """
+        It chooses the payShield of the next command, and accounts the command as outstanding on it.
+
+        Returns
+        -------
+        int
+            The index of the target. It has to be passed to release when the command completes
+        """
+        with self._lock:
+            count = len(self.targets)
+            if self.policy == 'weighted':
+                # smooth weighted round-robin: the targets are interleaved instead of sent bursts of commands
+                for index in range(count):
+                    self._credits[index] += self._weights[index]
+                index = max(range(count), key=self._credits.__getitem__)
+                self._credits[index] -= self._total_weight
+            elif self.policy == 'least-outstanding':
+                # the scan starts from a rotating position, so the ties do not always favour the first target
+                start = self._next
+                self._next = (self._next + 1) % count
+                index = min(((start + offset) % count for offset in range(count)),
+                            key=lambda i: self.outstanding[i] / self._weights[i])
+            else:
+                index = self._next
+                self._next = (self._next + 1) % count
+            self.outstanding[index] += 1
+            return index
+
+    def release(self, index: int):
+        """
+        It accounts the completion of a command sent to the payShield chosen by acquire.
+
+        Parameters
+        ----------
+        index : int
+            The index of the target, as returned by acquire
+        """
+        with self._lock:
+            self.outstanding[index] -= 1
+
+
+# End Class
+
+class PooledConnector:
+    """It sends the commands of a connection to the payShields of a TargetPool, keeping a PayConnector for each
+        payShield. It offers the same interface as PayConnector, so it can be used wherever a connection is expected.
+        The counters of the connections, e.g. connects or timeouts, are the sums of the counters of all the
+        payShields.
+
+        Attributes
+        ----------
+        pool : TargetPool
+            The pool choosing the payShield of each command.
+        connectors : list[PayConnector]
+            The connections, one for each target of the pool, in the same order.
+        target : str | None
+            The payShield, as host:port, the last command was sent to.
+        connect_latency : LatencyHistogram
+            How long it took to open the tcp connections, in microseconds, shared by all the connections.
+        handshake_latency : LatencyHistogram
+            How long the TLS handshakes took, in microseconds, shared by all the connections.
+        """
+    # the counters summed over the connections to the targets
+    COUNTERS = ('connects', 'reconnects', 'timeouts', 'resets', 'connect_errors', 'resumed', 'connect_us', 'open_us',
+                'late', 'reordered')
+
+    def __init__(self, pool: TargetPool, connectors: list):
+        """
+        Constructor for the PooledConnector class.
+
+        Parameters
+        ----------
+        pool : TargetPool
+            The pool choosing the payShield of each command
+        connectors : list
+            The connections, one for each target of the pool, in the same order
+        """
+        self.pool = pool
+        self.connectors = connectors
+        self.target = None
+        self.connect_latency = LatencyHistogram()
+        self.handshake_latency = LatencyHistogram()
+        for connector in connectors:
+            connector.connect_latency = self.connect_latency
+            connector.handshake_latency = self.handshake_latency
+
+    def __getattr__(self, name: str):
+        if name in self.COUNTERS:
+            return sum(getattr(connector, name) for connector in self.connectors)
+        raise AttributeError(name)
+
+    def send_command(self, host_command: str) -> bytes | None:
+        """
+        It sends the command to the payShield chosen by the pool and returns the response.
+
+        Parameters
+        ----------
+        host_command : str
+            The command to send to the payShield complete of the header part
+
+        Returns
+        -------
+        bytes | None
+            The response, or None if it was not received
+        """
+        index = self.pool.acquire()
+        self.target = self.pool.names[index]
+        try:
+            return self.connectors[index].send_command(host_command)
+        finally:
+            self.pool.release(index)
+
+    def send_frame(self, message: bytes | bytearray | memoryview) -> bytes | None:
+        """
+        It sends a message already framed to the payShield chosen by the pool and returns the response.
+
+        Parameters
+        ----------
+        message : bytes | bytearray | memoryview
+            The message, complete of the length prefix
+
+        Returns
+        -------
+        bytes | None
+            The response, or None if it was not received
+        """
+        index = self.pool.acquire()
+        self.target = self.pool.names[index]
+        try:
+            return self.connectors[index].send_frame(message)
+        finally:
+            self.pool.release(index)
+
+    def close(self):
+        """
+        It closes the connections to all the payShields.
+        """
+        for connector in self.connectors:
+            connector.close()
+
+
+# End Class
+
+class AsyncPooledConnector(PooledConnector):
+    """It sends the commands of an asyncio connection to the payShields of a TargetPool, keeping an
+        AsyncPayConnector for each payShield. As several commands are in flight at the same time, the payShield of
+        each command is returned by send_routed instead of being kept in target.
+
+        Attributes
+        ----------
+        window : int
+            The maximum number of commands in flight on the connections to all the payShields together.
+        """
+
+    def __init__(self, pool: TargetPool, connectors: list, window: int):
+        """
+        Constructor for the AsyncPooledConnector class.
+
+        Parameters
+        ----------
+        pool : TargetPool
+            The pool choosing the payShield of each command
+        connectors : list[AsyncPayConnector]
+            The connections, one for each target of the pool, in the same order
+        window : int
+            The maximum number of commands in flight on the connections to all the payShields together
+        """
+        super().__init__(pool, connectors)
+        self.window = window
+
+    async def send_routed(self, host_command: str,
+                          message: bytes | bytearray | memoryview | None = None) -> Tuple[bytes | None, str]:
+        """
+        It sends the command to the payShield chosen by the pool.
+
+        Parameters
+        ----------
+        host_command : str
+            The command to send to the payShield complete of the header part
+        message : bytes | bytearray | memoryview, optional
+            The command already framed, sent instead of framing host_command
+
+        Returns
+        -------
+        Tuple[bytes | None, str]
+            The response, or None if it was not received, and the payShield as host:port
+        """
+        index = self.pool.acquire()
+        try:
+            if message is None:
+                data = await self.connectors[index].send_command(host_command)
+            else:
+                data = await self.connectors[index].send_frame(message)
+            return data, self.pool.names[index]
+        finally:
+            self.pool.release(index)
+
+    async def send_command(self, host_command: str) -> bytes | None:
+        """
+        It sends the command to the payShield chosen by the pool and returns the response.
+        """
+        return (await self.send_routed(host_command))[0]
+
+    async def send_frame(self, message: bytes | bytearray | memoryview) -> bytes | None:
+        """
+        It sends the message already framed to the payShield chosen by the pool and returns the response.
+        """
+        return (await self.send_routed("", message))[0]
+
+    async def close(self):
+        """
+        It closes the connections to all the payShields.
+        """
+        for connector in self.connectors:
+            await connector.close()
+
+
+# End Class
+
+class LatencyHistogram:
+    """It records latencies in logarithmic buckets, in the same way HdrHistogram does.
+        Values below 128 microseconds have their own bucket, and every further power of two is split in 64 buckets,
+        so the relative error of the percentiles is below 1.6%.
+        The memory used is constant, no matter how many values are recorded.
+
+        Attributes
+        ----------
+        counts : list[int]
+            How many values fell in each bucket.
+        total : int
+            How many values have been recorded.
+        min : int
+            The smallest value recorded, in microseconds.
+        max : int
+            The largest value recorded, in microseconds.
+        sum : int
+            The sum of all the values recorded, in microseconds.
+        """
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+    # values are clamped to about 19 hours, plenty for a command latency
+    MAX_VALUE = (1 << 36) - 1
+
+    def __init__(self):
+        """
+        Constructor for the LatencyHistogram class. It allocates all the buckets.
+        """
+        self.counts: list[int] = [0] * (self._index(self.MAX_VALUE) + 1)
+        self.total: int = 0
+        self.min: int = 0
+        self.max: int = 0
+        self.sum: int = 0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        """
+        It returns the index of the bucket the value falls into.
+        """
+        if value < cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        return shift * cls.HALF_SUB_BUCKETS + (value >> shift)
+
+    @classmethod
+    def _highest_value(cls, index: int) -> int:
+        """
+        It returns the highest value that falls into the bucket with the index specified.
+        """
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.HALF_SUB_BUCKETS - 1
+        mantissa = index - shift * cls.HALF_SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value: int):
+        """
+        It records one value.
+
+        Parameters
+        ----------
+        value : int
+            The latency in microseconds. Negative values are recorded as 0.
+        """
+        value = min(max(value, 0), self.MAX_VALUE)
+        self.counts[self._index(value)] += 1
+        if self.total == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.total += 1
+        self.sum += value
+
+    def merge(self, other: 'LatencyHistogram') -> 'LatencyHistogram':
+        """
+        It adds the values recorded by another instance to this instance.
+
+        Parameters
+        ----------
+        other : LatencyHistogram
+            The instance to merge into this one
+
+        Returns
+        -------
+        LatencyHistogram
+            This instance, to allow chaining
+        """
+        if other.total == 0:
+            return self
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        if self.total == 0 or other.min < self.min:
+            self.min = other.min
+        self.max = max(self.max, other.max)
+        self.total += other.total
+        self.sum += other.sum
+        return self
+
+    def subtract(self, other: 'LatencyHistogram') -> 'LatencyHistogram':
+        """
+        It removes the values recorded by an earlier copy of this instance, leaving only the values recorded since
+        then. The max becomes the highest value of the highest bucket left.
+
+        Parameters
+        ----------
+        other : LatencyHistogram
+            An earlier copy of this instance
+
+        Returns
+        -------
+        LatencyHistogram
+            This instance, to allow chaining
+        """
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] -= count
+        self.total -= other.total
+        self.sum -= other.sum
+        self.max = 0
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index] > 0:
+                self.max = self._highest_value(index)
+                break
+        return self
+
+    def percentile(self, percentile: float) -> int:
+        """
+        It returns the value below which the percentage of values specified falls.
+
+        Parameters
+        ----------
+        percentile : float
+            The percentile, between 0 and 100
+
+        Returns
+        -------
+        int
+            The value in microseconds, or 0 if no value has been recorded
+        """
+        if self.total == 0:
+            return 0
+        threshold = max(1, -(-self.total * percentile // 100))
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def cumulative_counts(self, bounds: list[int]) -> list[int]:
+        """
+        It returns, for each bound, how many values are lower or equal to it, as needed by the histograms
+        of Prometheus. The values in the same bucket of a bound are counted as lower.
+
+        Parameters
+        ----------
+        bounds : list[int]
+            The bounds in microseconds, in ascending order
+
+        Returns
+        -------
+        list[int]
+            The number of values lower or equal to each bound
+        """
+        result = []
+        cumulative = 0
+        index = 0
+        for bound in bounds:
+            last_index = self._index(min(max(bound, 0), self.MAX_VALUE))
+            while index <= last_index:
+                cumulative += self.counts[index]
+                index += 1
+            result.append(cumulative)
+        return result
+
+    @property
+    def mean(self) -> float:
+        """
+        The average of the values recorded, in microseconds.
+        """
+        return self.sum / self.total if self.total else 0.0
+
+    def summary(self) -> str:
+        """
+        It returns the percentiles p50, p90, p99, p99.9 and the max formatted in milliseconds.
+        """
+        return "p50={:.3f} p90={:.3f} p99={:.3f} p99.9={:.3f} max={:.3f} ms".format(
+            *(self.percentile(p) / 1000 for p in (50, 90, 99, 99.9)), self.max / 1000)
+
+    def to_dict(self) -> dict:
+        """
+        It returns the histogram as a dictionary that can be serialized in JSON. Only the buckets not empty are kept.
+        """
+        return {"counts": {index: count for index, count in enumerate(self.counts) if count},
+                "total": self.total, "min": self.min, "max": self.max, "sum": self.sum}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'LatencyHistogram':
+        """
+        It creates a histogram from the dictionary returned by to_dict, also after a round trip through JSON.
+
+        Parameters
+        ----------
+        data : dict
+            The dictionary returned by to_dict
+
+        Returns
+        -------
+        LatencyHistogram
+            The histogram
+        """
+        histogram = cls()
+        for index, count in data["counts"].items():
+            histogram.counts[int(index)] = int(count)
+        histogram.total = int(data["total"])
+        histogram.min = int(data["min"])
+        histogram.max = int(data["max"])
+        histogram.sum = int(data["sum"])
+        return histogram
+
+
+# End Class
+
+class LoadStats:
+    """It collects the counters of the operations performed by one connection during the test.
+        Every connection owns its own instance, so no locking is needed while the test is running.
+        The instances are merged together at the end of the test to produce the aggregated figures.
+
+        Attributes
+        ----------
+        operations : int
+            The number of commands sent to the payShield.
+        return_codes : Dict[str, int]
+            For every return code received, how many times it was returned.
+        latency : LatencyHistogram
+            The latency of the commands that received a response.
+        verbs : Dict[str, LoadStats]
+            The same counters, broken down per command verb.
+        schedule_lag : LatencyHistogram
+            In open-loop mode, how late each command was sent compared to its timetable.
+        stages : Dict[int, LoadStats]
+            When a load profile is used, the same counters broken down per stage of the profile.
+        in_flight : int
+            The number of commands sent and still waiting for the response.
+        connects : int
+            How many times the connection has been opened, as counted by the connector.
+        reconnects : int
+            How many times the connection has been opened again after the first time, as counted by the connector.
+        timeouts : int
+            How many responses did not arrive within the read timeout, as counted by the connector.
+        resets : int
+            How many times the connection was closed or reset by the host while in use, as counted by the connector.
+        connect_errors : int
+            How many times the connection could not be opened, as counted by the connector.
+        connect_latency : LatencyHistogram
+            How long it took to open the tcp connections, as measured by the connector.
+        handshake_latency : LatencyHistogram
+            How long the TLS handshakes took, as measured by the connector.
+        resumed : int
+            How many TLS handshakes resumed the previous session, as counted by the connector.
+        open_us : int
+            The total microseconds the connections stayed open, as measured by the connector.
+        late : int
+            How many responses arrived after the read timeout, as counted by the connector.
+        reordered : int
+            How many responses arrived after the response of a command sent later, as counted by the connector.
+        connection_id : int | None
+            The number of the connection, written in the results file.
+        results : ResultsWriter | None
+            If not None, every operation accounted is also written as a record in the results file.
+        """
+    # the attributes serialized by to_dict
+    COUNTERS = ('operations', 'in_flight', 'connects', 'reconnects', 'timeouts', 'resets', 'connect_errors',
+                'resumed', 'open_us', 'late', 'reordered')
+    HISTOGRAMS = ('latency', 'schedule_lag', 'connect_latency', 'handshake_latency')
+
+    def __init__(self, connection_id: int | None = None, results: 'ResultsWriter | None' = None):
+        """
+        Constructor for the LoadStats class. All the counters start from zero.
+
+        Parameters
+        ----------
+        connection_id : int, optional
+            The number of the connection, written in the results file
+        results : ResultsWriter, optional
+            If specified, every operation accounted is written in the results file as well
+        """
+        self.connection_id = connection_id
+        self.results = results
+        self.operations: int = 0
+        self.return_codes: Dict[str, int] = {}
+        self.latency: LatencyHistogram = LatencyHistogram()
+        self.verbs: Dict[str, LoadStats] = {}
+        self.schedule_lag: LatencyHistogram = LatencyHistogram()
+        self.stages: Dict[int, LoadStats] = {}
+        self.targets: Dict[str, LoadStats] = {}
+        self.in_flight: int = 0
+        self.connects: int = 0
+        self.reconnects: int = 0
+        self.timeouts: int = 0
+        self.resets: int = 0
+        self.connect_errors: int = 0
+        self.connect_latency: LatencyHistogram = LatencyHistogram()
+        self.handshake_latency: LatencyHistogram = LatencyHistogram()
+        self.resumed: int = 0
+        self.open_us: int = 0
+        self.late: int = 0
+        self.reordered: int = 0
+
+    def update_connection(self, connector: 'PayConnector | AsyncPayConnector'):
+        """
+        It copies the counters of the state of the connection from the connector.
+
+        Parameters
+        ----------
+        connector : PayConnector | AsyncPayConnector
+            The connector used by the connection these counters refer to
+        """
+        self.connects = connector.connects
+        self.reconnects = connector.reconnects
+        self.timeouts = connector.timeouts
+        self.resets = connector.resets
+        self.connect_errors = connector.connect_errors
+        # the histograms are only updated when a connection is opened, so they are shared rather than copied
+        self.connect_latency = connector.connect_latency
+        self.handshake_latency = connector.handshake_latency
+        self.resumed = connector.resumed
+        self.open_us = connector.open_us
+        self.late = connector.late
+        self.reordered = connector.reordered
+
+    def connection_health(self) -> str:
+        """
+        It returns the counters of the state of the connection in a human readable form.
+        """
+        return (f"Connection health - reconnects: {self.reconnects} timeouts: {self.timeouts} "
+                f"resets: {self.resets} connect errors: {self.connect_errors}")
+
+    def delivery(self) -> str:
+        """
+        It returns the rate of the responses lost, arrived late or out of order, in a human readable form.
+        """
+        operations = max(self.operations, 1)
+        return (f"Delivery - lost: {self.timeouts} ({self.timeouts * 100 / operations:.2f}%) late: {self.late} "
+                f"reordered: {self.reordered} ({self.reordered * 100 / operations:.2f}%)")
+
+    def record(self, return_code: str, verb: str | None = None, latency: int | None = None,
+               stage: int | None = None, sent_bytes: int | None = None, received_bytes: int | None = None,
+               target: str | None = None):
+        """
+        It accounts one operation and the return code it produced.
+
+        Parameters
+        ----------
+        return_code : str
+            The return code of the command, as returned by run_test
+        verb : str, optional
+            The command verb, e.g. NC. If specified, the operation is accounted in the breakdown per verb as well
+        latency : int, optional
+            The latency of the command in microseconds. If None, the command did not receive a response
+        stage : int, optional
+            The index of the stage of the load profile. If specified, the operation is accounted in the breakdown
+            per stage as well
+        sent_bytes : int, optional
+            The size of the message sent, written in the results file
+        received_bytes : int, optional
+            The size of the response, written in the results file. If None, no response was received
+        target : str, optional
+            The payShield, as host:port, the command was sent to. If specified, the operation is accounted in the
+            breakdown per payShield as well
+        """
+        if self.results is not None:
+            self.results.write(time.time(), self.connection_id, verb, return_code, latency, sent_bytes,
+                               received_bytes, stage, target)
+        self.operations += 1
+        self.return_codes[return_code] = self.return_codes.get(return_code, 0) + 1
+        if latency is not None:
+            self.latency.record(latency)
+        if verb is not None:
+            verb_stats = self.verbs.get(verb)
+            if verb_stats is None:
+                verb_stats = self.verbs[verb] = LoadStats()
+            verb_stats.record(return_code, None, latency)
+        if stage is not None:
+            stage_stats = self.stages.get(stage)
+            if stage_stats is None:
+                stage_stats = self.stages[stage] = LoadStats()
+            stage_stats.record(return_code, verb, latency)
+        if target is not None:
+            target_stats = self.targets.get(target)
+            if target_stats is None:
+                target_stats = self.targets[target] = LoadStats()
+            target_stats.record(return_code, None, latency)
+
+    def merge(self, other: 'LoadStats') -> 'LoadStats':
+        """
+        It adds the counters of another instance to the counters of this instance.
+
+        Parameters
+        ----------
+        other : LoadStats
+            The instance to merge into this one
+
+        Returns
+        -------
+        LoadStats
+            This instance, to allow chaining
+        """
+        self.operations += other.operations
+        self.in_flight += other.in_flight
+        self.connects += other.connects
+        self.reconnects += other.reconnects
+        self.timeouts += other.timeouts
+        self.resets += other.resets
+        self.connect_errors += other.connect_errors
+        self.connect_latency.merge(other.connect_latency)
+        self.handshake_latency.merge(other.handshake_latency)
+        self.resumed += other.resumed
+        self.open_us += other.open_us
+        self.late += other.late
+        self.reordered += other.reordered
+        # the items are copied first, so that a snapshot can be merged while the other instance is being updated
+        for return_code, count in list(other.return_codes.items()):
+            self.return_codes[return_code] = self.return_codes.get(return_code, 0) + count
+        self.latency.merge(other.latency)
+        self.schedule_lag.merge(other.schedule_lag)
+        for verb, verb_stats in list(other.verbs.items()):
+            self.verbs.setdefault(verb, LoadStats()).merge(verb_stats)
+        for stage, stage_stats in list(other.stages.items()):
+            self.stages.setdefault(stage, LoadStats()).merge(stage_stats)
+        for target, target_stats in list(other.targets.items()):
+            self.targets.setdefault(target, LoadStats()).merge(target_stats)
+        return self
+
+    @property
+    def errors(self) -> int:
+        """
+        The number of operations that did not return '00'.
+        """
+        return self.operations - self.return_codes.get('00', 0)
+
+    def to_dict(self) -> dict:
+        """
+        It returns the counters as a dictionary that can be serialized in JSON, to send them to another process or
+        host. The connection_id and the results file are not included.
+        """
+        return {**{name: getattr(self, name) for name in self.COUNTERS},
+                **{name: getattr(self, name).to_dict() for name in self.HISTOGRAMS},
+                "return_codes": dict(self.return_codes),
+                "verbs": {verb: verb_stats.to_dict() for verb, verb_stats in list(self.verbs.items())},
+                "stages": {stage: stage_stats.to_dict() for stage, stage_stats in list(self.stages.items())},
+                "targets": {target: target_stats.to_dict() for target, target_stats in list(self.targets.items())}}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'LoadStats':
+        """
+        It creates the counters from the dictionary returned by to_dict, also after a round trip through JSON.
+
+        Parameters
+        ----------
+        data : dict
+            The dictionary returned by to_dict
+
+        Returns
+        -------
+        LoadStats
+            The counters
+        """
+        stats = cls()
+        for name in cls.COUNTERS:
+            setattr(stats, name, int(data[name]))
+        for name in cls.HISTOGRAMS:
+            setattr(stats, name, LatencyHistogram.from_dict(data[name]))
+        stats.return_codes = {str(return_code): int(count) for return_code, count in data["return_codes"].items()}
+        stats.verbs = {verb: cls.from_dict(verb_stats) for verb, verb_stats in data["verbs"].items()}
+        stats.stages = {int(stage): cls.from_dict(stage_stats) for stage, stage_stats in data["stages"].items()}
+        stats.targets = {target: cls.from_dict(target_stats) for target, target_stats in data["targets"].items()}
+        return stats
+
+
+# End Class
+
+class ResultsWriter:
+    """It writes a record for every operation in the results file, as JSON lines or CSV, optionally compressed
+        with gzip. The records are queued and written by a background thread, so the threads sending the commands
+        never wait for the disk.
+
+        Attributes
+        ----------
+        path : Path
+            The results file. The format is CSV if the name ends with .csv or .csv.gz, otherwise JSON lines.
+            If the name ends with .gz the file is compressed.
+        records : int
+            The number of records written so far.
+        """
+    FIELDS = ('timestamp', 'connection', 'verb', 'return_code', 'latency_us', 'sent_bytes', 'received_bytes', 'stage',
+              'target')
+    # maximum number of records formatted and written at once
+    BATCH_SIZE = 1024
+
+    def __init__(self, path: Path):
+        """
+        Constructor for the ResultsWriter class. It creates the file and starts the writer thread.
+
+        Parameters
+        ----------
+        path : Path
+            The results file
+
+        Raises
+        ------
+        OSError
+            If the file cannot be created.
+        """
+        self.path = Path(path)
+        name = self.path.name.lower()
+        self.compressed = name.endswith('.gz')
+        self.csv = name.removesuffix('.gz').endswith('.csv')
+        if self.compressed:
+            self._file = gzip.open(self.path, 'wt', encoding='utf-8', newline='')
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8', newline='', buffering=1024 * 1024)
+        self.records = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_records, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def worker_path(path: Path, worker_id: int) -> Path:
+        """
+        It returns the results file of a worker process, adding the worker number to the name,
+        e.g. results.jsonl.gz becomes results.w1.jsonl.gz for the worker 1.
+
+        Parameters
+        ----------
+        path : Path
+            The results file specified by the user
+        worker_id : int
+            The number of the worker
+
+        Returns
+        -------
+        Path
+            The results file of the worker
+        """
+        path = Path(path)
+        stem, dot, suffixes = path.name.partition('.')
+        return path.with_name(stem + '.w' + str(worker_id) + dot + suffixes)
+
+    def write(self, *record):
+        """
+        It queues a record, with the values in the order of FIELDS. It never blocks.
+        """
+        self._queue.put(record)
+
+    def _write_records(self):
+        csv_writer = None
+        if self.csv:
+            csv_writer = csv.writer(self._file)
+            csv_writer.writerow(self.FIELDS)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is queued by close to stop the thread
+            records = [record for record in batch if record is not None]
+            for record in records:
+                record = (round(record[0], 6),) + record[1:]
+                if csv_writer is not None:
+                    csv_writer.writerow(record)
+                else:
+                    self._file.write(json.dumps(dict(zip(self.FIELDS, record)), separators=(',', ':')) + '\n')
+            self.records += len(records)
+            if len(records) != len(batch):
+                return
+
+    def close(self):
+        """
+        It writes the records still queued and closes the file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+# End Class
+
+class MetricsExporter:
+    """It serves the counters of the test in the Prometheus text format on http://address:port/metrics,
+        so the test can be followed live on a dashboard.
+        The counters are read from the LoadStats of the connections (or of the workers) at every scrape, without
+        locking them, so scraping never slows down the threads sending the commands.
+
+        Attributes
+        ----------
+        stats_list : list[LoadStats]
+            The counters exported, one instance for each connection or worker.
+        server : ThreadingHTTPServer
+            The HTTP server, running in a daemon thread.
+        """
+    # upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, stats_list: list[LoadStats], port: int, address: str = "127.0.0.1"):
+        """
+        Constructor for the MetricsExporter class. It starts the HTTP server.
+
+        Parameters
+        ----------
+        stats_list : list[LoadStats]
+            The counters to export. The list is read at every scrape, so its elements can be replaced while
+            the test runs
+        port : int
+            The HTTP port
+        address : str, optional
+            The address to listen on. The default is 127.0.0.1
+
+        Raises
+        ------
+        OSError
+            If the port cannot be opened.
+        """
+        self.stats_list = stats_list
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # the scrapes are not printed, they would mix with the output of the test
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _label(value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self) -> str:
+        """
+        It returns all the metrics in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            The metrics
+        """
+        total = LoadStats()
+        for stats in list(self.stats_list):
+            total.merge(stats)
+        lines = ["# HELP payshield_requests_total Commands sent to the payShield, by verb and return code.",
+                 "# TYPE payshield_requests_total counter"]
+        for verb, verb_stats in sorted(total.verbs.items()):
+            for return_code, count in sorted(verb_stats.return_codes.items()):
+                lines.append('payshield_requests_total{verb="%s",code="%s",description="%s"} %d' % (
+                    self._label(verb), self._label(return_code), self._label(payshield_error_codes(return_code)),
+                    count))
+        lines += ["# HELP payshield_requests_in_flight Commands sent and still waiting for the response.",
+                  "# TYPE payshield_requests_in_flight gauge",
+                  "payshield_requests_in_flight %d" % total.in_flight,
+                  "# HELP payshield_connects_total Connections opened to the payShield.",
+                  "# TYPE payshield_connects_total counter",
+                  "payshield_connects_total %d" % total.connects,
+                  "# HELP payshield_reconnects_total Connections opened again after the first time.",
+                  "# TYPE payshield_reconnects_total counter",
+                  "payshield_reconnects_total %d" % total.reconnects,
+                  "# HELP payshield_timeouts_total Responses not received within the read timeout.",
+                  "# TYPE payshield_timeouts_total counter",
+                  "payshield_timeouts_total %d" % total.timeouts,
+                  "# HELP payshield_late_responses_total Responses received after the read timeout.",
+                  "# TYPE payshield_late_responses_total counter",
+                  "payshield_late_responses_total %d" % total.late,
+                  "# HELP payshield_reordered_responses_total Responses received after the one of a later command.",
+                  "# TYPE payshield_reordered_responses_total counter",
+                  "payshield_reordered_responses_total %d" % total.reordered,
+                  "# HELP payshield_resets_total Connections closed or reset by the payShield while in use.",
+                  "# TYPE payshield_resets_total counter",
+                  "payshield_resets_total %d" % total.resets,
+                  "# HELP payshield_connect_errors_total Connections that could not be opened.",
+                  "# TYPE payshield_connect_errors_total counter",
+                  "payshield_connect_errors_total %d" % total.connect_errors,
+                  "# HELP payshield_tls_resumed_total TLS handshakes that resumed the previous session.",
+                  "# TYPE payshield_tls_resumed_total counter",
+                  "payshield_tls_resumed_total %d" % total.resumed,
+                  "# HELP payshield_request_latency_seconds Latency of the commands, by verb.",
+                  "# TYPE payshield_request_latency_seconds histogram"]
+        for verb, verb_stats in sorted(total.verbs.items()):
+            lines += self._histogram("payshield_request_latency_seconds", verb_stats.latency,
+                                     'verb="%s",' % self._label(verb))
+        if total.targets:
+            lines += ["# HELP payshield_target_requests_total Commands sent to each payShield of the cluster, "
+                      "by return code.",
+                      "# TYPE payshield_target_requests_total counter"]
+            for target, target_stats in sorted(total.targets.items()):
+                for return_code, count in sorted(target_stats.return_codes.items()):
+                    lines.append('payshield_target_requests_total{target="%s",code="%s"} %d' % (
+                        self._label(target), self._label(return_code), count))
+            lines += ["# HELP payshield_target_latency_seconds Latency of the commands, by payShield of the cluster.",
+                      "# TYPE payshield_target_latency_seconds histogram"]
+            for target, target_stats in sorted(total.targets.items()):
+                lines += self._histogram("payshield_target_latency_seconds", target_stats.latency,
+                                         'target="%s",' % self._label(target))
+        lines += ["# HELP payshield_connect_seconds Time to open the tcp connections.",
+                  "# TYPE payshield_connect_seconds histogram"]
+        lines += self._histogram("payshield_connect_seconds", total.connect_latency)
+        lines += ["# HELP payshield_tls_handshake_seconds Time of the TLS handshakes.",
+                  "# TYPE payshield_tls_handshake_seconds histogram"]
+        lines += self._histogram("payshield_tls_handshake_seconds", total.handshake_latency)
+        return "\n".join(lines) + "\n"
+
+    def _histogram(self, name: str, histogram: LatencyHistogram, labels: str = "") -> list[str]:
+        """
+        It returns the lines of a histogram in the Prometheus text format.
+
+        Parameters
+        ----------
+        name : str
+            The name of the metric
+        histogram : LatencyHistogram
+            The latency, in microseconds
+        labels : str, optional
+            The labels of the histogram, each one followed by a comma
+
+        Returns
+        -------
+        list[str]
+            The buckets, the sum and the count of the histogram
+        """
+        bounds = [int(bound * 1000000) for bound in self.LATENCY_BUCKETS]
+        lines = []
+        for bound, count in zip(self.LATENCY_BUCKETS, histogram.cumulative_counts(bounds)):
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, count))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, histogram.total))
+        lines.append('%s_sum%s %.6f' % (name, "{%s}" % labels.rstrip(",") if labels else "", histogram.sum / 1000000))
+        lines.append('%s_count%s %d' % (name, "{%s}" % labels.rstrip(",") if labels else "", histogram.total))
+        return lines
+
+    def close(self):
+        """
+        It stops the HTTP server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# End Class
+
+class HsmSample(NamedTuple):
+    """The state of the payShield and of the client in an interval, as measured by HsmSampler."""
+    elapsed: float
+    utilisation: float | None
+    busiest_range: str | None
+    hsm_rates: Dict[str, float]
+    client_rate: float
+    client_p99: int
+    tamper_state: str | None
+
+
+class HsmSampler:
+    """It polls the payShield with J2 (HSM loading), J4 (host command volumes) and JK (health status) every
+        interval seconds, on its own connection, while the test runs.
+        Every sample joins the utilisation and the command volumes reported by the payShield with the throughput and
+        the latency measured by the client in the same interval, to tell if the payShield is saturated or if the
+        limit is elsewhere (client or network).
+
+        Attributes
+        ----------
+        connector : PayConnector
+            The dedicated connection used to poll the payShield.
+        header : str
+            The header of the commands.
+        interval : float
+            The seconds between two samples.
+        stats_list : list[LoadStats]
+            The counters of the client, read at every sample.
+        samples : list[HsmSample]
+            The samples collected so far.
+        """
+    # above this utilisation the payShield is considered saturated
+    SATURATION = 90.0
+    # the sampler sends one of each of these commands per reading, subtracted from the volumes of every interval
+    OWN_COMMANDS = ('J2', 'J4', 'JK')
+
+    def __init__(self, connector: PayConnector, header: str, interval: float, stats_list: list[LoadStats]):
+        """
+        Constructor for the HsmSampler class.
+
+        Parameters
+        ----------
+        connector : PayConnector
+            The dedicated connection used to poll the payShield
+        header : str
+            The header of the commands
+        interval : float
+            The seconds between two samples
+        stats_list : list[LoadStats]
+            The counters of the client
+        """
+        self.connector = connector
+        self.header = header
+        self.interval = interval
+        self.stats_list = stats_list
+        self.samples: list[HsmSample] = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = 0.0
+        self._previous = None
+
+    def _query(self, verb: str, parser: Callable):
+        data = self.connector.send_command(self.header + verb)
+        if data is None:
+            raise ConnectionError("no response to " + verb)
+        response = parser(data, len(self.header))
+        if response.header.error_code != '00':
+            raise ValueError(verb + " returned the error " + response.header.error_code + " " +
+                             payshield_error_codes(response.header.error_code))
+        return response
+
+    def _read(self) -> tuple:
+        """
+        It reads the counters of the payShield and of the client at this moment.
+        """
+        loading = self._query('J2', parse_j2)
+        volumes = self._query('J4', parse_j4)
+        health = self._query('JK', parse_jk)
+        client = LoadStats()
+        for stats in list(self.stats_list):
+            client.merge(stats)
+        return time.perf_counter(), loading, volumes, health, client
+
+    def sample(self) -> HsmSample | None:
+        """
+        It reads the counters and, if a previous reading exists, returns the sample of the interval since then.
+
+        Returns
+        -------
+        HsmSample | None
+            The sample, or None if this is the first reading
+        """
+        current = self._read()
+        previous, self._previous = self._previous, current
+        if previous is None:
+            return None
+        now, loading, volumes, health, client = current
+        before, previous_loading, previous_volumes, _, previous_client = previous
+        seconds = max(now - before, 1e-9)
+        # J2 counts the periods spent in each range of utilisation since its counters were reset
+        previous_periods = {(load_range.start_percentage, load_range.end_percentage): load_range.periods
+                            for load_range in previous_loading.ranges}
+        periods = {}
+        for load_range in loading.ranges:
+            key = (load_range.start_percentage, load_range.end_percentage)
+            periods[key] = load_range.periods - previous_periods.get(key, 0)
+        if any(count < 0 for count in periods.values()):
+            periods = {(load_range.start_percentage, load_range.end_percentage): load_range.periods
+                       for load_range in loading.ranges}
+        total_periods = sum(periods.values())
+        utilisation = busiest_range = None
+        if total_periods > 0:
+            utilisation = sum((start + end) / 2 * count for (start, end), count in periods.items()) / total_periods
+            start, end = max(periods, key=lambda key: periods[key])
+            busiest_range = str(start).zfill(3) + "-" + str(end).zfill(3) + "%"
+        previous_transactions = {volume.command: volume.transactions for volume in previous_volumes.volumes}
+        hsm_rates = {}
+        for volume in volumes.volumes:
+            transactions = volume.transactions - previous_transactions.get(volume.command, 0)
+            if volume.command in HsmSampler.OWN_COMMANDS:
+                transactions = transactions - 1
+            hsm_rates[volume.command] = max(0, transactions) / seconds
+        latency = LatencyHistogram().merge(client.latency).subtract(previous_client.latency)
+        sample = HsmSample(now - self._start_time, utilisation, busiest_range, hsm_rates,
+                           (client.operations - previous_client.operations) / seconds, latency.percentile(99),
+                           health.tamper_state)
+        self.samples.append(sample)
+        return sample
+
+    @staticmethod
+    def format(sample: HsmSample) -> str:
+        """
+        It returns the sample as a line of text.
+
+        Parameters
+        ----------
+        sample : HsmSample
+            The sample to format
+
+        Returns
+        -------
+        str
+            The line of text
+        """
+        if sample.utilisation is None:
+            line = "[HSM {:.0f}s] utilisation: n/a".format(sample.elapsed)
+        else:
+            line = "[HSM {:.0f}s] utilisation: {:.1f}% (mostly {})".format(sample.elapsed, sample.utilisation,
+                                                                        sample.busiest_range)
+        rates = " ".join("{} {:.1f}/s".format(command, rate)
+                         for command, rate in sorted(sample.hsm_rates.items()) if rate > 0)
+        line = line + " | HSM volumes: " + (rates if rates else "none")
+        line = line + " | client: {:.1f} TPS p99={:.3f} ms".format(sample.client_rate, sample.client_p99 / 1000)
+        if sample.utilisation is not None and sample.utilisation >= HsmSampler.SATURATION:
+            line = line + " - the HSM is saturated"
+        if sample.tamper_state == '2':
+            line = line + " - WARNING: the HSM is tampered"
+        return line
+
+    def _run(self):
+        while True:
+            try:
+                sample = self.sample()
+                if sample is not None:
+                    print(self.format(sample))
+            except (ConnectionError, ValueError, IndexError, OSError) as e:
+                print("[HSM] the telemetry sample failed:", e)
+                self._previous = None
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        """
+        It takes the first reading and starts the thread sampling every interval seconds.
+        """
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        It stops the sampling thread and closes the connection.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 10)
+        self.connector.close()
+
+    def print_summary(self):
+        """
+        It prints the utilisation of the payShield during the test, compared with the throughput of the client.
+        """
+        measured = [sample for sample in self.samples if sample.utilisation is not None]
+        if not measured:
+            print("HSM utilisation: not available")
+            return
+        busiest = max(measured, key=lambda sample: sample.utilisation)
+        print("HSM utilisation: average {:.1f}% max {:.1f}% (at {:.0f}s, client {:.1f} TPS p99={:.3f} ms)".format(
+            sum(sample.utilisation for sample in measured) / len(measured), busiest.utilisation, busiest.elapsed,
+            busiest.client_rate, busiest.client_p99 / 1000))
+        if busiest.utilisation < HsmSampler.SATURATION:
+            print(" The HSM never reached {:.0f}% of utilisation: the throughput was limited by the client, "
+                  "the network or the offered load".format(HsmSampler.SATURATION))
+
+
+# End Class
+
+class LoadProfile:
+    """It describes how the target rate changes during the test, as a sequence of stages.
+        Each stage is a ramp: the rate changes linearly from the starting rate to the ending rate during the stage.
+        A stage where the two rates are equal holds the rate constant.
+
+        Attributes
+        ----------
+        stages : list[Tuple[str, float, float, float]]
+            The stages, each one as a tuple of the description, the starting rate, the ending rate and the duration
+            in seconds.
+        """
+
+    def __init__(self, stages: list[Tuple[str, float, float, float]]):
+        """
+        Constructor for the LoadProfile class.
+
+        Parameters
+        ----------
+        stages : list[Tuple[str, float, float, float]]
+            The stages, each one as a tuple of the description, the starting rate, the ending rate and the duration
+            in seconds.
+
+        Raises
+        ------
+        ValueError
+            If there are no stages, or a stage has a rate or a duration that is not positive.
+        """
+        if len(stages) == 0:
+            raise ValueError("the profile needs at least one stage")
+        for description, start_rate, end_rate, duration in stages:
+            if start_rate <= 0 or end_rate <= 0 or duration <= 0:
+                raise ValueError("rates and durations of the stage " + description + " must be positive")
+        self.stages = stages
+
+    @classmethod
+    def parse(cls, spec: str) -> 'LoadProfile':
+        """
+        It creates the profile from its textual description: a comma separated list of stages, where each stage is
+         - ramp:FROM:TO:SECONDS the rate changes linearly from FROM to TO TPS in SECONDS
+         - hold:TPS:SECONDS the rate stays at TPS for SECONDS
+         - step:FROM:TO:INCREMENT:SECONDS the rate goes from FROM to TO TPS in steps of INCREMENT TPS,
+           holding each step for SECONDS
+
+        Example: ramp:100:2000:300,hold:2000:1800,hold:500:600
+
+        Parameters
+        ----------
+        spec : str
+            The textual description of the profile
+
+        Returns
+        -------
+        LoadProfile
+            The profile described
+
+        Raises
+        ------
+        ValueError
+            If the description is not valid.
+        """
+        stages = []
+        for stage_spec in spec.split(','):
+            fields = stage_spec.strip().split(':')
+            try:
+                values = [float(field) for field in fields[1:]]
+            except ValueError:
+                raise ValueError("invalid number in the stage " + stage_spec)
+            kind = fields[0].lower()
+            if kind == 'ramp' and len(values) == 3:
+                stages.append((f"ramp {values[0]:g}->{values[1]:g} TPS", values[0], values[1], values[2]))
+            elif kind == 'hold' and len(values) == 2:
+                stages.append((f"hold {values[0]:g} TPS", values[0], values[0], values[1]))
+            elif kind == 'step' and len(values) == 4:
+                start_rate, end_rate, increment, duration = values
+                if increment <= 0:
+                    raise ValueError("the increment of the stage " + stage_spec + " must be positive")
+                direction = 1 if end_rate >= start_rate else -1
+                step_rate = start_rate
+                while (step_rate - end_rate) * direction < 1e-9:
+                    stages.append((f"step {step_rate:g} TPS", step_rate, step_rate, duration))
+                    step_rate = step_rate + increment * direction
+            else:
+                raise ValueError("invalid stage " + stage_spec +
+                                 ", expected ramp:FROM:TO:SECONDS, hold:TPS:SECONDS or step:FROM:TO:INCREMENT:SECONDS")
+        return cls(stages)
+
+    @property
+    def duration(self) -> float:
+        """
+        The total duration of the profile in seconds.
+        """
+        return sum(stage[3] for stage in self.stages)
+
+    def stage_at(self, elapsed: float, repeat: bool = False) -> int | None:
+        """
+        It returns the index of the stage running at the time specified.
+
+        Parameters
+        ----------
+        elapsed : float
+            The seconds elapsed since the start of the profile
+        repeat : bool
+            If True, the profile restarts when it ends, and the index keeps increasing across the repetitions
+
+        Returns
+        -------
+        int | None
+            The index of the stage, or None if the profile has ended
+        """
+        cycle = 0
+        if repeat:
+            cycle = int(elapsed // self.duration)
+            elapsed = elapsed - cycle * self.duration
+        for index, stage in enumerate(self.stages):
+            if elapsed < stage[3]:
+                return cycle * len(self.stages) + index
+            elapsed = elapsed - stage[3]
+        return None
+
+    def rate_at(self, elapsed: float, repeat: bool = False) -> float | None:
+        """
+        It returns the target rate at the time specified.
+
+        Parameters
+        ----------
+        elapsed : float
+            The seconds elapsed since the start of the profile
+        repeat : bool
+            If True, the profile restarts when it ends
+
+        Returns
+        -------
+        float | None
+            The rate in TPS, or None if the profile has ended
+        """
+        if repeat:
+            elapsed = elapsed % self.duration
+        for description, start_rate, end_rate, duration in self.stages:
+            if elapsed < duration:
+                return start_rate + (end_rate - start_rate) * elapsed / duration
+            elapsed = elapsed - duration
+        return None
+
+    def describe(self, stage_index: int) -> str:
+        """
+        It returns the description of the stage with the index specified, as returned by stage_at.
+        """
+        cycle, index = divmod(stage_index, len(self.stages))
+        description = f"Stage {index + 1} ({self.stages[index][0]}, {self.stages[index][3]:g}s)"
+        if cycle > 0:
+            description = f"Cycle {cycle + 1} " + description
+        return description
+
+
+# End Class
+
+class CommandMix:
+    """It represents a mix of host commands, each one sent with its own weight.
+        The commands are built and framed once when the mix is created and reused for every request.
+
+        Attributes
+        ----------
+        commands : list[str]
+            The host commands, complete of the header part.
+        frames : list[bytes]
+            The host commands framed with the two bytes of the length, as returned by build_frame.
+        decoders : list[FunctionType | None]
+            For each command, the function used to decode the response, or None.
+        weights : list[float]
+            For each command, its weight in the mix.
+        """
+
+    def __init__(self, commands: list[str], weights: list[float], decoders: list | None = None):
+        """
+        Constructor for the CommandMix class.
+
+        Parameters
+        ----------
+        commands : list[str]
+            The host commands, complete of the header part.
+        weights : list[float]
+            For each command, its weight in the mix.
+        decoders : list, optional
+            For each command, the function used to decode the response, or None.
+
+        Raises
+        ------
+        ValueError
+            If there are no commands, the weights are not positive, or a command is too long to be framed.
+        """
+        if len(commands) == 0 or len(commands) != len(weights):
+            raise ValueError("the scenario needs at least one command, each one with its weight")
+        if any(weight <= 0 for weight in weights):
+            raise ValueError("the weights of the commands must be positive")
+        if any(len(command) > 0x7FFF for command in commands):
+            raise ValueError("the commands cannot be longer than 32767 characters")
+        self.commands = commands
+        self.frames = [build_frame(command) for command in commands]
+        self.weights = weights
+        self.decoders = decoders if decoders is not None else [None] * len(commands)
+        self._cum_weights = []
+        total = 0.0
+        for weight in weights:
+            total = total + weight
+            self._cum_weights.append(total)
+
+    @classmethod
+    def load(cls, scenario_file: Path, header: str, decoders: Dict[str, Callable] | None = None) -> 'CommandMix':
+        """
+        It creates the mix from a scenario file in JSON, or in YAML if the PyYAML package is installed.
+        The file contains the list of the commands, each one with the host command without the header and its weight,
+        either at the top level or under the key "commands", e.g.:
+
+        {"commands": [{"command": "JA1234567890128;05", "weight": 70},
+                      {"command": "N0008", "weight": 20},
+                      {"command": "NC", "weight": 10}]}
+
+        Parameters
+        ----------
+        scenario_file : Path
+            The path of the scenario file
+        header : str
+            The header to prepend to each command
+        decoders : Dict[str, Callable], optional
+            The decoder functions indexed by command verb. If provided, each command gets the decoder of its verb
+
+        Returns
+        -------
+        CommandMix
+            The mix described by the file
+
+        Raises
+        ------
+        ValueError
+            If the file is not a valid scenario.
+        OSError
+            If the file cannot be read.
+        """
+        with open(scenario_file, "r") as f:
+            if Path(scenario_file).suffix.lower() in ('.yaml', '.yml'):
+                if yaml is None:
+                    raise ValueError("the PyYAML package is required to read YAML scenario files")
+                scenario = yaml.safe_load(f)
+            else:
+                try:
+                    scenario = json.load(f)
+                except json.JSONDecodeError as e:
+                    raise ValueError("invalid JSON: " + str(e))
+        if isinstance(scenario, dict):
+            scenario = scenario.get("commands")
+        if not isinstance(scenario, list):
+            raise ValueError("the scenario must contain a list of commands")
+        commands = []
+        weights = []
+        command_decoders = []
+        for entry in scenario:
+            if not isinstance(entry, dict) or not isinstance(entry.get("command"), str) or len(entry["command"]) < 2:
+                raise ValueError("each command of the scenario needs the \"command\" string, e.g. NC")
+            try:
+                weights.append(float(entry.get("weight", 1)))
+            except (TypeError, ValueError):
+                raise ValueError("invalid weight for the command " + entry["command"])
+            commands.append(header + entry["command"])
+            command_decoders.append(None if decoders is None else decoders.get(entry["command"][:2]))
+        return cls(commands, weights, command_decoders)
+
+    def _index(self) -> int:
+        index = bisect.bisect_right(self._cum_weights, random.random() * self._cum_weights[-1])
+        if index >= len(self.commands):
+            index = len(self.commands) - 1
+        return index
+
+    def pick(self) -> Tuple[str, Any]:
+        """
+        It picks one of the commands at random, according to the weights.
+
+        Returns
+        -------
+        Tuple[str, FunctionType | None]
+            The host command and the function to decode its response
+        """
+        index = self._index()
+        return self.commands[index], self.decoders[index]
+
+    def pick_frame(self) -> Tuple[str, bytes, Any]:
+        """
+        It picks one of the commands in the same way as pick, together with its framed message.
+
+        Returns
+        -------
+        Tuple[str, bytes, FunctionType | None]
+            The host command, the framed message and the function to decode its response
+        """
+        index = self._index()
+        return self.commands[index], self.frames[index], self.decoders[index]
+
+
+# End Class
+
+class CommandRing(CommandMix):
+    """It is a ring of commands generated before the test, e.g. with a different PAN in each one, sent in turn.
+        The commands are generated and framed when the ring is created, so the test does not spend any time on them,
+        and the ring is long enough to avoid the patterns a payShield could cache.
+        """
+
+    def __init__(self, commands: list[str], decoders: list | None = None):
+        """
+        Constructor for the CommandRing class.
+
+        Parameters
+        ----------
+        commands : list[str]
+            The host commands, complete of the header part, in the order they are sent.
+        decoders : list, optional
+            For each command, the function used to decode the response, or None.
+
+        Raises
+        ------
+        ValueError
+            If there are no commands, or a command is too long to be framed.
+        """
+        super().__init__(commands, [1.0] * len(commands), decoders)
+        self._position = 0
+
+    @classmethod
+    def generate(cls, generator: Callable[[random.Random, int], str], header: str, size: int,
+                 decoder: Callable | None = None, seed: int | None = None) -> 'CommandRing':
+        """
+        It creates the ring with the commands returned by the generator.
+
+        Parameters
+        ----------
+        generator : Callable[[random.Random, int], str]
+            The function returning the command without the header, given the random generator and the position of
+            the command in the ring. See GENERATORS
+        header : str
+            The header to prepend to each command
+        size : int
+            How many commands the ring holds
+        decoder : Callable, optional
+            The function used to decode the responses, or None
+        seed : int, optional
+            The seed of the random generator, to generate the same commands in every run
+
+        Returns
+        -------
+        CommandRing
+            The ring of commands
+        """
+        rng = random.Random(seed)
+        return cls([header + generator(rng, index) for index in range(size)], [decoder] * size)
+
+    def start_at(self, worker_id: int, workers: int):
+        """
+        It moves the start of the ring to the share of the worker specified, so that the workers and the agents
+        sending the same ring do not send the same commands in lockstep.
+
+        Parameters
+        ----------
+        worker_id : int
+            The index of the worker, starting from 0
+        workers : int
+            How many workers send the ring
+        """
+        self._position = worker_id * len(self.commands) // workers
+
+    def _index(self) -> int:
+        # the position is shared by the threads without a lock: a command sent twice or skipped is harmless
+        index = self._position % len(self.commands)
+        self._position = index + 1
+        return index
+
+
+# End Class
+
+class ResponseHeader(NamedTuple):
+    """The fields at the start of every response of the payShield."""
+    length: int
+    header: str
+    command: str
+    error_code: str
+
+
+class N0Response(NamedTuple):
+    """The response of the command N0, Generate a random value."""
+    header: ResponseHeader
+    random_value: bytes | None = None
+
+
+class NoResponse(NamedTuple):
+    """The response of the command NO, HSM status. Mode 00 fills the status fields, mode 01 only pci_compliance."""
+    header: ResponseHeader
+    buffer_size: str | None = None
+    connection_type: str | None = None
+    tcp_sockets: str | None = None
+    firmware: str | None = None
+    reserved_1: str | None = None
+    reserved_2: str | None = None
+    pci_compliance: str | None = None
+
+
+class NiConnection(NamedTuple):
+    """A connection of the Ethernet host port listed in the response of the command NI."""
+    protocol: str
+    local_port: str
+    ip_address: str
+    remote_port: str
+    status: str
+    duration: str
+
+
+class NiResponse(NamedTuple):
+    """The response of the command NI, Ethernet host port statistics."""
+    header: ResponseHeader
+    connections: list[NiConnection] | None = None
+    bytes_sent: int | None = None
+    bytes_received: int | None = None
+    unicast_packets_sent: int | None = None
+    unicast_packets_received: int | None = None
+    non_unicast_packets_sent: int | None = None
+    non_unicast_packets_received: int | None = None
+    packets_discarded_send: int | None = None
+    packets_discarded_receive: int | None = None
+    errors_send: int | None = None
+    errors_receive: int | None = None
+    unknown_packets: int | None = None
+
+
+class NcResponse(NamedTuple):
+    """The response of the command NC, Perform diagnostics."""
+    header: ResponseHeader
+    lmk_crc: str | None = None
+    firmware: str | None = None
+
+
+class JaResponse(NamedTuple):
+    """The response of the command JA, Generate a random PIN."""
+    header: ResponseHeader
+    pin: str | None = None
+
+
+class J8Response(NamedTuple):
+    """The response of the command J8, Health check accumulated counts."""
+    header: ResponseHeader
+    serial_number: str | None = None
+    start_date: str | None = None
+    start_time: str | None = None
+    end_date: str | None = None
+    end_time: str | None = None
+    current_date: str | None = None
+    current_time: str | None = None
+    reboots: int | None = None
+    tampers: int | None = None
+    pin_verifies_minute: int | None = None
+    pin_verifies_hour: int | None = None
+    pin_attacks: int | None = None
+
+
+class B2Response(NamedTuple):
+    """The response of the command B2, Echo."""
+    header: ResponseHeader
+    payload: bytes | None = None
+
+
+class LoadRange(NamedTuple):
+    """A range of utilisation in the response of the command J2, with how many periods the HSM was in it."""
+    start_percentage: int
+    end_percentage: int
+    periods: int
+    delimiter: str
+
+
+class J2Response(NamedTuple):
+    """The response of the command J2, HSM loading."""
+    header: ResponseHeader
+    serial_number: str | None = None
+    start_date: str | None = None
+    start_time: str | None = None
+    end_date: str | None = None
+    end_time: str | None = None
+    current_date: str | None = None
+    current_time: str | None = None
+    seconds: int | None = None
+    ranges: list[LoadRange] | None = None
+
+
+class CommandVolume(NamedTuple):
+    """The number of transactions of a command in the response of the command J4."""
+    command: str
+    transactions: int
+
+
+class J4Response(NamedTuple):
+    """The response of the command J4, Host command volumes."""
+    header: ResponseHeader
+    serial_number: str | None = None
+    start_date: str | None = None
+    start_time: str | None = None
+    end_date: str | None = None
+    end_time: str | None = None
+    current_date: str | None = None
+    current_time: str | None = None
+    seconds: int | None = None
+    volumes: list[CommandVolume] | None = None
+
+
+class LmkStatus(NamedTuple):
+    """An LMK listed in the response of the command JK."""
+    lmk_id: str
+    authorised: str
+    authorised_activities: str
+    scheme: str
+    algorithm: str
+    status: str
+    comments: str
+
+
+class JkResponse(NamedTuple):
+    """The response of the command JK, Instantaneous health check status. The tamper fields are only
+    present if the HSM is tampered."""
+    header: ResponseHeader
+    serial_number: str | None = None
+    system_date: str | None = None
+    system_time: str | None = None
+    console_state: str | None = None
+    manager_state: str | None = None
+    host_1_state: str | None = None
+    host_2_state: str | None = None
+    reserved_1: str | None = None
+    reserved_2: str | None = None
+    tamper_state: str | None = None
+    tamper_cause: str | None = None
+    tamper_date: str | None = None
+    tamper_time: str | None = None
+    lmks_loaded: str | None = None
+    test_lmks: str | None = None
+    old_lmks: str | None = None
+    lmks: list[LmkStatus] | None = None
+    fraud_detection_exceeded: str | None = None
+    pin_attacks_exceeded: str | None = None
+
+
+class EccResponse(NamedTuple):
+    """The response of the command FY, Generate an ECC key pair."""
+    header: ResponseHeader
+    public_key: bytes | None = None
+    separator: str | None = None
+    private_key: bytes | None = None
+
+
+# End Class
+
+class _ResponseReader:
+    """It reads the fields of a response one after the other, from a memoryview, without converting the whole
+        response to str.
+
+        Attributes
+        ----------
+        view : memoryview
+            The response, including the two bytes of the length.
+        pointer : int
+            The position of the next field to read.
+        """
+    __slots__ = ('view', 'pointer')
+
+    def __init__(self, response: bytes, pointer: int = 0):
+        self.view = memoryview(response)
+        self.pointer = pointer
+
+    def raw(self, length: int | None = None) -> bytes:
+        """It returns the next field as bytes. If the length is None, the field lasts until the end."""
+        end = len(self.view) if length is None else self.pointer + length
+        field = bytes(self.view[self.pointer:end])
+        self.pointer = min(end, len(self.view))
+        return field
+
+    def text(self, length: int | None = None) -> str:
+        """It returns the next field as str."""
+        end = len(self.view) if length is None else self.pointer + length
+        field = str(self.view[self.pointer:end], 'ascii', 'replace')
+        self.pointer = min(end, len(self.view))
+        return field
+
+    def number(self, length: int, base: int = 10) -> int:
+        """It returns the next field as int. It raises ValueError if the field is not a number."""
+        return int(self.raw(length), base)
+
+
+# End Class
+
+def parse_header(response_to_decode: bytes, head_len: int) -> Tuple[ResponseHeader, _ResponseReader]:
+    """
+        It parses the fields common to all the responses: the message length, the header, the command returned
+        and the error code.
+
+        Parameters
+        ----------
+        response_to_decode : bytes
+            The response returned by the payShield
+        head_len : int
+            The length of the header
+
+        Returns
+        -------
+        result : tuple
+            The parsed ResponseHeader and the reader positioned after the error code
+    """
+    reader = _ResponseReader(response_to_decode, 2)
+    length = int.from_bytes(response_to_decode[:2], byteorder='big', signed=False)
+    header = ResponseHeader(length, reader.text(head_len), reader.text(2), reader.text(2))
+    return header, reader
+
+
+def print_header(header: ResponseHeader):
+    """
+        It prints the fields common to all the responses.
+
+        Parameters
+        ----------
+        header : ResponseHeader
+            The fields parsed by parse_header
+    """
+    print("Message length: ", header.length)
+    print("Header: ", header.header)
+    print("Command returned: ", header.command)
+    print("Error returned: ", header.error_code)
+
+
+def decode_response(parse_funct: Callable, print_funct: Callable, response_to_decode: bytes, head_len: int) -> bool:
+    """
+        It parses the response with the parse function and prints it with the print function.
+        If the response is malformed, e.g. truncated or with a field that is not a number, the header and the rest
+        of the response are printed as they are.
+
+        Parameters
+        ----------
+        parse_funct : Callable
+            The parse_ function of the command, e.g. parse_j2
+        print_funct : Callable
+            The print_ function of the command, e.g. print_j2
+        response_to_decode : bytes
+            The response returned by the payShield
+        head_len : int
+            The length of the header
+
+        Returns
+        -------
+        result : bool
+            True if the response was decoded, False if it is malformed
+    """
+    try:
+        response = parse_funct(response_to_decode, head_len)
+    except (ValueError, IndexError) as e:
+        header, reader = parse_header(response_to_decode, head_len)
+        print_header(header)
+        print("The response is malformed (" + str(e) + "), the rest of it is: ", reader.text())
+        return False
+    print_funct(response)
+    return True
+
+
+def parse_n0(response_to_decode: bytes, head_len: int) -> N0Response:
+    """
+    It parses the result of the command N0
+
+    Parameters
+    ----------
+    response_to_decode : bytes
+        The response returned by the payShield
+    head_len : int
+        The length of the header
+
+    Returns
+    ----------
+    N0Response
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return N0Response(header)
+    return N0Response(header, reader.raw())
+
+
+def print_n0(response: N0Response):
+    """
+    It prints the meaning of the result of the command N0
+
+    Parameters
+    ----------
+    response : N0Response
+        The response parsed by parse_n0
+    """
+    print_header(response.header)
+    if response.header.error_code == '01':
+        print("Invalid Random Value Length")
+    elif response.header.error_code == '00':
+        print("Random payload:(HEX)", bytes.hex(response.random_value))
+
+
+def decode_n0(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command N0 and prints the meaning of the returned output
+
+    Parameters
+    ----------
+    response_to_decode : bytes
+        The response returned by the payShield
+
+    head_len : int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_n0, print_n0, response_to_decode, head_len)
+
+
+def parse_no(response_to_decode: bytes, head_len: int) -> NoResponse:
+    """
+    It parses the result of the command NO, in mode 00 or 01 depending on the length of the response
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    NoResponse
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return NoResponse(header)
+    if len(response_to_decode) < (24 + head_len):  # Mode 01
+        return NoResponse(header, pci_compliance=reader.text(1))
+    # I obtained the value 24 in this way: 2 for the response len, 2 for the error code and the rest is for the
+    # sum of the field len as indicated by the Core Host Command Manual
+    if len(response_to_decode) > (24 + head_len):  # FW 1.8a or more
+        socket_field_len = 4  # From FW 1.8a the Number of TCP sockets is 4 character long instead of 2
+    else:
+        socket_field_len = 2
+    return NoResponse(header, reader.text(1), reader.text(1), reader.text(socket_field_len), reader.text(9),
+                      reader.text(1), reader.text(4))
+
+
+def print_no(response: NoResponse):
+    """
+    It prints the meaning of the result of the command NO
+
+    Parameters
+    ----------
+    response : NoResponse
+        The response parsed by parse_no
+    """
+    BUFFER_SIZE: Dict[str, str] = {
+        '0': '2K bytes', '1': '8K bytes', '2': '16K bytes', '3': '32K bytes'}
+    NET_PROTO: Dict[str, str] = {'0': 'UDP', '1': 'TCP'}
+    print_header(response.header)
+    if response.header.error_code != '00':
+        return
+    if response.pci_compliance is None:  # Mode 00
+        print("I/O buffer size: ", BUFFER_SIZE.get(response.buffer_size, "Unknown"))
+        print("Type of connection: ", NET_PROTO.get(response.connection_type, "Unknown"))
+        print("Number of TCP sockets: ", response.tcp_sockets)
+        print("Firmware number: ", response.firmware)
+        print("Reserved: ", response.reserved_1)
+        print("Reserved: ", response.reserved_2)
+    elif response.pci_compliance == '0':
+        print(
+            "Some of the security settings relevant to PCI HSM compliance have non-compliant values.\n"
+            "\"The Enforce key type 002 separation for PCI HSM compliance\" setting is one of these.")
+    elif response.pci_compliance == '1':
+        print("All security settings relevant to PCI HSM compliance have compliant values.")
+    elif response.pci_compliance == '2':
+        print(
+            "Some of the security settings relevant to PCI HSM compliance have non-compliant values.\n"
+            "\"The Enforce key type 002 separation for PCI HSM compliance\" setting is not one of these.")
+
+
+def decode_no(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command NO and prints the meaning of the returned output
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_no, print_no, response_to_decode, head_len)
+
+
+def parse_ni(response_to_decode: bytes, head_len: int) -> NiResponse:
+    """
+    It parses the result of the command NI
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    NiResponse
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return NiResponse(header)
+    connections = []
+    for record in range(reader.number(4)):
+        connections.append(NiConnection(reader.text(1), reader.text(4), hex2ip(reader.text(8)), reader.text(4),
+                                        reader.text(1), reader.text(8)))
+    return NiResponse(header, connections, reader.number(16, 16), reader.number(16, 16),
+                      *[reader.number(8, 16) for _ in range(9)])
+
+
+def print_ni(response: NiResponse):
+    """
+    It prints the meaning of the result of the command NI
+
+    Parameters
+    ----------
+    response : NiResponse
+        The response parsed by parse_ni
+    """
+    NET_PROTO: Dict[str, str] = {'0': 'TCP', '1': 'UDP'}
+    SPECIFIC_ERROR: Dict[str, str] = {'01': 'Failed to execute NETSTAT',
+                                      '82': 'Invalid Ethernet Statistics value'}
+    NET_CONNECTION_STATUS: Dict[str, str] = {'0': 'ESTABLISHED', '1': 'CLOSED'}
+    print_header(response.header)
+    if response.header.error_code == '00':  # No errors
+        print("Records to follow: ", str(len(response.connections)).zfill(4))
+        for connection in response.connections:
+            print("Protocol: ", NET_PROTO.get(connection.protocol, "Unknown"))
+            print("Local port number: ", connection.local_port)
+            print("IP Address: ", connection.ip_address)
+            print("Remote port number: ", connection.remote_port)
+            print("Connection Status: ", NET_CONNECTION_STATUS.get(connection.status, 'Reserved'))
+            print("Duration: ", connection.duration)
+        print("Total Bytes Sent: ", response.bytes_sent)
+        print("Total Bytes Received: ", response.bytes_received)
+        print("Total Unicast Packets Sent: ", response.unicast_packets_sent)
+        print("Total Unicast Packets Received: ", response.unicast_packets_received)
+        print("Total Non-unicast packets Sent: ", response.non_unicast_packets_sent)
+        print("Total Non-unicast packets Received: ", response.non_unicast_packets_received)
+        print("Total Packets Discarded During Send: ", response.packets_discarded_send)
+        print("Total Packets Discarded During Receive: ", response.packets_discarded_receive)
+        print("Total Errors During Send: ", response.errors_send)
+        print("Total Errors During Receive: ", response.errors_receive)
+        print("Total Unknown Packets: ", response.unknown_packets)
+
+    else:
+        if SPECIFIC_ERROR.get(response.header.error_code) is not None:
+            print("Command specific error: ", SPECIFIC_ERROR.get(response.header.error_code))
+
+
+def decode_ni(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command NI and prints the meaning of the returned output
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_ni, print_ni, response_to_decode, head_len)
+
+
+def parse_nc(response_to_decode: bytes, head_len: int) -> NcResponse:
+    """
+    It parses the result of the command NC
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    NcResponse
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return NcResponse(header)
+    return NcResponse(header, reader.text(16), reader.text(9))
+
+
+def print_nc(response: NcResponse):
+    """
+    It prints the meaning of the result of the command NC
+
+    Parameters
+    ----------
+    response : NcResponse
+        The response parsed by parse_nc
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("LMK CRC:", response.lmk_crc)
+        print("Firmware number:", response.firmware)
+
+
+def decode_nc(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command NC and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_nc, print_nc, response_to_decode, head_len)
+
+
+def parse_ja(response_to_decode: bytes, head_len: int) -> JaResponse:
+    """
+    It parses the result of the command JA
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    JaResponse
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return JaResponse(header)
+    return JaResponse(header, reader.text(33))
+
+
+def print_ja(response: JaResponse):
+    """
+    It prints the meaning of the result of the command JA
+
+    Parameters
+    ----------
+    response : JaResponse
+        The response parsed by parse_ja
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("Pin under the LMK:", response.pin)
+
+
+def decode_ja(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command JA and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_ja, print_ja, response_to_decode, head_len)
+
+
+def parse_j8(response_to_decode: bytes, head_len: int) -> J8Response:
+    """
+    It parses the result of the command J8
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    J8Response
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return J8Response(header)
+    return J8Response(header, reader.text(12), *[reader.text(6) for _ in range(6)], reader.number(10),
+                      reader.number(10), reader.number(7), reader.number(5), reader.number(8))
+
+
+def print_j8(response: J8Response):
+    """
+    It prints the meaning of the result of the command J8
+
+    Parameters
+    ----------
+    response : J8Response
+        The response parsed by parse_j8
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("Serial Number: ", response.serial_number)
+        print("Start Date: ", response.start_date)
+        print("Start Time: ", response.start_time)
+        print("End Date: ", response.end_date)
+        print("End Time: ", response.end_time)
+        print("Current Date: ", response.current_date)
+        print("Current Time: ", response.current_time)
+        print("Reboots: ", str(response.reboots).zfill(10))
+        print("Tampers: ", str(response.tampers).zfill(10))
+        print("Pin verifies/minute: ", str(response.pin_verifies_minute).zfill(7))
+        print("Pin verifies/hour: ", str(response.pin_verifies_hour).zfill(5))
+        print("Pin attacks: ", str(response.pin_attacks).zfill(8))
+
+
+def decode_j8(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command J8 and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ----------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_j8, print_j8, response_to_decode, head_len)
+
+
+def parse_b2(response_to_decode: bytes, head_len: int) -> B2Response:
+    """
+    It parses the result of the command B2
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    B2Response
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':  # no errors
+        return B2Response(header)
+    return B2Response(header, reader.raw())
+
+
+def print_b2(response: B2Response):
+    """
+    It prints the meaning of the result of the command B2
+
+    Parameters
+    ___________
+    response : B2Response
+        The response parsed by parse_b2
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':  # no errors
+        print("Payload echoed: ", response.payload.decode('ascii', 'replace'))
+
+
+def decode_b2(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command B2 and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_b2, print_b2, response_to_decode, head_len)
+
+
+def parse_j2(response_to_decode: bytes, head_len: int) -> J2Response:
+    """
+    It parses the result of the command J2
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    J2Response
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return J2Response(header)
+    fields = [reader.text(12)] + [reader.text(6) for _ in range(6)] + [reader.number(10)]
+    ranges = []
+    while (reader.pointer + 15) <= header.length:
+        ranges.append(LoadRange(reader.number(3), reader.number(3), reader.number(10), reader.text(1)))
+    return J2Response(header, *fields, ranges)
+
+
+def print_j2(response: J2Response):
+    """
+    It prints the meaning of the result of the command J2
+
+    Parameters
+    ___________
+    response : J2Response
+        The response parsed by parse_j2
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("Serial Number: ", response.serial_number)
+        print("Start Date: ", response.start_date)
+        print("Start Time: ", response.start_time)
+        print("End Date: ", response.end_date)
+        print("End Time: ", response.end_time)
+        print("Current Date: ", response.current_date)
+        print("Current Time: ", response.current_time)
+        print("Seconds: ", str(response.seconds).zfill(10))
+
+        for load_range in response.ranges:
+            print("Starting percentage: ", str(load_range.start_percentage).zfill(3))
+            print("Ending percentage: ", str(load_range.end_percentage).zfill(3))
+            print("Number Times Periods: ", str(load_range.periods).zfill(10))
+            print("Delimiter: ", load_range.delimiter)
+        print("")
+
+
+def decode_j2(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command J2 and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_j2, print_j2, response_to_decode, head_len)
+
+
+def parse_j4(response_to_decode: bytes, head_len: int) -> J4Response:
+    """
+    It parses the result of the command J4
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    J4Response
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return J4Response(header)
+    fields = [reader.text(12)] + [reader.text(6) for _ in range(6)] + [reader.number(10)]
+    volumes = []
+    while (reader.pointer + 12) <= header.length:
+        volumes.append(CommandVolume(reader.text(2), reader.number(12)))
+    return J4Response(header, *fields, volumes)
+
+
+def print_j4(response: J4Response):
+    """
+    It prints the meaning of the result of the command J4
+
+    Parameters
+    ___________
+    response : J4Response
+        The response parsed by parse_j4
+    """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("Serial Number: ", response.serial_number)
+        print("Start Date: ", response.start_date)
+        print("Start Time: ", response.start_time)
+        print("End Date: ", response.end_date)
+        print("End Time: ", response.end_time)
+        print("Current Date: ", response.current_date)
+        print("Current Time: ", response.current_time)
+        print("Seconds: ", str(response.seconds).zfill(10))
+
+        for volume in response.volumes:
+            print("Command Code: ", volume.command)
+            print("Transactions: ", str(volume.transactions).zfill(12))
+
+
+def decode_j4(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command J4 and prints the meaning of the returned output
+    The message trailer is not considered
+
+    Parameters
+    ___________
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    ___________
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_j4, print_j4, response_to_decode, head_len)
+
+
+def parse_jk(response_to_decode: bytes, head_len: int) -> JkResponse:
+    """
+    It parses the result of the command JK
+    The message trailer is not considered
+
+    Parameters
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    -------
+    JkResponse
+        The parsed response. The fields other than the header are None if the command failed
+    """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return JkResponse(header)
+    fields = [reader.text(12), reader.text(6), reader.text(6)] + [reader.text(1) for _ in range(7)]
+    tamper_state = fields[-1]
+    if tamper_state == '2':
+        fields = fields + [reader.text(2), reader.text(6), reader.text(6)]
+    else:
+        fields = fields + [None, None, None]
+    lmk_loaded = reader.text(2)
+    fields = fields + [lmk_loaded, reader.text(2), reader.text(2)]
+    try:
+        lmks_loaded_num = int(lmk_loaded)
+    except ValueError:
+        lmks_loaded_num = -1
+    remaining_to_decode = reader.raw()
+    lmks = []
+    if lmks_loaded_num > 0:
+        lmks_string = remaining_to_decode.split(b'\x15')[0]
+        for lmk in lmks_string.split(b'\x14'):
+            if len(lmk) > 0:
+                lmk_reader = _ResponseReader(lmk)
+                lmks.append(LmkStatus(lmk_reader.text(2), lmk_reader.text(1), lmk_reader.text(2),
+                                      lmk_reader.text(1), lmk_reader.text(1), lmk_reader.text(1),
+                                      lmk_reader.text()))
+    fraud_detection = remaining_to_decode.split(b'\x15')[1].decode('ascii', 'replace')
+    return JkResponse(header, *fields, lmks, fraud_detection[0], fraud_detection[1])
+
+
+def print_jk(response: JkResponse):
+    """
+    It prints the meaning of the result of the command JK
+
+    Parameters
+    ----------
+    response : JkResponse
+        The response parsed by parse_jk
+    """
+    # structures to decode the result
+    # We can use CONSOLE_STATUS_CODE to check the status of the payShield Manager as well.
+
+    CONSOLE_STATUS_CODE: dict[str, str] = {
+        '0': 'unknown',
+        '1': 'running',
+        '2': 'not running',
+        '3': 'console disabled by GUI'}
+
+    TAMPER_STATUS_CODE: dict[str, str] = {
+        '0': 'Unknown',
+        '1': 'Not Tampered',
+        '2': 'Tampered'}
+
+    HOST_STATUS_CODE: dict[str, str] = {
+        '0': 'unknown',
+        '1': 'running',
+        '2': 'not running',
+        '3': 'not configured'
+    }
+
+    TAMPER_CAUSE_CODE: dict[str, str] = {
+        '00': 'unknown',
+        '01': 'temp out of range',
+        '02': 'battery low',
+        '03': 'erase button pressed',
+        '04': 'security processor watchdog',
+        '05': 'power too high',
+        '06': 'security processor restart',
+        '07': 'motion detected',
+        '08': 'case tampered',
+        '09': 'TSPP Module',
+        '10': 'General'
+    }
+    LMK_ALGORITHM_CODE: dict[str, str] = {
+        '0': '3DES2Key',
+        '1': '3DES3Key',
+        '2': 'AES 256-bit'
+    }
+    LMK_SCHEME_CODE: dict[str, str] = {
+        'V': 'Variant',
+        'K': 'Keyblock'
+    }
+    LMK_STATUS_CODE: dict[str, str] = {
+        'L': 'Live',
+        'T': 'Test'
+    }
+    LMK_AUTH_CODE: dict[str, str] = {
+        '0': 'Not authorized',
+        '1': 'Authorized'
+    }
+    FRAUD_CODE: dict[str, str] = {
+
+        '0': 'not exceeded (or not enabled)',
+        '1': 'exceeded'
+    }
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("Serial Number: ", response.serial_number)
+        print("System Date: ", response.system_date)
+        print("System Time: ", response.system_time)
+        print("Console State: ", CONSOLE_STATUS_CODE.get(response.console_state, '?'))
+        print("payShield Manager State: ", CONSOLE_STATUS_CODE.get(response.manager_state, '?'))
+        print("HOST 1 State: ", HOST_STATUS_CODE.get(response.host_1_state, '?'))
+        print("HOST 2 State: ", HOST_STATUS_CODE.get(response.host_2_state, '?'))
+        print("Reserved: ", response.reserved_1)
+        print("Reserved: ", response.reserved_2)
+        print("Tamper State: ", TAMPER_STATUS_CODE.get(response.tamper_state, '?'))
+        if response.tamper_state == '2':
+            print("Tamper Cause: ", TAMPER_CAUSE_CODE.get(response.tamper_cause, '?'))
+            print("Tamper Date: ", response.tamper_date)
+            print("Tamper Time: ", response.tamper_time)
+        print("Number of LMK Loaded: ", response.lmks_loaded)
+        print("Number of Test LMK: ", response.test_lmks)
+        print("Number of Old LMK: ", response.old_lmks)
+        print("There are ", response.lmks_loaded, " LMK(s) loaded")
+        for lmk in response.lmks:
+            print("LMK ID: ", lmk.lmk_id)
+            print("Authorised: ", LMK_AUTH_CODE.get(lmk.authorised, '?'))
+            print("Num Authorised Activities: ", lmk.authorised_activities)
+            print("LMK Scheme: ", LMK_SCHEME_CODE.get(lmk.scheme, '?'))
+            print("Algorithm: ", LMK_ALGORITHM_CODE.get(lmk.algorithm, '?'))
+            print("Status: ", LMK_STATUS_CODE.get(lmk.status, '?'))
+            print("Comments: ", lmk.comments)
+            print("")
+        print("Fraud detection Exceeded: ", FRAUD_CODE.get(response.fraud_detection_exceeded, '?'))
+        print("PIN attacks exceeded: ", FRAUD_CODE.get(response.pin_attacks_exceeded, '?'))
+        print("")
+
+
+def decode_jk(response_to_decode: bytes, head_len: int) -> bool:
+    """
+    It decodes the result of the command JK and prints the meaning of the returned output
     The message trailer is not considered
 
     Parameters
-    ___________
-    response_to_decode: bytes
-        The response returned by the payShield
+    ----------
+    response_to_decode: bytes
+        The response returned by the payShield
+    head_len: int
+        The length of the header
+
+    Returns
+    -------
+    bool
+        False if the response is malformed: its header and the rest of it are printed as they are
+    """
+    return decode_response(parse_jk, print_jk, response_to_decode, head_len)
+
+
+def parse_ecc(response_to_decode: bytes, head_len: int) -> EccResponse:
+    """
+        It parses the result of the command FY
+
+        Parameters
+        ----------
+        response_to_decode: bytes
+            The response returned by the payShield
+        head_len: int
+            The length of the header
+
+        Returns
+        -------
+        EccResponse
+            The parsed response. The fields other than the header are None if the command failed
+        """
+    header, reader = parse_header(response_to_decode, head_len)
+    if header.error_code != '00':
+        return EccResponse(header)
+    key_len = reader.number(4)
+    return EccResponse(header, reader.raw(key_len), reader.raw(1).decode('ascii', 'ignore'), reader.raw())
+
+
+def print_ecc(response: EccResponse):
+    """
+        It prints the meaning of the result of the command FY
+
+        Parameters
+        ----------
+        response : EccResponse
+            The response parsed by parse_ecc
+        """
+    print_header(response.header)
+    if response.header.error_code == '00':
+        print("ECC Public Key Length: ", len(response.public_key))
+        print("ECC Public Key", bytes.hex(response.public_key))
+        print("Public/private separator: ", response.separator)
+        print("ECC Private Key under LMK", bytes.hex(response.private_key))
+
+
+def decode_ecc(response_to_decode: bytes, head_len: int) -> bool:
+    """
+        It decodes the result of the command FY and prints the meaning of the returned output
+
+        Parameters
+        ----------
+        response_to_decode: bytes
+            The response returned by the payShield
+        head_len: int
+            The length of the header
+
+        Returns
+        -------
+        bool
+            False if the response is malformed: its header and the rest of it are printed as they are
+        """
+    return decode_response(parse_ecc, print_ecc, response_to_decode, head_len)
+
+
+# The parse functions, used instead of the decoder functions when nothing is printed, to validate the responses
+PARSERS: Dict[str, Callable] = {
+    'NO': parse_no,
+    'NC': parse_nc,
+    'N0': parse_n0,
+    'J8': parse_j8,
+    'J2': parse_j2,
+    'J4': parse_j4,
+    'JK': parse_jk,
+    'B2': parse_b2,
+    'FY': parse_ecc,
+    'NI': parse_ni,
+    'JA': parse_ja
+}
+
+
+def luhn_check_digit(digits: str) -> str:
+    """
+        It calculates the check digit of the Luhn algorithm (ISO/IEC 7812), the last digit of a valid PAN.
+
+        Parameters
+        ----------
+         digits: str
+            The PAN without the check digit
+
+        Returns
+        -------
+        result : str
+            The check digit
+    """
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value = value * 2
+            if value > 9:
+                value = value - 9
+        total = total + value
+    return str((10 - total % 10) % 10)
+
+
+def generate_pan(rng: random.Random, length: int = 16, prefix: str = '4') -> str:
+    """
+        It generates a random PAN with a valid Luhn check digit.
+
+        Parameters
+        ----------
+         rng: random.Random
+            The random generator
+         length: int
+            The number of digits of the PAN, including the check digit
+         prefix: str
+            The first digits of the PAN, e.g. the BIN
+
+        Returns
+        -------
+        result : str
+            The PAN
+    """
+    digits = prefix + ''.join(rng.choices(string.digits, k=length - len(prefix) - 1))
+    return digits + luhn_check_digit(digits)
+
+
+def parse_size_distribution(spec: str, maximum: int) -> Callable[[random.Random], int]:
+    """
+        It creates the function that returns the size of each generated payload, from its textual description:
+         - fixed:SIZE every payload is SIZE characters long
+         - uniform:MIN:MAX the size is uniformly distributed between MIN and MAX
+         - exp:MEAN the size is exponentially distributed with mean MEAN
+         - normal:MEAN:STDDEV the size is normally distributed
+        The sizes are rounded and kept between 1 and the maximum.
+
+        Parameters
+        ----------
+         spec: str
+            The textual description of the distribution
+         maximum: int
+            The largest size allowed
+
+        Returns
+        -------
+        result : Callable[[random.Random], int]
+            The function returning a size every time it is invoked with the random generator
+
+        Raises
+        ------
+        ValueError
+            If the description is not valid.
+    """
+    fields = spec.split(':')
+    try:
+        values = [float(field) for field in fields[1:]]
+    except ValueError:
+        raise ValueError("invalid number in the size " + spec)
+    if any(value < 0 for value in values):
+        raise ValueError("the values of the size must not be negative")
+    kind = fields[0].lower()
+    if kind == 'fixed' and len(values) == 1:
+        distribution = lambda rng: values[0]
+    elif kind == 'uniform' and len(values) == 2:
+        distribution = lambda rng: rng.uniform(values[0], values[1])
+    elif kind == 'exp' and len(values) == 1 and values[0] > 0:
+        distribution = lambda rng: rng.expovariate(1 / values[0])
+    elif kind == 'normal' and len(values) == 2:
+        distribution = lambda rng: rng.gauss(values[0], values[1])
+    else:
+        raise ValueError("the size must be fixed:SIZE, uniform:MIN:MAX, exp:MEAN or normal:MEAN:STDDEV")
+    return lambda rng: min(maximum, max(1, round(distribution(rng))))
+
+
+def ja_generator(pin_length: int = 5) -> Callable[[random.Random, int], str]:
+    """
+        It returns the generator of JA commands, each one with a random PAN with a valid check digit.
+
+        Parameters
+        ----------
+         pin_length: int
+            The length of the PIN to generate
+
+        Returns
+        -------
+        result : Callable[[random.Random, int], str]
+            The generator, to be passed to CommandRing.generate
+    """
+    return lambda rng, index: 'JA' + generate_pan(rng) + ';' + str(pin_length).zfill(2)
+
+
+def b2_command(payload: str) -> str:
+    """
+        It returns the command B2 echoing the payload, without the header.
+
+        Parameters
+        ----------
+         payload: str
+            The data to echo, not longer than 0xFFFF characters
+
+        Returns
+        -------
+        result : str
+            The command, with the length of the payload in 4 hexadecimal digits
+    """
+    return 'B2' + format(len(payload), '04X') + payload
+
+
+def b2_generator(size: Callable[[random.Random], int]) -> Callable[[random.Random, int], str]:
+    """
+        It returns the generator of B2 commands, each one with a random printable payload.
+
+        Parameters
+        ----------
+         size: Callable[[random.Random], int]
+            The function returning the size of each payload, see parse_size_distribution
+
+        Returns
+        -------
+        result : Callable[[random.Random, int], str]
+            The generator, to be passed to CommandRing.generate
+    """
+
+    def generate(rng: random.Random, index: int) -> str:
+        return b2_command(''.join(rng.choices(string.ascii_letters + string.digits, k=size(rng))))
+
+    return generate
+
+
+def ei_generator(key_lengths: list[int]) -> Callable[[random.Random, int], str]:
+    """
+        It returns the generator of EI commands, rotating the length of the RSA key among the ones specified.
+
+        Parameters
+        ----------
+         key_lengths: list[int]
+            The lengths of the keys in bits, between 320 and 4096
+
+        Returns
+        -------
+        result : Callable[[random.Random, int], str]
+            The generator, to be passed to CommandRing.generate
+    """
+    return lambda rng, index: 'EI2' + str(key_lengths[index % len(key_lengths)]).zfill(4) + '01#0000'
+
+
+# The generators of the variable fields of the commands, used by --generate, indexed by command verb.
+# Each one receives the command line arguments and the header, and returns the function passed to CommandRing.generate
+GENERATORS: Dict[str, Callable[[argparse.Namespace, str], Callable[[random.Random, int], str]]] = {
+    'JA': lambda args, header: ja_generator(),
+    # the whole message cannot be longer than 32767 bytes
+    'B2': lambda args, header: b2_generator(parse_size_distribution(args.echo_size or "fixed:" + str(len(args.echo)),
+                                                                    0x7FFF - len(header) - 6)),
+    'EI': lambda args, header: ei_generator(args.key)
+}
+
+
+def payshield_error_codes(error_code: str) -> str:
+    """This function maps the result code with the error message.
+        I derived the list of errors and messages from the following manual:
+        payShield 10K Core Host Commands v1
+        Revision: A
+        Date: 04 August 2020
+        Doc.Number: PUGD0537 - 004
+
+        Parameters
+        ----------
+         error_code: str
+            The status code returned from the payShield 10k
+
+         Returns
+         -------
+         result : str
+          a string containing the message of the error code
+        """
+
+    PAYSHIELD_ERROR_CODE: dict[str, str] = {
+        '00': 'No error',
+        '01': 'Verification failure or warning of imported key parity error',
+        '02': 'Key inappropriate length for algorithm',
+        '04': 'Invalid key type code',
+        '05': 'Invalid key length flag',
+        '10': 'Source key parity error',
+        '11': 'Destination key parity error or key all zeros',
+        '12': 'Contents of user storage not available. Reset, power-down or overwrite',
+        '13': 'Invalid LMK Identifier',
+        '14': 'PIN encrypted under LMK pair 02-03 is invalid',
+        '15': 'Invalid input data (invalid format, invalid characters, or not enough data provided)',
+        '16': 'Console or printer not ready or not connected',
+        '17': 'HSM not authorized, or operation prohibited by security settings',
+        '18': 'Document format definition not loaded',
+        '19': 'Specified Diebold Table is invalid',
+        '20': 'PIN block does not contain valid values',
+        '21': 'Invalid index value, or index/block count would cause an overflow condition',
+        '22': 'Invalid account number',
+        '23': 'Invalid PIN block format code. (Use includes where the security setting to implement PCI HSM '
+              'limitations on PIN Block format usage is applied, and a Host command attempts to convert a PIN Block '
+              'to a disallowed format.)',
+        '24': 'PIN is fewer than 4 or more than 12 digits in length',
+        '25': 'Decimalization Table error',
+        '26': 'Invalid key scheme',
+        '27': 'Incompatible key length',
+        '28': 'Invalid key type',
+        '29': 'Key function not permitted',
+        '30': 'Invalid reference number',
+        '31': 'Insufficient solicitation entries for batch',
+        '32': 'AES not licensed',
+        '33': 'LMK key change storage is corrupted',
+        '39': 'Fraud detection',
+        '40': 'Invalid checksum',
+        '41': 'Internal hardware/software error: bad RAM, invalid error codes, etc.',
+        '42': 'DES failure',
+        '43': 'RSA Key Generation Failure',
+        '46': 'Invalid tag for encrypted PIN',
+        '47': 'Algorithm not licensed',
+        '49': 'Private key error, report to supervisor',
+        '51': 'Invalid message header',
+        '65': 'Transaction Key Scheme set to None',
+        '67': 'Command not licensed',
+        '68': 'Command has been disabled',
+        '69': 'PIN block format has been disabled',
+        '74': 'Invalid digest info syntax (no hash mode only)',
+        '75': 'Single length key masquerading as double or triple length key',
+        '76': 'RSA public key length error or RSA encrypted data length error',
+        '77': 'Clear data block error',
+        '78': 'Private key length error',
+        '79': 'Hash algorithm object identifier error',
+        '80': 'Data length error. The amount of MAC data (or other data) is greater than or less than the expected '
+              'amount.',
+        '81': 'Invalid certificate header',
+        '82': 'Invalid check value length',
+        '83': 'Key block format error',
+        '84': 'Key block check value error',
+        '85': 'Invalid OAEP Mask Generation Function',
+        '86': 'Invalid OAEP MGF Hash Function',
+        '87': 'OAEP Parameter Error',
+        '90': 'Data parity error in the request message received by the HSM',
+        'A1': 'Incompatible LMK schemes',
+        'A2': 'Incompatible LMK identifiers',
+        'A3': 'Incompatible key block LMK identifiers',
+        'A4': 'Key block authentication failure',
+        'A5': 'Incompatible key length',
+        'A6': 'Invalid key usage',
+        'A7': 'Invalid algorithm',
+        'A8': 'Invalid mode of use',
+        'A9': 'Invalid key version number',
+        'AA': 'Invalid export field',
+        'AB': 'Invalid number of optional blocks',
+        'AC': 'Optional header block error',
+        'AD': 'Key status optional block error',
+        'AE': 'Invalid start date/time',
+        'AF': 'Invalid end date/time',
+        'B0': 'Invalid encryption mode',
+        'B1': 'Invalid authentication mode',
+        'B2': 'Miscellaneous key block error',
+        'B3': 'Invalid number of optional blocks',
+        'B4': 'Optional block data error',
+        'B5': 'Incompatible components',
+        'B6': 'Incompatible key status optional blocks',
+        'B7': 'Invalid change field',
+        'B8': 'Invalid old value',
+        'B9': 'Invalid new value',
+        'BA': 'No key status block in the key block',
+        'BB': 'Invalid wrapping key',
+        'BC': 'Repeated optional block',
+        'BD': 'Incompatible key types',
+        'BE': 'Invalid key block header ID',
+        'D2': 'Invalid curve reference',
+        'D3': 'Invalid Key Encoding',
+        'E0': 'Invalid command version number'
+    }
+
+    return PAYSHIELD_ERROR_CODE.get(error_code, "Unknown error")
+
+
+def check_returned_command_verb(result_returned: bytes, head_len: int, command_sent: str) -> Tuple[int, str, str]:
+    """
+    Checks if the command returned by the payShield is congruent to the command sent
+    Parameters
+    ----------
+    result_returned: bytes
+        The output returned from the payShield
     head_len: int
         The length of the header
+    command_sent: str
+        The command sent to the payShield
 
     Returns
-    ___________
-    nothing
+    -------
+    result : tuple
+        a Tuple[int, str, str]
+        where the first value is 0 of the command is congruent or -1 if it is not.
+        the second value is the command sent.
+        the third value is the command returned by the payShield.
+    """
+
+    verb_returned = result_returned[2 + head_len:][:2]
+    verb_sent = command_sent[head_len:][:2]
+    verb_expected = verb_sent[0:1] + chr(ord(verb_sent[1:2]) + 1)
+    if verb_returned != verb_expected.encode():
+        return -1, verb_sent, verb_returned.decode()
+    else:
+        return 0, verb_sent, verb_returned.decode()
+
+
+def check_return_message(result_returned: bytes, head_len: int) -> Tuple[str, str]:
+    if len(result_returned) < 2 + head_len + 2:  # 2 bytes for len + 2 header len + 2 for command
+        return "ZZ", "Incomplete message"
+    # decode the first two bytes returned and transform them in integer
+    try:
+        expected_msg_len = int.from_bytes(result_returned[:2], byteorder='big', signed=False)
+    except ValueError:
+        return "ZZ", "Malformed message"
+    except Exception:
+        return "ZZ", "Unknown message length parsing error"
+
+    # compares the effective message length with then one stated in the first two bytes of the message
+    if len(result_returned) - 2 != expected_msg_len:
+        return "ZZ", "Length mismatch"
+    ret_code_position = 2 + head_len + 2
+
+    # better be safe than sorry
+    try:
+        # ret_code = int(result_returned[ret_code_position:ret_code_position + 2])
+        ret_code = result_returned[ret_code_position:ret_code_position + 2].decode()
+    except (ValueError, UnicodeDecodeError):
+        return "ZZ", "message result code parsing error"
+    except Exception:
+        return "ZZ", "Unknown message result code parsing error"
+
+    # try to describe the error
+    return ret_code, payshield_error_codes(ret_code)
+
+
+def test_printable(input_str):
+    return all(c in string.printable for c in input_str)
+
+
+def hex2ip(hex_ip):
+    addr_long = int(hex_ip, 16)
+    hex_ip = socket.inet_ntoa(pack(">L", addr_long))
+    return hex_ip
+
+
+def run_test(payConnectorInstance: PayConnector, host_command: str, header_len: int = 4,
+             decoder_funct: FunctionType = None, stats: LoadStats = None, verbose: bool = True,
+             start_time: int | None = None, stage: int | None = None, frame: bytes | None = None) -> str:
+    """
+        It connects to the specified host and port, using the specified protocol (tcp, udp, or tls) and sends the command.
+
+        Parameters
+        ----------
+         payConnectorInstance: PayConnector
+            The instance of the PayConnector class
+         host_command: str
+            The command to send to the payShield complete of the header part
+         header_len: int
+            The length of the header. If not specified, the value is 4 because it is the default factory value
+            in payShield 10k
+         decoder_funct: FunctionType
+            If provided needs to be a reference to a function that is able to parse the command and print the meaning of it
+            If it returns False, the response is malformed and it is accounted as ZZ.
+            If it is not provided, the default is None
+         stats: LoadStats
+            If provided, the return code and the latency of the command are accounted in it
+            If it is not provided, the default is None
+         verbose: bool
+            If False, nothing is printed, and the decoder_funct is expected to be a parse_XX function: it is
+            invoked to validate the response, and a response that cannot be parsed is accounted as ZZ.
+            If it is not provided, the default is True
+         start_time: int | None
+            The time, as returned by time.perf_counter_ns(), from which the latency is measured.
+            It is used in open-loop mode to measure the latency from the time the command was intended to be sent.
+            If it is not provided, the latency is measured from the time the command is actually sent
+         stage: int | None
+            The index of the stage of the load profile the command belongs to, passed to the stats.
+            If it is not provided, the default is None
+         frame: bytes | None
+            The host_command already framed, e.g. by a CommandMix, sent as it is.
+            If it is not provided, the command is framed by the connector
+
+        Returns
+        -------
+        result : str
+            The return code from the command
+    """
+    return_code_tuple = ['ZZ', 'Error']
+    latency = None
+    data = None
+    try:
+        # Connect to the host and gather the reply in TCP or UDP
+        if start_time is None:
+            start_time = time.perf_counter_ns()
+        if stats is not None:
+            stats.in_flight += 1
+        connect_us = payConnectorInstance.connect_us
+        if frame is None:
+            data = payConnectorInstance.send_command(host_command)
+        else:
+            data = payConnectorInstance.send_frame(frame)
+        # If no data is returned
+        if data is None:
+            return return_code_tuple[0]
+        # the time spent opening the connection is accounted apart, in the connect and handshake latency
+        latency = max(0, (time.perf_counter_ns() - start_time) // 1000 - payConnectorInstance.connect_us + connect_us)
+
+        # try to decode the result code contained in the reply of the payShield
+        return_code_tuple = check_return_message(data, header_len)
+        if not verbose:
+            # in quiet mode nothing is formatted or printed, the decoder_funct, if any, only parses the response
+            # to validate it
+            if decoder_funct is not None and return_code_tuple[0] == '00':
+                try:
+                    decoder_funct(data, header_len)
+                except (ValueError, IndexError):
+                    return_code_tuple = ['ZZ', 'Malformed response']
+            return return_code_tuple[0]
+
+        message = build_frame(host_command)
+        check_result_tuple = (-1, "", "")
+        if return_code_tuple[0] != "ZZ":
+            print()
+            check_result_tuple = check_returned_command_verb(data, header_len, host_command)
+
+        print("Return code: " + str(return_code_tuple[0]) + " " + return_code_tuple[1])
+        if check_result_tuple[0] != 0:
+            print("NOTE: The response received from the HSM seems unrelated to the request!")
+
+        print("Command sent/received: " + check_result_tuple[1] + " ==> " + check_result_tuple[2])
+
+        # don't print ascii if msg or resp contains non printable chars
+        if test_printable(message[2:].decode("ascii", "ignore")):
+            print("sent data (ASCII) :", message[2:].decode("ascii", "ignore"))
+
+        print("sent data (HEX) :", bytes.hex(message))
+
+        if test_printable((data[2:]).decode("ascii", "ignore")):
+            print("received data (ASCII):", data[2:].decode("ascii", "ignore"))
+
+        print("received data (HEX) :", bytes.hex(data))
+        if (decoder_funct is not None) and callable(decoder_funct):
+            print("")
+            print("-----DECODING RESPONSE-----")
+            # a response that cannot be decoded is accounted as ZZ, as in quiet mode
+            if decoder_funct(data, header_len) is False and return_code_tuple[0] == '00':
+                return_code_tuple = ['ZZ', 'Malformed response']
+                print("Return code accounted: ZZ Malformed response")
+
+    except ConnectionError as e:
+        print("Connection issue: ", e)
+    except FileNotFoundError as e:
+        print("The client certificate file or the client key file cannot be found or accessed.\n" +
+              "Check value passed to the parameters --keyfile and --crtfile", e)
+    except Exception as e:
+        print("Unexpected issue:", e)
+
+    finally:
+        # no return statement here: it would swallow KeyboardInterrupt and the test could not be interrupted
+        if stats is not None:
+            stats.in_flight = 0
+            stats.update_connection(payConnectorInstance)
+            stats.record(return_code_tuple[0], host_command[header_len:header_len + 2], latency, stage,
+                         len(host_command) + 2, None if data is None else len(data),
+                         payConnectorInstance.target if isinstance(payConnectorInstance, PooledConnector) else None)
+    return return_code_tuple[0]
+
+
+def send_schedule(rate: float, poisson: bool = False, start_time: int | None = None):
+    """
+        It generates the times when the commands need to be sent to obtain the rate specified,
+        independently of how long the payShield takes to answer (open-loop load).
+
+        Parameters
+        ----------
+         rate: float
+            The number of commands per second
+         poisson: bool
+            If True, the intervals between the commands are random and exponentially distributed (Poisson arrivals),
+            otherwise they are all equal
+         start_time: int | None
+            The time of the first command, as returned by time.perf_counter_ns(). If None, it is the current time
+
+        Returns
+        -------
+        result : Iterator[Tuple[int, None]]
+            The times, as returned by time.perf_counter_ns(), when the commands are intended to be sent,
+            each one paired with None because there are no stages
+    """
+    next_time = float(time.perf_counter_ns() if start_time is None else start_time)
+    while True:
+        yield int(next_time), None
+        if poisson:
+            next_time = next_time + random.expovariate(rate) * 1e9
+        else:
+            next_time = next_time + 1e9 / rate
+
+
+def profile_schedule(profile: LoadProfile, share: float = 1.0, poisson: bool = False,
+                     start_time: int | None = None, repeat: bool = False):
+    """
+        It generates the times when the commands need to be sent to follow the load profile specified.
+        The generator ends when the profile ends, unless repeat is True.
+
+        Parameters
+        ----------
+         profile: LoadProfile
+            The load profile to follow
+         share: float
+            The fraction of the rate of the profile this schedule has to generate, e.g. 0.25 if the load is spread
+            over four connections
+         poisson: bool
+            If True, the intervals between the commands are random and exponentially distributed (Poisson arrivals),
+            otherwise they are all equal
+         start_time: int | None
+            The time the profile starts, as returned by time.perf_counter_ns(). If None, it is the current time
+         repeat: bool
+            If True, the profile restarts when it ends
+
+        Returns
+        -------
+        result : Iterator[Tuple[int, int]]
+            The times, as returned by time.perf_counter_ns(), when the commands are intended to be sent,
+            each one paired with the index of the stage of the profile
+    """
+    start_time = float(time.perf_counter_ns() if start_time is None else start_time)
+    next_time = start_time
+    while True:
+        elapsed = (next_time - start_time) / 1e9
+        stage = profile.stage_at(elapsed, repeat)
+        if stage is None:
+            return
+        yield int(next_time), stage
+        rate = profile.rate_at(elapsed, repeat) * share
+        if poisson:
+            next_time = next_time + random.expovariate(rate) * 1e9
+        else:
+            next_time = next_time + 1e9 / rate
+
+
+def build_schedules(parts: int, rate: float | None = None, poisson: bool = False,
+                    profile: LoadProfile | None = None, repeat: bool = False, share: float = 1.0) -> list:
+    """
+        It creates one schedule for each connection, splitting the rate, or the rate of the profile, evenly among them.
+        All the schedules start at the same time.
+
+        Parameters
+        ----------
+         parts: int
+            The number of connections
+         rate: float | None
+            The total number of commands per second
+         poisson: bool
+            If True, the commands are sent with Poisson arrivals
+         profile: LoadProfile | None
+            If provided, the load profile to follow instead of the constant rate
+         repeat: bool
+            If True, the profile restarts when it ends
+         share: float
+            The fraction of the rate of the profile all these schedules together have to generate
+
+        Returns
+        -------
+        result : list
+            The schedules, one per connection, or a list of None if neither the rate nor the profile is specified
+    """
+    start_time = time.perf_counter_ns()
+    if profile is not None:
+        return [profile_schedule(profile, share / parts, poisson, start_time, repeat) for _ in range(parts)]
+    if rate is not None:
+        return [send_schedule(rate / parts, poisson, start_time) for _ in range(parts)]
+    return [None] * parts
+
+
+def wait_until(intended_time: int) -> int:
+    """
+        It sleeps until the time specified, if it is in the future.
+
+        Parameters
+        ----------
+         intended_time: int
+            The time, as returned by time.perf_counter_ns(), when the command is intended to be sent
+
+        Returns
+        -------
+        result : int
+            How many microseconds the sender is behind the schedule, including the oversleeping
+    """
+    delay = intended_time - time.perf_counter_ns()
+    if delay > 0:
+        time.sleep(delay / 1e9)
+    return max(0, time.perf_counter_ns() - intended_time) // 1000
+
+
+def run_connection(payConnectorInstance: PayConnector, host_command: str | CommandMix, header_len: int,
+                   times: int | None,
+                   stats: LoadStats, decoder_funct: FunctionType = None, connection_id: int | None = None,
+                   verbose: bool = True, schedule=None, churn: int | None = None):
+    """
+        It drives run_test on a single connection for the number of times specified, or forever.
+
+        Parameters
+        ----------
+         payConnectorInstance: PayConnector
+            The instance of the PayConnector class used by this connection
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         header_len: int
+            The length of the header
+         times: int | None
+            How many commands to send. If None, the commands are sent forever, or until the schedule ends
+         stats: LoadStats
+            The instance where the results of the operations are accounted
+         decoder_funct: FunctionType
+            If provided, it is passed to run_test to decode the response.
+            If host_command is a CommandMix, the decoders of the mix are used instead
+         connection_id: int | None
+            The identifier of the connection, printed together with the iteration number.
+            If None, the connection is the only one and no identifier is printed.
+         verbose: bool
+            If False, nothing is printed for each iteration and only the stats are updated
+         schedule: Iterator[Tuple[int, int | None]] | None
+            If provided, as created by build_schedules, the commands are sent following its timetable (open-loop load),
+            and the latency is measured from the time each command was intended to be sent.
+            If None, each command is sent as soon as the previous one returns
+         churn: int | None
+            If provided, the connection is closed after every churn commands, and opened again by the next one
+    """
+    mix = host_command if isinstance(host_command, CommandMix) else None
+    command, frame, decoder = host_command, None, decoder_funct
+    i = 0
+    while times is None or i < times:
+        i = i + 1
+        intended_time = stage = None
+        if schedule is not None:
+            try:
+                intended_time, stage = next(schedule)
+            except StopIteration:
+                break
+            stats.schedule_lag.record(wait_until(intended_time))
+        if mix is not None:
+            command, frame, decoder = mix.pick_frame()
+        if not verbose:
+            run_test(payConnectorInstance, command, header_len, decoder, stats, False, intended_time, stage, frame)
+        else:
+            prefix = "" if connection_id is None else "Connection " + str(connection_id) + " - "
+            if times is None:
+                print(prefix + "Iteration: ", i)
+            else:
+                print(prefix + "Iteration: ", i, " of ", times)
+            run_test(payConnectorInstance, command, header_len, decoder, stats, True, intended_time, stage, frame)
+            print("")
+        if churn is not None and i % churn == 0:
+            payConnectorInstance.close()
+            stats.update_connection(payConnectorInstance)
+
+
+def split_times(times: int | None, parts: int, index: int) -> int | None:
+    """
+        It returns how many of the total commands the part with the index specified has to send,
+        so that the total is split as evenly as possible.
+
+        Parameters
+        ----------
+         times: int | None
+            The total number of commands. If None, the commands are sent forever
+         parts: int
+            In how many parts the total needs to be split
+         index: int
+            The index of the part, starting from 0
+
+        Returns
+        -------
+        result : int | None
+            The number of commands of the part, or None if the commands are sent forever
+    """
+    if times is None:
+        return None
+    return times // parts + (1 if index < times % parts else 0)
+
+
+def run_load(connectors: list[PayConnector], host_command: str | CommandMix, header_len: int, times: int | None,
+             stats_list: list[LoadStats], decoder_funct: FunctionType = None,
+             verbose: bool = True, schedules: list | None = None, churn: int | None = None) -> list[LoadStats]:
+    """
+        It sends the command to the payShield using all the connections passed concurrently, one thread per
+        connection. The total number of commands is split evenly among the connections.
+        If only one connection is passed, the test runs in the calling thread.
+
+        Parameters
+        ----------
+         connectors: list[PayConnector]
+            The connections to use. Each one is driven by its own thread
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         header_len: int
+            The length of the header
+         times: int | None
+            The total number of commands to send. If None, the commands are sent forever, or until the schedules end
+         stats_list: list[LoadStats]
+            The instances where the results are accounted, one for each connector.
+            They are passed by the caller, so they can be read while the test is running or after an interruption
+         decoder_funct: FunctionType
+            If provided, it is passed to run_test to decode the response
+         verbose: bool
+            If False, nothing is printed for each command and only the stats are updated
+         schedules: list | None
+            If provided, the schedules created by build_schedules, one for each connector
+         churn: int | None
+            If provided, every connection is closed and opened again after the number of commands specified
+
+        Returns
+        -------
+        result : list[LoadStats]
+            The stats_list passed
+    """
+    if schedules is None:
+        schedules = [None] * len(connectors)
+    if len(connectors) == 1:
+        run_connection(connectors[0], host_command, header_len, times, stats_list[0], decoder_funct, None, verbose,
+                       schedules[0], churn)
+        return stats_list
+    threads = []
+    for connection_id, connector in enumerate(connectors):
+        connection_times = split_times(times, len(connectors), connection_id)
+        threads.append(threading.Thread(target=run_connection,
+                                        args=(connector, host_command, header_len, connection_times,
+                                              stats_list[connection_id], decoder_funct, connection_id + 1,
+                                              verbose, schedules[connection_id], churn),
+                                        daemon=True))
+    for thread in threads:
+        thread.start()
+    # join with a timeout, so that CTRL-C is still able to stop the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+    return stats_list
+
+
+async def run_async_connection(asyncConnectorInstance: AsyncPayConnector, host_command: str | CommandMix,
+                               header_len: int, times: int | None, stats: LoadStats, schedule=None):
+    """
+        It keeps the window of the connection full of commands for the number of times specified, or forever.
+        If the schedule is specified, instead, the commands are sent following its timetable and wait for a free slot
+        of the window if needed.
+        Nothing is printed per command: the results are only accounted in the stats.
+
+        Parameters
+        ----------
+         asyncConnectorInstance: AsyncPayConnector
+            The instance of the AsyncPayConnector class used by this connection
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         header_len: int
+            The length of the header
+         times: int | None
+            How many commands to send. If None, the commands are sent forever, or until the schedule ends
+         stats: LoadStats
+            The instance where the results of the operations are accounted
+         schedule: Iterator[Tuple[int, int | None]] | None
+            If provided, as created by build_schedules, the commands are sent following its timetable, and the
+            latency is measured from the time each command was intended to be sent
+    """
+    mix = host_command if isinstance(host_command, CommandMix) else None
+
+    async def send_one(start_time: int, stage: int | None = None):
+        command, frame = (host_command, None) if mix is None else mix.pick_frame()[:2]
+        verb = command[header_len:header_len + 2]
+        stats.in_flight += 1
+        connect_us = asyncConnectorInstance.connect_us
+        target = None
+        try:
+            if isinstance(asyncConnectorInstance, AsyncPooledConnector):
+                data, target = await asyncConnectorInstance.send_routed(command, frame)
+            elif frame is not None:
+                data = await asyncConnectorInstance.send_frame(frame)
+            else:
+                data = await asyncConnectorInstance.send_command(command)
+        finally:
+            stats.in_flight -= 1
+        stats.update_connection(asyncConnectorInstance)
+        if data is None:
+            stats.record('ZZ', verb, None, stage, len(command) + 2, None, target)
+        else:
+            # a command waiting for the connection to be opened does not account that time in its latency
+            latency = (time.perf_counter_ns() - start_time) // 1000 - asyncConnectorInstance.connect_us + connect_us
+            stats.record(check_return_message(data, header_len)[0], verb, max(0, latency), stage,
+                         len(command) + 2, len(data), target)
+
+    if schedule is None:
+        remaining = [times]
+
+        async def sender():
+            while remaining[0] is None or remaining[0] > 0:
+                if remaining[0] is not None:
+                    remaining[0] = remaining[0] - 1
+                await send_one(time.perf_counter_ns())
+
+        await asyncio.gather(*(sender() for _ in range(asyncConnectorInstance.window)))
+    else:
+        in_flight = set()
+        sent = 0
+        for intended_time, stage in schedule:
+            if times is not None and sent >= times:
+                break
+            sent = sent + 1
+            delay = intended_time - time.perf_counter_ns()
+            if delay > 0:
+                await asyncio.sleep(delay / 1e9)
+            stats.schedule_lag.record(max(0, time.perf_counter_ns() - intended_time) // 1000)
+            task = asyncio.create_task(send_one(intended_time, stage))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        await asyncio.gather(*in_flight)
+    await asyncConnectorInstance.close()
+
+
+def run_async_load(connectors: list[AsyncPayConnector], host_command: str | CommandMix, header_len: int,
+                   times: int | None, stats_list: list[LoadStats], schedules: list | None = None) -> list[LoadStats]:
     """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':  # no errors
-        str_pointer = str_pointer + 2
-        print("Payload echoed: ", response_to_decode[str_pointer:])
+        It sends the command to the payShield pipelining the commands on all the connections passed.
+        All the connections are served by a single asyncio event loop running in the calling thread.
+        The total number of commands is split evenly among the connections.
 
+        Parameters
+        ----------
+         connectors: list[AsyncPayConnector]
+            The connections to use
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         header_len: int
+            The length of the header
+         times: int | None
+            The total number of commands to send. If None, the commands are sent forever, or until the schedules end
+         stats_list: list[LoadStats]
+            The instances where the results are accounted, one for each connector
+         schedules: list | None
+            If provided, the schedules created by build_schedules, one for each connector
 
-def decode_j2(response_to_decode: bytes, head_len: int):
+        Returns
+        -------
+        result : list[LoadStats]
+            The stats_list passed
     """
-    It decodes the result of the command J2 and prints the meaning of the returned output
-    The message trailer is not considered
+    if schedules is None:
+        schedules = [None] * len(connectors)
 
-    Parameters
-    ___________
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+    async def run_all():
+        tasks = []
+        for connection_id, connector in enumerate(connectors):
+            connection_times = split_times(times, len(connectors), connection_id)
+            tasks.append(run_async_connection(connector, host_command, header_len, connection_times,
+                                              stats_list[connection_id], schedules[connection_id]))
+        await asyncio.gather(*tasks)
 
-    Returns
-    ___________
-    nothing
-    """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("Serial Number: ", response_to_decode[str_pointer:str_pointer + 12])
-        str_pointer = str_pointer + 12
-        print("Start Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Start Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Seconds: ", response_to_decode[str_pointer:str_pointer + 10])
-        str_pointer = str_pointer + 10
-
-        while (str_pointer + 15) <= msg_len:
-            print("Starting percentage: ", response_to_decode[str_pointer:str_pointer + 3])
-            str_pointer = str_pointer + 3
-            print("Ending percentage: ", response_to_decode[str_pointer:str_pointer + 3])
-            str_pointer = str_pointer + 3
-            print("Number Times Periods: ", response_to_decode[str_pointer:str_pointer + 10])
-            str_pointer = str_pointer + 10
-            print("Delimiter: ", response_to_decode[str_pointer:str_pointer + 1])
-            str_pointer = str_pointer + 1
-        print("")
+    asyncio.run(run_all())
+    return stats_list
 
 
-def decode_j4(response_to_decode: bytes, head_len: int):
+def create_connectors(args: argparse.Namespace) -> list:
     """
-    It decodes the result of the command J4 and prints the meaning of the returned output
-    The message trailer is not considered
+        It creates the connections to the payShield as specified by the command line arguments.
 
-    Parameters
-    ___________
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
 
-    Returns
-    ___________
-    nothing
-    """
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("Serial Number: ", response_to_decode[str_pointer:str_pointer + 12])
-        str_pointer = str_pointer + 12
-        print("Start Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Start Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("End Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Current Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Seconds: ", response_to_decode[str_pointer:str_pointer + 10])
-        str_pointer = str_pointer + 10
-
-        while (str_pointer + 12) <= msg_len:
-            print("Command Code: ", response_to_decode[str_pointer:str_pointer + 2])
-            str_pointer = str_pointer + 2
-            print("Transactions: ", response_to_decode[str_pointer:str_pointer + 12])
-            str_pointer = str_pointer + 12
-
-
-def decode_jk(response_to_decode: bytes, head_len: int):
+        Returns
+        -------
+        result : list
+            args.connections instances of AsyncPayConnector if --pipeline is specified, otherwise of PayConnector.
+            If several payShields are specified, each connection is an AsyncPooledConnector or a PooledConnector
+            with a connection to every payShield, and all of them share the same TargetPool
     """
-    It decodes the result of the command JK and prints the meaning of the returned output
-    The message trailer is not considered
+    timeouts = dict(connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, backoff=args.backoff,
+                    backoff_max=args.backoff_max)
+
+    def connector(host: str, port: int):
+        if args.pipeline is not None:
+            return AsyncPayConnector(host, port, args.proto, args.keyfile, args.crtfile, len(args.header),
+                                     args.pipeline, **timeouts)
+        if args.proto == 'tls':
+            return PayConnector(host, port, args.proto, args.keyfile, args.crtfile, **timeouts,
+                                resume_sessions=not args.no_tls_resume)
+        return PayConnector(host, port, args.proto, **timeouts)
+
+    if len(args.targets) == 1:
+        return [connector(args.host, args.port) for _ in range(args.connections)]
+    pool = TargetPool(args.targets, args.balance)
+    connectors = []
+    for _ in range(args.connections):
+        target_connectors = [connector(host, port) for host, port, _ in pool.targets]
+        if args.pipeline is not None:
+            connectors.append(AsyncPooledConnector(pool, target_connectors, args.pipeline))
+        else:
+            connectors.append(PooledConnector(pool, target_connectors))
+    return connectors
 
-    Parameters
-    ----------
-    response_to_decode: bytes
-        The response returned by the payShield
-    head_len: int
-        The length of the header
 
-    Returns
-    -------
-    result : None
-        nothing
+def run_configured_load(args: argparse.Namespace, connectors: list, host_command: str | CommandMix,
+                        times: int | None, stats_list: list[LoadStats], profile: LoadProfile | None = None,
+                        decoder_funct: FunctionType = None, share: float = 1.0):
     """
-    # structures to decode the result
-    # We can use CONSOLE_STATUS_CODE to check the status of the payShield Manager as well.
+        It runs the test on the connections passed with the engine, the rate and the profile specified by the
+        command line arguments.
 
-    CONSOLE_STATUS_CODE: dict[str, str] = {
-        '0': 'unknown',
-        '1': 'running',
-        '2': 'not running',
-        '3': 'console disabled by GUI'}
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         connectors: list
+            The connections created by create_connectors
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         times: int | None
+            The total number of commands to send. If None, the commands are sent forever.
+            It is ignored if a profile is specified, because the profile sets the duration of the test
+         stats_list: list[LoadStats]
+            The instances where the results are accounted, one for each connector
+         profile: LoadProfile | None
+            The load profile, if specified
+         decoder_funct: FunctionType
+            If provided, it is passed to run_test to decode the response
+         share: float
+            The fraction of the rate, or of the rate of the profile, this process has to generate
+    """
+    # the schedules are created here, so that they start when the test starts
+    rate = None if args.rate is None else args.rate * share
+    schedules = build_schedules(len(connectors), rate, args.poisson, profile, args.forever, share)
+    if profile is not None:
+        # the duration of the test is set by the profile
+        times = None
+    if args.pipeline is not None:
+        run_async_load(connectors, host_command, len(args.header), times, stats_list, schedules)
+    else:
+        run_load(connectors, host_command, len(args.header), times, stats_list, decoder_funct, not args.quiet,
+                 schedules, args.churn)
 
-    TAMPER_STATUS_CODE: dict[str, str] = {
-        '0': 'Unknown',
-        '1': 'Not Tampered',
-        '2': 'Tampered'}
 
-    HOST_STATUS_CODE: dict[str, str] = {
-        '0': 'unknown',
-        '1': 'running',
-        '2': 'not running',
-        '3': 'not configured'
-    }
+def run_worker(worker_id: int, args: argparse.Namespace, host_command: str | CommandMix,
+               profile: LoadProfile | None, times: int | None, result_queue, start_at: float | None = None):
+    """
+        It is the entry point of the worker processes started by run_workers.
+        It runs its own pool of connections and sends to the parent process a snapshot of its counters every second,
+        and the final counters when the test ends or is interrupted.
 
-    TAMPER_CAUSE_CODE: dict[str, str] = {
-        '00': 'unknown',
-        '01': 'temp out of range',
-        '02': 'battery low',
-        '03': 'erase button pressed',
-        '04': 'security processor watchdog',
-        '05': 'power too high',
-        '06': 'security processor restart',
-        '07': 'motion detected',
-        '08': 'case tampered',
-        '09': 'TSPP Module',
-        '10': 'General'
-    }
-    LMK_ALGORITHM_CODE: dict[str, str] = {
-        '0': '3DES2Key',
-        '1': '3DES3Key',
-        '2': 'AES 256-bit'
-    }
-    LMK_SCHEME_CODE: dict[str, str] = {
-        'V': 'Variant',
-        'K': 'Keyblock'
-    }
-    LMK_STATUS_CODE: dict[str, str] = {
-        'L': 'Live',
-        'T': 'Test'
-    }
-    LMK_AUTH_CODE: dict[str, str] = {
-        '0': 'Not authorized',
-        '1': 'Authorized'
-    }
-    FRAUD_CODE: dict[str, str] = {
+        Parameters
+        ----------
+         worker_id: int
+            The index of the worker, starting from 0
+         args: argparse.Namespace
+            The parsed command line arguments
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         profile: LoadProfile | None
+            The load profile, if specified
+         times: int | None
+            The number of commands this worker has to send. If None, the commands are sent forever
+         result_queue: multiprocessing.Queue
+            The queue where the tuples (kind, worker_id, LoadStats) are sent, where kind is 'snapshot' or 'final'
+         start_at: float | None
+            If provided, the time, as returned by time.time(), the load starts at, so that the workers started by
+            different agents start together
+    """
+    connectors = create_connectors(args)
+    results = None
+    if args.results_file is not None:
+        results = ResultsWriter(ResultsWriter.worker_path(args.results_file, worker_id + 1))
+    # the connections are numbered across all the workers
+    stats_list = [LoadStats(worker_id * len(connectors) + connection_id + 1, results)
+                  for connection_id in range(len(connectors))]
+    stop_snapshots = threading.Event()
+
+    def snapshot() -> LoadStats:
+        total = LoadStats()
+        for stats in stats_list:
+            total.merge(stats)
+        return total
+
+    def send_snapshots():
+        while not stop_snapshots.wait(1):
+            result_queue.put(('snapshot', worker_id, snapshot()))
+
+    threading.Thread(target=send_snapshots, daemon=True).start()
+    try:
+        decoder = PARSERS.get(host_command[len(args.header):len(args.header) + 2]) \
+            if args.decode and isinstance(host_command, str) else None
+        if isinstance(host_command, CommandRing):
+            # each worker, or agent, starts from a different point of the ring
+            host_command.start_at(worker_id, args.workers)
+        if start_at is not None:
+            time.sleep(max(0.0, start_at - time.time()))
+        run_configured_load(args, connectors, host_command, times, stats_list, profile, decoder, 1 / args.workers)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_snapshots.set()
+        if results is not None:
+            results.close()
+        result_queue.put(('final', worker_id, snapshot()))
 
-        '0': 'not exceeded (or not enabled)',
-        '1': 'exceeded'
-    }
-    response_to_decode, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        print("Serial Number: ", response_to_decode[str_pointer:str_pointer + 12])
-        str_pointer = str_pointer + 12
-        print("System Date: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("System Time: ", response_to_decode[str_pointer:str_pointer + 6])
-        str_pointer = str_pointer + 6
-        print("Console State: ", CONSOLE_STATUS_CODE.get(response_to_decode[str_pointer:str_pointer + 1], '?'))
-        str_pointer = str_pointer + 1
-        print("payShield Manager State: ",
-              CONSOLE_STATUS_CODE.get(response_to_decode[str_pointer:str_pointer + 1], '?'))
-        str_pointer = str_pointer + 1
-        print("HOST 1 State: ", HOST_STATUS_CODE.get(response_to_decode[str_pointer:str_pointer + 1], '?'))
-        str_pointer = str_pointer + 1
-        print("HOST 2 State: ", HOST_STATUS_CODE.get(response_to_decode[str_pointer:str_pointer + 1], '?'))
-        str_pointer = str_pointer + 1
-        print("Reserved: ", response_to_decode[str_pointer:str_pointer + 1])
-        str_pointer = str_pointer + 1
-        print("Reserved: ", response_to_decode[str_pointer:str_pointer + 1])
-        str_pointer = str_pointer + 1
-        tamper_state = response_to_decode[str_pointer:str_pointer + 1]
-
-        print("Tamper State: ", TAMPER_STATUS_CODE.get(tamper_state, '?'))
-        str_pointer = str_pointer + 1
-        if tamper_state == '2':
-            print("Tamper Cause: ", TAMPER_CAUSE_CODE.get(response_to_decode[str_pointer:str_pointer + 2], '?'))
-            str_pointer = str_pointer + 2
-            print("Tamper Date: ", response_to_decode[str_pointer:str_pointer + 6])
-            str_pointer = str_pointer + 6
-            print("Tamper Time: ", response_to_decode[str_pointer:str_pointer + 6])
-            str_pointer = str_pointer + 6
-        lmk_loaded = response_to_decode[str_pointer:str_pointer + 2]
-        print("Number of LMK Loaded: ", lmk_loaded)
-        str_pointer = str_pointer + 2
-        print("Number of Test LMK: ", response_to_decode[str_pointer:str_pointer + 2])
-        str_pointer = str_pointer + 2
-        print("Number of Old LMK: ", response_to_decode[str_pointer:str_pointer + 2])
-        str_pointer = str_pointer + 2
-        print("There are ", lmk_loaded, " LMK(s) loaded")
-        try:
-            lmks_loaded_num = int(lmk_loaded)
-        except ValueError:
-            lmks_loaded_num = -1
-        if lmks_loaded_num > 0:
-            remaining_to_decode = response_to_decode[str_pointer:]
-            lmks_string = str.split(remaining_to_decode, '\x15')[0]
-            lmks_array = str.split(lmks_string, '\x14')
-            for lmk in lmks_array:
-                if len(lmk) > 0:
-                    local_lmk_pointer = 0
-                    print("LMK ID: ", lmk[local_lmk_pointer:local_lmk_pointer + 2])
-                    local_lmk_pointer = local_lmk_pointer + 2
-                    print("Authorised: ", LMK_AUTH_CODE.get(lmk[local_lmk_pointer:local_lmk_pointer + 1], '?'))
-                    local_lmk_pointer = local_lmk_pointer + 1
-                    print("Num Authorised Activities: ", lmk[local_lmk_pointer:local_lmk_pointer + 2])
-                    local_lmk_pointer = local_lmk_pointer + 2
-                    print("LMK Scheme: ", LMK_SCHEME_CODE.get(lmk[local_lmk_pointer:local_lmk_pointer + 1], '?'))
-                    local_lmk_pointer = local_lmk_pointer + 1
-                    print("Algorithm: ", LMK_ALGORITHM_CODE.get(lmk[local_lmk_pointer:local_lmk_pointer + 1], '?'))
-                    local_lmk_pointer = local_lmk_pointer + 1
-                    print("Status: ", LMK_STATUS_CODE.get(lmk[local_lmk_pointer:local_lmk_pointer + 1], '?'))
-                    local_lmk_pointer = local_lmk_pointer + 1
-                    print("Comments: ", lmk[local_lmk_pointer:])
-                    print("")
-        fraud_detection = str.split(response_to_decode[str_pointer:], '\x15')[1]
-        print("Fraud detection Exceeded: ", FRAUD_CODE.get(fraud_detection[0], '?'))
-        print("PIN attacks exceeded: ", FRAUD_CODE.get(fraud_detection[1], '?'))
-        print("")
 
+def run_workers(args: argparse.Namespace, host_command: str | CommandMix, profile: LoadProfile | None,
+                times: int | None, worker_stats: list[LoadStats]) -> list[LoadStats]:
+    """
+        It starts args.workers processes, each one running its own pool of connections, and collects their counters.
+        The total number of commands, the rate and the profile are split evenly among the workers.
+        While the test runs, worker_stats is kept updated with the latest snapshot of each worker.
+
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         profile: LoadProfile | None
+            The load profile, if specified
+         times: int | None
+            The total number of commands to send. If None, the commands are sent forever
+         worker_stats: list[LoadStats]
+            The list, with one element for each worker, where the counters of the workers are stored
 
-def decode_ecc(response_to_decode: bytes, head_len: int):
+        Returns
+        -------
+        result : list[LoadStats]
+            The worker_stats passed, containing the final counters of each worker
     """
-        It decodes the result of the command FY and prints the meaning of the returned output
+    result_queue = multiprocessing.Queue()
+    processes = []
+    for worker_id in range(args.workers):
+        processes.append(multiprocessing.Process(target=run_worker,
+                                                 args=(worker_id, args, host_command, profile,
+                                                       split_times(times, args.workers, worker_id), result_queue),
+                                                 daemon=True))
+    for process in processes:
+        process.start()
+    finished = set()
+    deadline = None
+    while len(finished) < args.workers:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        try:
+            kind, worker_id, stats = result_queue.get(timeout=0.5)
+        except queue.Empty:
+            # a worker that died without sending its final counters is not waited for
+            for worker_id, process in enumerate(processes):
+                if not process.is_alive() and worker_id not in finished and process.exitcode != 0:
+                    print("Worker", worker_id + 1, "terminated unexpectedly with exit code", process.exitcode)
+                    finished.add(worker_id)
+            continue
+        except KeyboardInterrupt:
+            # the workers receive the interruption too: give them some time to send their final counters
+            deadline = time.perf_counter() + 5
+            continue
+        worker_stats[worker_id] = stats
+        if kind == 'final':
+            finished.add(worker_id)
+    for process in processes:
+        process.join(1)
+    return worker_stats
+
+
+def parse_endpoint(spec: str, default_address: str | None = None) -> Tuple[str, int]:
+    """
+        It parses an endpoint in the form ADDRESS:PORT, or just PORT if a default address is provided.
 
         Parameters
         ----------
-        response_to_decode: bytes
-            The response returned by the payShield
-        head_len: int
-            The length of the header
+         spec: str
+            The endpoint, e.g. 10.0.0.5:7000
+         default_address: str | None
+            The address used when spec contains only the port. If None, the address is mandatory
 
         Returns
         -------
-        result : None
-            nothing
-        """
-    response_to_decode_str, msg_len, str_pointer = common_parser(response_to_decode, head_len)
-    if response_to_decode_str[str_pointer:str_pointer + 2] == '00':
-        str_pointer = str_pointer + 2
-        key_len = int(response_to_decode_str[str_pointer:str_pointer + 4])
-        print("ECC Public Key Length: ", key_len)
-        str_pointer = str_pointer + 4
-        print("ECC Public Key",
-              bytes.hex(response_to_decode[str_pointer:str_pointer + key_len]))
+        result : Tuple[str, int]
+            The address and the port
 
-        print("Public/private separator: ",
-              response_to_decode[str_pointer + key_len:str_pointer + key_len + 1].decode('ascii', 'ignore'))
-        str_pointer = str_pointer + key_len + 1
-        print("ECC Private Key under LMK",
-              bytes.hex(response_to_decode[str_pointer:]))
+        Raises
+        ------
+        ValueError
+            If the address is missing or the port is not valid
+    """
+    address, _, port = spec.strip().rpartition(':')
+    if not address:
+        if default_address is None:
+            raise ValueError("the address is missing in " + spec)
+        address = default_address
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError("the port is not valid in " + spec)
+    return address, int(port)
 
 
-def payshield_error_codes(error_code: str) -> str:
-    """This function maps the result code with the error message.
-        I derived the list of errors and messages from the following manual:
-        payShield 10K Core Host Commands v1
-        Revision: A
-        Date: 04 August 2020
-        Doc.Number: PUGD0537 - 004
+def parse_targets(spec: str, default_port: int) -> list[Tuple[str, int, int]]:
+    """
+        It parses the payShields to send the commands to, in the form HOST[:PORT][/WEIGHT],... e.g.
+        10.0.0.5,10.0.0.6:1501/2
 
         Parameters
         ----------
-         error_code: str
-            The status code returned from the payShield 10k
+         spec: str
+            The payShields, separated by commas
+         default_port: int
+            The port of the payShields specified without it
 
-         Returns
-         -------
-         result : str
-          a string containing the message of the error code
-        """
+        Returns
+        -------
+        result : list[Tuple[str, int, int]]
+            The host, the port and the weight of each payShield. The weight is 1 if it is not specified
 
-    PAYSHIELD_ERROR_CODE: dict[str, str] = {
-        '00': 'No error',
-        '01': 'Verification failure or warning of imported key parity error',
-        '02': 'Key inappropriate length for algorithm',
-        '04': 'Invalid key type code',
-        '05': 'Invalid key length flag',
-        '10': 'Source key parity error',
-        '11': 'Destination key parity error or key all zeros',
-        '12': 'Contents of user storage not available. Reset, power-down or overwrite',
-        '13': 'Invalid LMK Identifier',
-        '14': 'PIN encrypted under LMK pair 02-03 is invalid',
-        '15': 'Invalid input data (invalid format, invalid characters, or not enough data provided)',
-        '16': 'Console or printer not ready or not connected',
-        '17': 'HSM not authorized, or operation prohibited by security settings',
-        '18': 'Document format definition not loaded',
-        '19': 'Specified Diebold Table is invalid',
-        '20': 'PIN block does not contain valid values',
-        '21': 'Invalid index value, or index/block count would cause an overflow condition',
-        '22': 'Invalid account number',
-        '23': 'Invalid PIN block format code. (Use includes where the security setting to implement PCI HSM '
-              'limitations on PIN Block format usage is applied, and a Host command attempts to convert a PIN Block '
-              'to a disallowed format.)',
-        '24': 'PIN is fewer than 4 or more than 12 digits in length',
-        '25': 'Decimalization Table error',
-        '26': 'Invalid key scheme',
-        '27': 'Incompatible key length',
-        '28': 'Invalid key type',
-        '29': 'Key function not permitted',
-        '30': 'Invalid reference number',
-        '31': 'Insufficient solicitation entries for batch',
-        '32': 'AES not licensed',
-        '33': 'LMK key change storage is corrupted',
-        '39': 'Fraud detection',
-        '40': 'Invalid checksum',
-        '41': 'Internal hardware/software error: bad RAM, invalid error codes, etc.',
-        '42': 'DES failure',
-        '43': 'RSA Key Generation Failure',
-        '46': 'Invalid tag for encrypted PIN',
-        '47': 'Algorithm not licensed',
-        '49': 'Private key error, report to supervisor',
-        '51': 'Invalid message header',
-        '65': 'Transaction Key Scheme set to None',
-        '67': 'Command not licensed',
-        '68': 'Command has been disabled',
-        '69': 'PIN block format has been disabled',
-        '74': 'Invalid digest info syntax (no hash mode only)',
-        '75': 'Single length key masquerading as double or triple length key',
-        '76': 'RSA public key length error or RSA encrypted data length error',
-        '77': 'Clear data block error',
-        '78': 'Private key length error',
-        '79': 'Hash algorithm object identifier error',
-        '80': 'Data length error. The amount of MAC data (or other data) is greater than or less than the expected '
-              'amount.',
-        '81': 'Invalid certificate header',
-        '82': 'Invalid check value length',
-        '83': 'Key block format error',
-        '84': 'Key block check value error',
-        '85': 'Invalid OAEP Mask Generation Function',
-        '86': 'Invalid OAEP MGF Hash Function',
-        '87': 'OAEP Parameter Error',
-        '90': 'Data parity error in the request message received by the HSM',
-        'A1': 'Incompatible LMK schemes',
-        'A2': 'Incompatible LMK identifiers',
-        'A3': 'Incompatible key block LMK identifiers',
-        'A4': 'Key block authentication failure',
-        'A5': 'Incompatible key length',
-        'A6': 'Invalid key usage',
-        'A7': 'Invalid algorithm',
-        'A8': 'Invalid mode of use',
-        'A9': 'Invalid key version number',
-        'AA': 'Invalid export field',
-        'AB': 'Invalid number of optional blocks',
-        'AC': 'Optional header block error',
-        'AD': 'Key status optional block error',
-        'AE': 'Invalid start date/time',
-        'AF': 'Invalid end date/time',
-        'B0': 'Invalid encryption mode',
-        'B1': 'Invalid authentication mode',
-        'B2': 'Miscellaneous key block error',
-        'B3': 'Invalid number of optional blocks',
-        'B4': 'Optional block data error',
-        'B5': 'Incompatible components',
-        'B6': 'Incompatible key status optional blocks',
-        'B7': 'Invalid change field',
-        'B8': 'Invalid old value',
-        'B9': 'Invalid new value',
-        'BA': 'No key status block in the key block',
-        'BB': 'Invalid wrapping key',
-        'BC': 'Repeated optional block',
-        'BD': 'Incompatible key types',
-        'BE': 'Invalid key block header ID',
-        'D2': 'Invalid curve reference',
-        'D3': 'Invalid Key Encoding',
-        'E0': 'Invalid command version number'
-    }
+        Raises
+        ------
+        ValueError
+            If a payShield is empty, or its port or its weight is not valid
+    """
+    targets = []
+    for item in spec.split(','):
+        endpoint, slash, weight = item.strip().partition('/')
+        if not endpoint:
+            raise ValueError("a payShield is missing in " + spec)
+        if slash and (not weight.isdigit() or int(weight) <= 0):
+            raise ValueError("the weight is not valid in " + item)
+        if ':' in endpoint:
+            host, port = parse_endpoint(endpoint)
+        else:
+            host, port = endpoint, default_port
+        targets.append((host, port, int(weight) if slash else 1))
+    return targets
+
+
+def send_json_line(connection: socket.socket, message: dict):
+    """
+        It sends the message to the coordinator or to the agent, as a line of JSON.
+    """
+    connection.sendall((json.dumps(message, default=str) + "\n").encode())
+
+
+def start_agents(args: argparse.Namespace, host_command: str | CommandMix, times: int | None,
+                 delay: float = 2.0) -> list[socket.socket]:
+    """
+        It connects to the agents listed in args.agents and sends them the test to run. Each agent runs it as a
+        worker, with its share of the commands, of the rate and of the profile.
+        All the agents start the load at the same time, delay seconds from now: the function returns at that time.
+        The clocks of the hosts running the agents need to be synchronized, e.g. with NTP.
+
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         times: int | None
+            The total number of commands to send. If None, the commands are sent forever
+         delay: float
+            The seconds given to the agents to receive the test and open their connections
+
+        Returns
+        -------
+        result : list[socket.socket]
+            The connections with the agents, in the order of args.agents
 
-    return PAYSHIELD_ERROR_CODE.get(error_code, "Unknown error")
+        Raises
+        ------
+        OSError
+            If an agent cannot be reached
+    """
+    start_at = time.time() + delay
+    if isinstance(host_command, CommandMix):
+        command = {"commands": host_command.commands, "weights": host_command.weights,
+                   "ring": isinstance(host_command, CommandRing)}
+    else:
+        command = host_command
+    connections = []
+    try:
+        for agent_id, (address, port) in enumerate(args.agents):
+            try:
+                connection = socket.create_connection((address, port), timeout=args.connect_timeout)
+            except OSError as e:
+                raise OSError("the agent " + address + ":" + str(port) + " cannot be reached: " + str(e))
+            connections.append(connection)
+            connection.settimeout(None)
+            send_json_line(connection, {"version": VERSION, "args": vars(args), "command": command,
+                                        "agent": agent_id, "agents": len(args.agents),
+                                        "times": split_times(times, len(args.agents), agent_id), "start_at": start_at})
+    except OSError:
+        for connection in connections:
+            connection.close()
+        raise
+    time.sleep(max(0.0, start_at - time.time()))
+    return connections
+
+
+def run_agents(connections: list[socket.socket], agent_stats: list[LoadStats]) -> list[LoadStats]:
+    """
+        It collects the counters streamed by the agents started by start_agents, until all of them sent the final
+        ones. While the test runs, agent_stats is kept updated with the latest snapshot of each agent.
+        If the coordinator is interrupted, the agents are asked to stop and their final counters are waited for.
 
+        Parameters
+        ----------
+         connections: list[socket.socket]
+            The connections with the agents, returned by start_agents
+         agent_stats: list[LoadStats]
+            The list, with one element for each agent, where the counters of the agents are stored
 
-def check_returned_command_verb(result_returned: bytes, head_len: int, command_sent: str) -> Tuple[int, str, str]:
+        Returns
+        -------
+        result : list[LoadStats]
+            The agent_stats passed, containing the final counters of each agent
     """
-    Checks if the command returned by the payShield is congruent to the command sent
-    Parameters
-    ----------
-    result_returned: bytes
-        The output returned from the payShield
-    head_len: int
-        The length of the header
-    command_sent: str
-        The command sent to the payShield
+    messages = queue.Queue()
 
-    Returns
-    -------
-    result : tuple
-        a Tuple[int, str, str]
-        where the first value is 0 of the command is congruent or -1 if it is not.
-        the second value is the command sent.
-        the third value is the command returned by the payShield.
+    def receive(agent_id: int, connection: socket.socket):
+        try:
+            for line in connection.makefile('r', encoding='utf-8'):
+                messages.put((agent_id, json.loads(line)))
+        except (OSError, ValueError):
+            pass
+        # the end of the stream is signalled in any case
+        messages.put((agent_id, None))
+
+    for agent_id, connection in enumerate(connections):
+        threading.Thread(target=receive, args=(agent_id, connection), daemon=True).start()
+    finished = set()
+    deadline = None
+    while len(finished) < len(connections):
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        try:
+            agent_id, message = messages.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            # the agents are asked to stop: give them some time to send their final counters
+            deadline = time.perf_counter() + 5
+            for connection in connections:
+                try:
+                    send_json_line(connection, {"kind": "stop"})
+                except OSError:
+                    pass
+            continue
+        if message is None:
+            if agent_id not in finished:
+                print("Agent", agent_id + 1, "disconnected before sending its final counters")
+                finished.add(agent_id)
+            continue
+        if "error" in message:
+            print("Agent", agent_id + 1, "cannot run the test:", message["error"])
+            continue
+        agent_stats[agent_id] = LoadStats.from_dict(message["stats"])
+        if message["kind"] == 'final':
+            finished.add(agent_id)
+    for connection in connections:
+        connection.close()
+    return agent_stats
+
+
+def serve_agent(address: str, port: int):
     """
+        It runs the agent: it waits for a coordinator started with --agents, runs the test it receives, streams the
+        counters back, and then waits for the next coordinator. It runs until it is interrupted.
+        Only JSON is exchanged with the coordinator, but the agent sends commands to any payShield the coordinator
+        asks for, so it has to listen only on a trusted network.
 
-    verb_returned = result_returned[2 + head_len:][:2]
-    verb_sent = command_sent[head_len:][:2]
-    verb_expected = verb_sent[0:1] + chr(ord(verb_sent[1:2]) + 1)
-    if verb_returned != verb_expected.encode():
-        return -1, verb_sent, verb_returned.decode()
+        Parameters
+        ----------
+         address: str
+            The address to listen on
+         port: int
+            The port to listen on
+    """
+    server = socket.create_server((address, port))
+    print("Agent listening on", address, "port", port)
+    try:
+        while True:
+            connection, peer = server.accept()
+            print("Coordinator connected from", peer[0])
+            try:
+                run_agent_job(connection)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print("The test cannot be run:", e)
+                try:
+                    send_json_line(connection, {"error": str(e)})
+                except OSError:
+                    pass
+            finally:
+                connection.close()
+            print("Test completed, waiting for the next coordinator")
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        server.close()
+
+
+def run_agent_job(connection: socket.socket):
+    """
+        It runs the test received from the coordinator in a worker process, and sends to the coordinator the
+        snapshots of its counters every second, and the final counters.
+        The worker is interrupted if the coordinator asks to stop or disconnects.
+
+        Parameters
+        ----------
+         connection: socket.socket
+            The connection with the coordinator
+    """
+    reader = connection.makefile('r', encoding='utf-8')
+    job = json.loads(reader.readline())
+    if job.get("version") != VERSION:
+        print("WARNING: the coordinator runs the version", job.get("version"), "and this agent the version", VERSION)
+    args = argparse.Namespace(**job["args"])
+    for name in ('keyfile', 'crtfile', 'results_file'):
+        if getattr(args, name, None) is not None:
+            setattr(args, name, Path(getattr(args, name)))
+    # the agent is one of the workers of the coordinator, and the outputs are printed by the coordinator
+    args.workers = job["agents"]
+    args.quiet = True
+    command = job["command"]
+    if isinstance(command, dict):
+        decoders = [PARSERS.get(verb[len(args.header):len(args.header) + 2]) if args.decode else None
+                    for verb in command["commands"]]
+        if command.get("ring"):
+            host_command = CommandRing(command["commands"], decoders)
+        else:
+            host_command = CommandMix(command["commands"], command["weights"], decoders)
     else:
-        return 0, verb_sent, verb_returned.decode()
+        host_command = command
+    profile = LoadProfile.parse(args.profile) if args.profile is not None else None
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_worker, args=(job["agent"], args, host_command, profile,
+                                                               job["times"], result_queue, job["start_at"]),
+                                      daemon=True)
+    process.start()
+    stop = threading.Event()
+
+    def wait_stop():
+        try:
+            for line in reader:
+                if json.loads(line).get("kind") == "stop":
+                    break
+        except (OSError, ValueError):
+            pass
+        # the coordinator asked to stop, or disconnected
+        stop.set()
+
+    threading.Thread(target=wait_stop, daemon=True).start()
+    interrupted = False
+    while True:
+        if stop.is_set() and not interrupted:
+            interrupted = True
+            # the worker sends its final counters when it is interrupted
+            os.kill(process.pid, signal.SIGINT)
+        try:
+            kind, _, stats = result_queue.get(timeout=0.5)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+            continue
+        try:
+            send_json_line(connection, {"kind": kind, "stats": stats.to_dict()})
+        except OSError:
+            stop.set()
+        if kind == 'final':
+            break
+    process.join(5)
 
 
-def check_return_message(result_returned: bytes, head_len: int) -> Tuple[str, str]:
-    if len(result_returned) < 2 + head_len + 2:  # 2 bytes for len + 2 header len + 2 for command
-        return "ZZ", "Incomplete message"
-    # decode the first two bytes returned and transform them in integer
-    try:
-        expected_msg_len = int.from_bytes(result_returned[:2], byteorder='big', signed=False)
-    except ValueError:
-        return "ZZ", "Malformed message"
-    except Exception:
-        return "ZZ", "Unknown message length parsing error"
+def close_results(results: ResultsWriter | None):
+    """
+        It closes the results file, if any, and prints how many records were written.
 
-    # compares the effective message length with then one stated in the first two bytes of the message
-    if len(result_returned) - 2 != expected_msg_len:
-        return "ZZ", "Length mismatch"
-    ret_code_position = 2 + head_len + 2
+        Parameters
+        ----------
+         results: ResultsWriter | None
+            The results file, or None if --results-file was not specified
+    """
+    if results is not None:
+        results.close()
+        print("Results file:", results.path, "-", results.records, "records written")
 
-    # better be safe than sorry
-    try:
-        # ret_code = int(result_returned[ret_code_position:ret_code_position + 2])
-        ret_code = result_returned[ret_code_position:ret_code_position + 2].decode()
-    except (ValueError, UnicodeDecodeError):
-        return "ZZ", "message result code parsing error"
-    except Exception:
-        return "ZZ", "Unknown message result code parsing error"
 
-    # try to describe the error
-    return ret_code, payshield_error_codes(ret_code)
+def report_status(stats_list: list[LoadStats], interval: float, stop_event: threading.Event):
+    """
+        It prints one line with the progress of the test every interval seconds, until the stop_event is set.
+        It is meant to run in its own thread, reading the counters while the connections update them.
 
+        Parameters
+        ----------
+         stats_list: list[LoadStats]
+            The counters of each connection
+         interval: float
+            How many seconds between two lines
+         stop_event: threading.Event
+            When set, the function returns
+    """
+    start_time = last_time = time.perf_counter()
+    last_operations = 0
+    while not stop_event.wait(interval):
+        now = time.perf_counter()
+        operations = sum(stats.operations for stats in stats_list)
+        errors = sum(stats.errors for stats in stats_list)
+        lost = sum(stats.timeouts for stats in stats_list)
+        reordered = sum(stats.reordered for stats in stats_list)
+        print(f"[{now - start_time:.0f}s] operations: {operations} errors: {errors} "
+              f"throughput: {(operations - last_operations) / (now - last_time):.1f} TPS" +
+              (f" lost: {lost} reordered: {reordered}" if lost or reordered else ""))
+        last_operations, last_time = operations, now
+
+
+def print_load_summary(stats_list: list[LoadStats], elapsed: float, target_rate: float | None = None,
+                       profile: LoadProfile | None = None, label: str = "Connection", delivery: bool = False):
+    """
+        It prints the counters, the throughput and the latency percentiles of every connection,
+        and the aggregated ones, overall, per command verb and per payShield of the cluster.
 
-def test_printable(input_str):
-    return all(c in string.printable for c in input_str)
+        Parameters
+        ----------
+         stats_list: list[LoadStats]
+            The counters collected by each connection
+         elapsed: float
+            The duration of the test in seconds, used to calculate the throughput
+         target_rate: float | None
+            In open-loop mode, the rate requested, compared with the throughput achieved
+         profile: LoadProfile | None
+            If a load profile was used, the counters of each stage are printed as well
+         label: str
+            How the elements of stats_list are named in the output, e.g. Connection or Worker
+         delivery: bool
+            If True, the rate of the responses lost, late and out of order is always printed, as it is expected
+            with udp. Otherwise, it is printed only if some responses arrived late or out of order
+    """
+    elapsed = max(elapsed, 1e-9)
+    total = LoadStats()
+    for connection_id, stats in enumerate(stats_list):
+        total.merge(stats)
+        if len(stats_list) > 1:
+            print(f"{label} {connection_id + 1} - operations: {stats.operations} errors: {stats.errors} "
+                  f"throughput: {stats.operations / elapsed:.1f} TPS latency: {stats.latency.summary()}")
+            if stats.timeouts or stats.resets or stats.connect_errors:
+                print(f" {stats.connection_health()}")
+    print(f"Total operations: {total.operations} errors: {total.errors} "
+          f"throughput: {total.operations / elapsed:.1f} TPS")
+    print(f" Latency: {total.latency.summary()}")
+    if total.timeouts or total.resets or total.connect_errors:
+        print(f" {total.connection_health()}")
+    if delivery or total.late or total.reordered:
+        print(f" {total.delivery()}")
+    if total.connect_latency.total > 0:
+        print(f" Connect: {total.connect_latency.total} connections latency: {total.connect_latency.summary()}")
+    if total.handshake_latency.total > 0:
+        print(f" TLS handshake: {total.handshake_latency.total} handshakes ({total.resumed} resumed) "
+              f"latency: {total.handshake_latency.summary()}")
+    if target_rate is not None:
+        achieved_rate = total.operations / elapsed
+        print(f" Target rate: {target_rate:.1f} TPS achieved: {achieved_rate:.1f} TPS "
+              f"({max(0.0, 100 - achieved_rate * 100 / target_rate):.1f}% behind)")
+        print(f" Schedule lag: {total.schedule_lag.summary()}")
+    if profile is not None:
+        print(f" Schedule lag: {total.schedule_lag.summary()}")
+        for stage, stage_stats in sorted(total.stages.items()):
+            stage_duration = profile.stages[stage % len(profile.stages)][3]
+            print(f" {profile.describe(stage)} - operations: {stage_stats.operations} errors: {stage_stats.errors} "
+                  f"throughput: {stage_stats.operations / stage_duration:.1f} TPS "
+                  f"latency: {stage_stats.latency.summary()}")
+    for return_code, count in sorted(total.return_codes.items()):
+        print(f" Return code {return_code} ({payshield_error_codes(return_code)}): {count}")
+    for verb, verb_stats in sorted(total.verbs.items()):
+        print(f" Command {verb} - operations: {verb_stats.operations} errors: {verb_stats.errors} "
+              f"throughput: {verb_stats.operations / elapsed:.1f} TPS latency: {verb_stats.latency.summary()}")
+    for target, target_stats in sorted(total.targets.items()):
+        print(f" Target {target} - operations: {target_stats.operations} "
+              f"({target_stats.operations * 100 / max(total.operations, 1):.1f}%) errors: {target_stats.errors} "
+              f"throughput: {target_stats.operations / elapsed:.1f} TPS latency: {target_stats.latency.summary()}")
+
+
+def query_status(connector: PayConnector, header: str) -> NoResponse | None:
+    """
+        It asks the payShield its status with the command NO, mode 00.
 
+        Parameters
+        ----------
+         connector: PayConnector
+            The connection used to send the command. It is closed afterwards
+         header: str
+            The header of the command
 
-def hex2ip(hex_ip):
-    addr_long = int(hex_ip, 16)
-    hex_ip = socket.inet_ntoa(pack(">L", addr_long))
-    return hex_ip
+        Returns
+        -------
+        result : NoResponse | None
+            The status, or None if the payShield did not return it
+    """
+    data = connector.send_command(header + 'NO00')
+    connector.close()
+    if data is None:
+        return None
+    try:
+        response = parse_no(data, len(header))
+    except (ValueError, IndexError):
+        return None
+    return response if response.header.error_code == '00' else None
 
 
-def run_test(payConnectorInstance: PayConnector, host_command: str, header_len: int = 4,
-             decoder_funct: FunctionType = None) -> str:
+def query_tcp_sockets(connector: PayConnector, header: str) -> int | None:
     """
-        It connects to the specified host and port, using the specified protocol (tcp, udp, or tls) and sends the command.
+        It asks the payShield, with the command NO, how many TCP sockets its host port supports.
 
         Parameters
         ----------
-         payConnectorInstance: PayConnector
-            The instance of the PayConnector class
-         host_command: str
-            The command to send to the payShield complete of the header part
-         header_len: int
-            The length of the header. If not specified, the value is 4 because it is the default factory value
-            in payShield 10k
-         decoder_funct: FunctionType
-            If provided needs to be a reference to a function that is able to parse the command and print the meaning of it
-            If it is not provided, the default is None
+         connector: PayConnector
+            The connection used to send the command. It is closed afterwards
+         header: str
+            The header of the command
 
         Returns
         -------
-        result : str
-            The return code from the command
+        result : int | None
+            The number of TCP sockets, or None if the payShield did not report it
     """
-    return_code_tuple = ['ZZ', 'Error']
-    try:
+    response = query_status(connector, header)
+    if response is None or response.tcp_sockets is None or not response.tcp_sockets.isdigit():
+        return None
+    return int(response.tcp_sockets)
 
-        # calculate the size and format it correctly
-        size = pack('>h', len(host_command))
 
-        # join everything together in python3
-        message = size + host_command.encode()
-        # Connect to the host and gather the reply in TCP or UDP
-        data = payConnectorInstance.send_command(host_command)
-        # If no data is returned
-        if data is None:
-            return 'Error'
+def query_buffer_size(connector: PayConnector, header: str) -> int | None:
+    """
+        It asks the payShield, with the command NO, the size of the I/O buffer of its host port, that is the
+        largest message it accepts.
 
-        # try to decode the result code contained in the reply of the payShield
-        check_result_tuple = (-1, "", "")
-        return_code_tuple = check_return_message(data, header_len)
-        if return_code_tuple[0] != "ZZ":
-            print()
-            check_result_tuple = check_returned_command_verb(data, header_len, host_command)
+        Parameters
+        ----------
+         connector: PayConnector
+            The connection used to send the command. It is closed afterwards
+         header: str
+            The header of the command
 
-        print("Return code: " + str(return_code_tuple[0]) + " " + return_code_tuple[1])
-        if check_result_tuple[0] != 0:
-            print("NOTE: The response received from the HSM seems unrelated to the request!")
+        Returns
+        -------
+        result : int | None
+            The size of the buffer in bytes, or None if the payShield did not report it
+    """
+    response = query_status(connector, header)
+    if response is None:
+        return None
+    return {'0': 2048, '1': 8192, '2': 16384, '3': 32768}.get(response.buffer_size)
 
-        print("Command sent/received: " + check_result_tuple[1] + " ==> " + check_result_tuple[2])
 
-        # don't print ascii if msg or resp contains non printable chars
-        if test_printable(message[2:].decode("ascii", "ignore")):
-            print("sent data (ASCII) :", message[2:].decode("ascii", "ignore"))
+def print_churn_summary(stats_list: list[LoadStats], elapsed: float, tcp_sockets: int | None):
+    """
+        It prints the rate the connections were opened at, how long each one stayed open and, if the number of TCP
+        sockets of the payShield is known, the highest connection rate they can sustain.
+        A socket is taken from the first byte of the connection to its close, so the sockets in use on average are
+        the rate multiplied by the lifetime, and the table is full when they reach the number of TCP sockets.
 
-        print("sent data (HEX) :", bytes.hex(message))
+        Parameters
+        ----------
+         stats_list: list[LoadStats]
+            The counters collected by each connection
+         elapsed: float
+            The duration of the test in seconds
+         tcp_sockets: int | None
+            The number of TCP sockets reported by the command NO, if available
+    """
+    total = LoadStats()
+    for stats in stats_list:
+        total.merge(stats)
+    if total.connects == 0:
+        return
+    elapsed = max(elapsed, 1e-9)
+    rate = total.connects / elapsed
+    lifetime = total.open_us / total.connects / 1000000
+    print(f"Churn: {total.connects} connections at {rate:.1f} connections/s - socket lifetime: {lifetime * 1000:.3f} ms "
+          f"- sockets open on average: {total.open_us / 1000000 / elapsed:.2f}")
+    if tcp_sockets is None:
+        print(" The number of TCP sockets of the payShield is not known: the NO command failed")
+    elif lifetime > 0:
+        max_rate = tcp_sockets / lifetime
+        print(f" The {tcp_sockets} TCP sockets of the payShield sustain at most {max_rate:.1f} connections/s "
+              f"with this socket lifetime - used: {rate * 100 / max_rate:.1f}%")
+
+
+def run_sweep(args: argparse.Namespace, sizes: list[int], connection_counts: list[int],
+              sweep_results: Dict[Tuple[int, int], Tuple[LoadStats, float]],
+              results: ResultsWriter | None = None) -> Dict[Tuple[int, int], Tuple[LoadStats, float]]:
+    """
+        It runs the command B2 for every payload size and number of connections specified, sending args.times
+        commands in each combination, with the engine and the rate specified by the command line arguments.
+        A line with the throughput and the latency is printed after each combination.
 
-        if test_printable((data[2:]).decode("ascii", "ignore")):
-            print("received data (ASCII):", data[2:].decode("ascii", "ignore"))
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         sizes: list[int]
+            The sizes of the payloads, in bytes
+         connection_counts: list[int]
+            The numbers of connections
+         sweep_results: Dict[Tuple[int, int], Tuple[LoadStats, float]]
+            Where the results are stored: for each size and number of connections, the counters of all the
+            connections and the duration in seconds. It is passed by the caller, so the combinations run so far
+            can be read after an interruption
+         results: ResultsWriter | None
+            If provided, every command is written in the results file, with the number of the connection
 
-        print("received data (HEX) :", bytes.hex(data))
-        if (decoder_funct is not None) and callable(decoder_funct):
-            print("")
-            print("-----DECODING RESPONSE-----")
-            decoder_funct(data, header_len)
+        Returns
+        -------
+        result : Dict[Tuple[int, int], Tuple[LoadStats, float]]
+            The sweep_results passed
+    """
+    payload = args.echo or "PayShieldStress Echo Test"
+    decoder = PARSERS['B2'] if args.decode else None
+    for size in sizes:
+        if args.generate:
+            host_command = CommandRing.generate(b2_generator(lambda rng, size=size: size), args.header,
+                                                args.ring_size, decoder)
+        else:
+            host_command = args.header + b2_command((payload * (size // len(payload) + 1))[:size])
+        for connections in connection_counts:
+            cell_args = argparse.Namespace(**{**vars(args), "connections": connections})
+            connectors = create_connectors(cell_args)
+            stats_list = [LoadStats(connection_id + 1, results) for connection_id in range(connections)]
+            start = time.perf_counter()
+            try:
+                run_configured_load(cell_args, connectors, host_command, args.times, stats_list, None, decoder)
+            finally:
+                elapsed = time.perf_counter() - start
+                if args.pipeline is None:
+                    for connector in connectors:
+                        connector.close()
+                total = LoadStats()
+                for stats in stats_list:
+                    total.merge(stats)
+                sweep_results[(size, connections)] = (total, elapsed)
+            print(f"B2 {size} bytes, {connections} connections - operations: {total.operations} "
+                  f"errors: {total.errors} throughput: {total.operations / max(elapsed, 1e-9):.1f} TPS "
+                  f"latency: {total.latency.summary()}")
+    return sweep_results
+
+
+def print_sweep_matrix(sweep_results: Dict[Tuple[int, int], Tuple[LoadStats, float]], sizes: list[int],
+                       connection_counts: list[int]):
+    """
+        It prints the results of run_sweep as three matrices, with a row for each payload size and a column for each
+        number of connections: the throughput, the bandwidth of the payloads echoed and the p99 latency.
 
-    except ConnectionError as e:
-        print("Connection issue: ", e)
-    except FileNotFoundError as e:
-        print("The client certificate file or the client key file cannot be found or accessed.\n" +
-              "Check value passed to the parameters --keyfile and --crtfile", e)
-    except Exception as e:
-        print("Unexpected issue:", e)
+        Parameters
+        ----------
+         sweep_results: Dict[Tuple[int, int], Tuple[LoadStats, float]]
+            The results returned by run_sweep
+         sizes: list[int]
+            The sizes of the payloads, in bytes
+         connection_counts: list[int]
+            The numbers of connections
+    """
+    errors = False
+    matrices = (("Throughput (TPS)", lambda stats, elapsed, size: f"{stats.operations / elapsed:.1f}"),
+                ("Payload bandwidth (MB/s), each way",
+                 lambda stats, elapsed, size: f"{(stats.operations - stats.errors) * size / elapsed / 1000000:.2f}"),
+                ("Latency p99 (ms)", lambda stats, elapsed, size: f"{stats.latency.percentile(99) / 1000:.3f}"))
+    for title, cell in matrices:
+        print("")
+        print("B2 sweep - " + title)
+        print(f"{'payload bytes':>14}" + "".join(f"{str(connections) + ' conn':>14}"
+                                                 for connections in connection_counts))
+        for size in sizes:
+            row = f"{size:>14}"
+            for connections in connection_counts:
+                if (size, connections) not in sweep_results:
+                    row = row + f"{'-':>14}"
+                    continue
+                stats, elapsed = sweep_results[(size, connections)]
+                mark = "*" if stats.errors else ""
+                errors = errors or stats.errors > 0
+                row = row + f"{cell(stats, max(elapsed, 1e-9), size) + mark:>14}"
+            print(row)
+    if errors:
+        print("* some commands failed: see the lines printed for each combination")
+
+
+def run_rate_step(args: argparse.Namespace, host_command: str | CommandMix, rate: float, duration: float,
+                  decoder_funct: FunctionType = None, sampler: HsmSampler | None = None,
+                  results: ResultsWriter | None = None) -> Tuple[LoadStats, float, HsmSample | None]:
+    """
+        It sends the command at the rate specified for the duration specified, on new connections, and measures
+        the load of the payShield in the meantime.
+
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         rate: float
+            The total number of commands per second
+         duration: float
+            The seconds the rate is kept
+         decoder_funct: FunctionType
+            If provided, it is used to validate the responses
+         sampler: HsmSampler | None
+            If provided, it reads the loading of the payShield, with J2, at the start and at the end of the step
+         results: ResultsWriter | None
+            If provided, every command is written in the results file
 
+        Returns
+        -------
+        result : Tuple[LoadStats, float, HsmSample | None]
+            The counters of all the connections, the duration in seconds, and the loading of the payShield during
+            the step, or None if it is not available
+    """
+    step_args = argparse.Namespace(**{**vars(args), "rate": rate})
+    connectors = create_connectors(step_args)
+    stats_list = [LoadStats(connection_id + 1, results) for connection_id in range(len(connectors))]
+    sample = None
+    if sampler is not None:
+        sampler.stats_list = stats_list
+        try:
+            # the first reading only marks the start of the step
+            sampler.sample()
+        except (ConnectionError, ValueError, IndexError, OSError) as e:
+            print("[HSM] the J2 loading cannot be read:", e)
+            sampler = None
+    start = time.perf_counter()
+    try:
+        run_configured_load(step_args, connectors, host_command, max(1, round(rate * duration)), stats_list, None,
+                            decoder_funct)
     finally:
-        return return_code_tuple[0]
+        elapsed = time.perf_counter() - start
+        if args.pipeline is None:
+            for connector in connectors:
+                connector.close()
+    if sampler is not None:
+        try:
+            sample = sampler.sample()
+        except (ConnectionError, ValueError, IndexError, OSError) as e:
+            print("[HSM] the J2 loading cannot be read:", e)
+    total = LoadStats()
+    for stats in stats_list:
+        total.merge(stats)
+    return total, elapsed, sample
+
+
+def find_max_rate(args: argparse.Namespace, host_command: str | CommandMix, steps: list,
+                  decoder_funct: FunctionType = None, sampler: HsmSampler | None = None,
+                  results: ResultsWriter | None = None, precision: float = 0.05) -> list:
+    """
+        It searches the highest rate the payShield sustains with the p99 latency and the error rate under the
+        thresholds of the command line arguments. The rate starts from --rate, or 100 TPS, and doubles at every step
+        until a step fails, then the highest passing rate is searched with a binary search, until the lowest failing
+        rate is within precision of it. A step fails also if the client could not keep up with the rate.
+
+        Parameters
+        ----------
+         args: argparse.Namespace
+            The parsed command line arguments
+         host_command: str | CommandMix
+            The command to send to the payShield complete of the header part, or the mix of commands to pick from
+         steps: list
+            Where the steps are appended, as tuples of rate, counters, duration, loading of the payShield and the
+            reason of the failure, or None if the step passed. It is passed by the caller, so the steps run so far
+            can be read after an interruption
+         decoder_funct: FunctionType
+            If provided, it is used to validate the responses
+         sampler: HsmSampler | None
+            If provided, the loading of the payShield is read during each step
+         results: ResultsWriter | None
+            If provided, every command is written in the results file
+         precision: float
+            The search stops when the lowest failing rate is less than this fraction above the highest passing one
+
+        Returns
+        -------
+        result : list
+            The steps passed
+    """
+    highest_passed = lowest_failed = None
+    rate = args.rate if args.rate is not None else 100.0
+    while True:
+        stats, elapsed, sample = run_rate_step(args, host_command, rate, args.step_duration, decoder_funct, sampler,
+                                               results)
+        elapsed = max(elapsed, 1e-9)
+        achieved = stats.operations / elapsed
+        error_rate = stats.errors * 100 / max(stats.operations, 1)
+        p99 = stats.latency.percentile(99)
+        failure = None
+        if error_rate > args.max_error_rate:
+            failure = f"error rate above {args.max_error_rate:g}%"
+        elif p99 > args.max_p99 * 1000:
+            failure = f"p99 above {args.max_p99:g} ms"
+        elif achieved < rate * 0.95:
+            failure = "the client could not keep up with the rate: add --connections or --pipeline"
+        steps.append((rate, stats, elapsed, sample, failure))
+        line = (f"Step {len(steps)}: target {rate:.1f} TPS - achieved {achieved:.1f} TPS p99={p99 / 1000:.3f} ms "
+                f"errors: {error_rate:.2f}%")
+        if sample is not None and sample.utilisation is not None:
+            line = line + f" HSM utilisation: {sample.utilisation:.1f}%"
+        print(line + (" - OK" if failure is None else " - failed: " + failure))
+        if failure is None:
+            highest_passed = rate
+        else:
+            lowest_failed = rate
+        if lowest_failed is None:
+            rate = rate * 2
+        elif highest_passed is None:
+            rate = rate / 2
+            if rate < 1:
+                break
+        elif lowest_failed - highest_passed <= highest_passed * precision:
+            break
+        else:
+            rate = (highest_passed + lowest_failed) / 2
+    return steps
+
+
+def print_find_max_summary(steps: list):
+    """
+        It prints the capacity found by find_max_rate: the highest rate that passed, with the throughput and the
+        latency of each command at that rate, and the loading of the payShield.
+
+        Parameters
+        ----------
+         steps: list
+            The steps returned by find_max_rate
+    """
+    print("")
+    passed = [step for step in steps if step[4] is None]
+    if not passed:
+        if steps:
+            print(f"No rate met the thresholds, down to {min(step[0] for step in steps):.1f} TPS")
+        return
+    rate, stats, elapsed, sample, _ = max(passed, key=lambda step: step[0])
+    print(f"Maximum sustainable throughput: {stats.operations / elapsed:.1f} TPS (target {rate:.1f} TPS) "
+          f"errors: {stats.errors} latency: {stats.latency.summary()}")
+    for verb, verb_stats in sorted(stats.verbs.items()):
+        print(f" Command {verb} - capacity: {verb_stats.operations / elapsed:.1f} TPS "
+              f"latency: {verb_stats.latency.summary()}")
+    if sample is None or sample.utilisation is None:
+        print(" HSM utilisation (J2): not available")
+    else:
+        print(f" HSM utilisation (J2): {sample.utilisation:.1f}% (mostly {sample.busiest_range})")
+        if sample.utilisation < HsmSampler.SATURATION:
+            print(" The HSM was not saturated: the limit was the client, the network or the thresholds")
+    failed = [step for step in steps if step[4] is not None and step[0] > rate]
+    if failed:
+        failed_step = min(failed, key=lambda step: step[0])
+        print(f" The lowest rate above it that was tried, {failed_step[0]:.1f} TPS, failed: {failed_step[4]}")
 
 
 def common_parser(response_to_decode: bytes, head_len: int) -> Tuple[str, int, int]:
     """
-        This function is a helper used by the decode_XX functions.
+        This function is the legacy printing helper, no longer used by the decoders, that are built on parse_header:
+        it is kept because pressureBench measures it.
         It converts the response_to_decode in ascii, calculates and prints the message size and
         prints the header, the command returned, and the error code.
 
@@ -1011,16 +5538,9 @@ def common_parser(response_to_decode: bytes, head_len: int) -> Tuple[str, int, i
         str_pointer : int
             the pointer (position) of the last interpreted/parsed character of the message_to_decode
     """
-    msg_len = int.from_bytes(response_to_decode[:2], byteorder='big', signed=False)
-    print("Message length: ", msg_len)
-    response_to_decode = response_to_decode.decode('ascii', 'replace')
-    str_pointer: int = 2
-    print("Header: ", response_to_decode[str_pointer:str_pointer + head_len])
-    str_pointer = str_pointer + head_len
-    print("Command returned: ", response_to_decode[str_pointer:str_pointer + 2])
-    str_pointer = str_pointer + 2
-    print("Error returned: ", response_to_decode[str_pointer:str_pointer + 2])
-    return response_to_decode, msg_len, str_pointer
+    header, reader = parse_header(response_to_decode, head_len)
+    print_header(header)
+    return response_to_decode.decode('ascii', 'replace'), header.length, 2 + head_len + 2
     # End
 
 
@@ -1221,11 +5741,13 @@ if __name__ == "__main__":
         description="Generates workload on PayShield 10k and 9k for the sake of testing and demonstration.",
         epilog="For any questions, feedback, suggestions or sending money (yes...it's a dream, I know), you can contact "
                "the author at msz@msz.eu")
-    parser.add_argument("host", help="Ip address or hostname of the payShield")
+    parser.add_argument("host", help="Ip address or hostname of the payShield. Not used with --agent. "
+                                     "To load a cluster, a comma separated list of HOST[:PORT][/WEIGHT].", nargs='?')
     group = parser.add_mutually_exclusive_group()
     parser.add_argument("--port", "-p", help="The host port. "
                                              "If not specified the default port is 1500.", default=1500, type=int)
-    group.add_argument("--key", help="RSA key length. Accepted values are between 320 and 4096.", type=int)
+    group.add_argument("--key", help="RSA key length. Accepted values are between 320 and 4096. With --generate, "
+                                     "a comma separated list of lengths to rotate.", type=str)
     group.add_argument("--nc", help="Perform a NC test.",
                        action="store_true")
     group.add_argument("--no", help="Retrieve HSM status information using NO command.",
@@ -1256,6 +5778,8 @@ if __name__ == "__main__":
                        help="Generate an ECC public/private key pair using the Elliptic Curve algorithm curve NIST "
                             "P-521.",
                        action="store_true")
+    group.add_argument("--scenario", help="JSON (or YAML) file listing the commands to send, each one with its "
+                                          "weight, e.g. 70%% JA, 20%% N0, 10%% FY.", type=Path)
     parser.add_argument("--ecc-curve", help="select the ECC curve.", default='0', type=str, choices=['0', '1', '2'])
     parser.add_argument("--key-use", help="Select the key mode of use.", default='S', type=str.upper,
                         choices=['S', 'X', 'N'])
@@ -1279,7 +5803,89 @@ if __name__ == "__main__":
                         default="client.crt")
     parser.add_argument("--echo", help="Payload sent using the echo command B2.", type=str,
                         default="PayShieldStress Echo Test", action="store")
+    parser.add_argument("--generate", help="Generates the variable fields of the commands before the test: random "
+                                           "PANs with a valid check digit for --pingen, random payloads for --b2, "
+                                           "rotating key lengths for --key.", action="store_true")
+    parser.add_argument("--echo-size", help="With --b2 and --generate, the size of the payloads: fixed:SIZE, "
+                                            "uniform:MIN:MAX, exp:MEAN or normal:MEAN:STDDEV. If not specified the "
+                                            "size of --echo is used.", type=str)
+    parser.add_argument("--ring-size", help="With --generate, how many different commands are generated and sent in "
+                                            "turn. If not specified the default is 1024.", type=int, default=1024)
+    parser.add_argument("--sweep", help="With --b2, runs --times commands for every payload size of --sweep-sizes "
+                                        "and number of connections of --sweep-connections, and prints the "
+                                        "throughput and the latency as a matrix.", action="store_true")
+    parser.add_argument("--sweep-sizes", help="Comma separated payload sizes in bytes used by --sweep, limited by "
+                                              "the I/O buffer of the payShield. If not specified the default is "
+                                              "16,64,256,1024,4096,16384,32768.", type=str,
+                        default="16,64,256,1024,4096,16384,32768")
+    parser.add_argument("--sweep-connections", help="Comma separated numbers of connections used by --sweep. "
+                                                    "If not specified the default is 1,4,16.", type=str,
+                        default="1,4,16")
+    parser.add_argument("--find-max", help="Searches the highest rate, starting from --rate, with the p99 latency "
+                                           "and the error rate under --max-p99 and --max-error-rate.",
+                        action="store_true")
+    parser.add_argument("--max-p99", help="With --find-max, the highest p99 latency allowed, in milliseconds. "
+                                          "If not specified the default is 100.", type=float, default=100)
+    parser.add_argument("--max-error-rate", help="With --find-max, the highest percentage of errors allowed. "
+                                                 "If not specified the default is 0.1.", type=float, default=0.1)
+    parser.add_argument("--step-duration", help="With --find-max, the seconds each rate is kept. "
+                                                "If not specified the default is 10.", type=float, default=10)
     parser.add_argument("--timing", help="Measure the time consumed by the operations", action="store_true")
+    parser.add_argument("--connections", help="How many concurrent connections to open towards the payShield. "
+                                              "If not specified the default is 1.", type=int, default=1)
+    parser.add_argument("--pipeline", help="Use the asyncio engine, keeping up to PIPELINE commands in flight on "
+                                           "each connection. The header is replaced with a sequence number.",
+                        type=int, metavar="PIPELINE")
+    parser.add_argument("--quiet", "--summary-only", help="Do not print anything for each command, "
+                                                          "only a periodic status line and the final summary.",
+                        action="store_true")
+    parser.add_argument("--status-interval", help="Seconds between two status lines in --quiet mode. "
+                                                  "If not specified the default is 5. 0 disables the status line.",
+                        type=float, default=5)
+    parser.add_argument("--rate", help="Send the commands at this total rate per second, following a fixed "
+                                       "timetable instead of waiting for each response (open-loop load).",
+                        type=float)
+    parser.add_argument("--poisson", help="With --rate or --profile, send the commands with random Poisson "
+                                          "arrivals instead of fixed intervals.", action="store_true")
+    parser.add_argument("--profile", help="Load profile as comma separated stages: ramp:FROM:TO:SECONDS, "
+                                          "hold:TPS:SECONDS, step:FROM:TO:INCREMENT:SECONDS. "
+                                          "It replaces --times and --rate.", type=str)
+    parser.add_argument("--workers", help="How many processes to start, each one with its own --connections. "
+                                          "If not specified the default is 1.", type=int, default=1)
+    parser.add_argument("--results-file", help="Writes a record for every command in the specified file: CSV if the "
+                                               "name ends with .csv, otherwise JSON lines. If the name ends with .gz "
+                                               "the file is compressed.", type=Path)
+    parser.add_argument("--metrics-port", help="Serves the counters of the test in the Prometheus format on the "
+                                               "specified HTTP port, at the path /metrics.", type=int)
+    parser.add_argument("--hsm-stats", help="Every specified number of seconds, polls the payShield with J2, J4 and "
+                                            "JK on a dedicated connection, and prints its utilisation and command "
+                                            "volumes next to the throughput of the client.", type=float)
+    parser.add_argument("--connect-timeout", help="The seconds to wait for a connection to be opened. "
+                                                  "If not specified the default is 5.", type=float, default=5)
+    parser.add_argument("--read-timeout", help="The seconds to wait for a response before the connection is "
+                                               "considered bad. If not specified the default is 10.",
+                        type=float, default=10)
+    parser.add_argument("--backoff", help="The seconds to wait before opening again a connection that failed. "
+                                          "The delay doubles at every consecutive failure, with a random jitter. "
+                                          "If not specified the default is 0.1.", type=float, default=0.1)
+    parser.add_argument("--backoff-max", help="The maximum seconds to wait before opening again a connection "
+                                              "that failed. If not specified the default is 10.",
+                        type=float, default=10)
+    parser.add_argument("--no-tls-resume", help="In the case of tls protocol, a full handshake is done every time a "
+                                                "connection is opened again, instead of resuming the TLS session.",
+                        action="store_true")
+    parser.add_argument("--churn", help="Closes every connection after the specified number of commands, and opens "
+                                        "a new one for the next command, as the hosts opening a socket per "
+                                        "transaction do. 1 means a new connection for each command.", type=int)
+    parser.add_argument("--balance", help="How the commands are spread among the payShields, if several are "
+                                          "specified. If not specified the default is round-robin.",
+                        choices=TargetPool.POLICIES, default='round-robin')
+    parser.add_argument("--agent", help="Runs as an agent listening on [ADDRESS:]PORT, waiting for a coordinator "
+                                        "started with --agents. The default address is 127.0.0.1.", type=str)
+    parser.add_argument("--agents", help="Runs as the coordinator of the comma separated list of agents "
+                                         "HOST:PORT, that generate the load together.", type=str)
+    parser.add_argument("--metrics-address", help="The address the Prometheus metrics are served on. "
+                                                  "If not specified the default is 127.0.0.1.", default="127.0.0.1")
     parser.add_argument("--no-upd-check", help="Avoid checking on GitHub if a new version is available",
                         action="store_true")
     args = parser.parse_args()
@@ -1287,22 +5893,127 @@ if __name__ == "__main__":
         if not args.no_upd_check:
             threading.Thread(target=check_for_updates, daemon=True).start()
             # check_for_updates()
+    if args.agent is not None:
+        # the agent receives the test from the coordinator
+        try:
+            agent_address, agent_port = parse_endpoint(args.agent, "127.0.0.1")
+        except ValueError as e:
+            parser.error("--agent: " + str(e))
+        serve_agent(agent_address, agent_port)
+        sys.exit()
+    if args.host is None:
+        parser.error("the host of the payShield is required.")
+    try:
+        args.targets = parse_targets(args.host, args.port)
+    except ValueError as e:
+        parser.error("host: " + str(e))
+    # the first payShield is the one queried by --hsm-stats
+    args.host, args.port = args.targets[0][:2]
+    if args.agents is not None:
+        if args.workers > 1:
+            parser.error("--agents and --workers cannot be used together: each agent runs one worker.")
+        try:
+            args.agents = [parse_endpoint(agent) for agent in args.agents.split(',')]
+        except ValueError as e:
+            parser.error("--agents: " + str(e))
+        # the output of several agents would be unreadable
+        args.quiet = True
+    processes = args.workers if args.agents is None else len(args.agents)
     if args.times <= 0:
         parser.error("--times must be a positive integer (greater than 0).")
+    if args.connections <= 0:
+        parser.error("--connections must be a positive integer (greater than 0).")
+    if not args.forever and args.profile is None and args.connections * processes > args.times:
+        parser.error("--connections multiplied by --workers, or by the number of --agents, cannot be greater than "
+                     "--times.")
+    if args.pipeline is not None:
+        if args.pipeline <= 0:
+            parser.error("--pipeline must be a positive integer (greater than 0).")
+        if args.pipeline >= 10 ** len(args.header):
+            parser.error("--header must be long enough to hold a sequence number for each command in --pipeline.")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be a positive number (greater than 0).")
+    profile = None
+    if args.profile is not None:
+        if args.rate is not None:
+            parser.error("--profile and --rate cannot be used together.")
+        try:
+            profile = LoadProfile.parse(args.profile)
+        except ValueError as e:
+            parser.error("--profile: " + str(e))
+    if args.poisson and args.rate is None and profile is None:
+        parser.error("--poisson requires --rate or --profile.")
+    if args.workers <= 0:
+        parser.error("--workers must be a positive integer (greater than 0).")
+    if args.workers > 1:
+        # the output of several processes would be unreadable
+        args.quiet = True
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        parser.error("--connect-timeout and --read-timeout must be greater than 0.")
+    if args.backoff < 0 or args.backoff_max < args.backoff:
+        parser.error("--backoff must be at least 0 and --backoff-max cannot be lower than --backoff.")
+    if args.churn is not None:
+        if args.churn <= 0:
+            parser.error("--churn must be greater than 0.")
+        if args.pipeline is not None or args.proto == 'udp':
+            parser.error("--churn is not supported with --pipeline or the udp protocol.")
+    if args.hsm_stats is not None and args.hsm_stats <= 0:
+        parser.error("--hsm-stats must be greater than 0.")
+    if args.metrics_port is not None and not 0 < args.metrics_port < 65536:
+        parser.error("--metrics-port must be between 1 and 65535.")
+    if args.status_interval < 0:
+        parser.error("--status-interval must not be negative.")
     if len(args.header) > 255:
         parser.error("--header must be a string not longer than 255 characters.")
+    if args.key is not None:
+        try:
+            args.key = [int(key_length) for key_length in args.key.split(',')]
+        except ValueError:
+            parser.error("--key must be a key length, or a comma separated list of key lengths.")
+        if len(args.key) > 1 and not args.generate:
+            parser.error("several --key lengths require --generate.")
+    if args.sweep:
+        if not args.b2:
+            parser.error("--sweep requires --b2.")
+        if args.forever or args.profile is not None or args.workers > 1 or args.agents is not None:
+            parser.error("--sweep cannot be used with --forever, --profile, --workers or --agents.")
+        try:
+            args.sweep_sizes = [int(size) for size in args.sweep_sizes.split(',')]
+            args.sweep_connections = [int(connections) for connections in args.sweep_connections.split(',')]
+        except ValueError:
+            parser.error("--sweep-sizes and --sweep-connections must be comma separated integers.")
+        if min(args.sweep_sizes) <= 0 or min(args.sweep_connections) <= 0:
+            parser.error("--sweep-sizes and --sweep-connections must be positive integers (greater than 0).")
+        if max(args.sweep_connections) > args.times:
+            parser.error("--sweep-connections cannot be greater than --times.")
+        # only the results of each combination are printed
+        args.quiet = True
+    if args.find_max:
+        if args.sweep:
+            parser.error("--find-max and --sweep cannot be used together.")
+        if args.forever or args.profile is not None or args.workers > 1 or args.agents is not None:
+            parser.error("--find-max cannot be used with --forever, --profile, --workers or --agents.")
+        if args.max_p99 <= 0 or args.max_error_rate < 0 or args.step_duration <= 0:
+            parser.error("--max-p99 and --step-duration must be greater than 0, --max-error-rate must not be "
+                         "negative.")
+        # only the results of each step are printed
+        args.quiet = True
+    if args.ring_size <= 0:
+        parser.error("--ring-size must be a positive integer (greater than 0).")
+    if args.echo_size is not None and not (args.b2 and args.generate):
+        parser.error("--echo-size requires --b2 and --generate.")
     if args.port < 0 or args.port > 65535:
         parser.error("--port must be a positive integer between 0 and 65535.")
     # the order of the IF here is important due to the default arguments.
     # All the mutually exclusive options need to be in this block where ELIF statements are used.
     command = ''
     if args.key is not None:
-        if 320 <= args.key <= 4096:
-            k_len_str = str(args.key)
+        if all(320 <= key_length <= 4096 for key_length in args.key):
+            k_len_str = str(args.key[0])
             if len(k_len_str) <= 3:
                 k_len_str = '0' + k_len_str
             command = args.header + 'EI2' + k_len_str + '01#0000'
-        elif args.key < 320 or args.key > 4096:
+        else:
             print("The key length value needs to be between 320 and 4096")
             sys.exit()
     elif args.nc:
@@ -1328,18 +6039,30 @@ if __name__ == "__main__":
     elif args.pingen:
         command = args.header + 'JA1234567890128;05'
     if args.b2:
-        # We need to calculate the hexadecimal representation of the length of the payload string.
-        # The length of the string field is 4 char long, so we need to format it accordingly.
-        # Example: 0001 or 000FA etc.
-        # Note: this padding algorithm works for echo payloads up to the length of 0xFFFF.
-        # I hope no one would be so crazy to exceed that quantity.
-        h_padding = '0000'
-        len_echo_message = len(args.echo)
-        hex_string_len = hex(len_echo_message).lstrip('0x').upper()
-        # using lstrip() to strip the '0x' prefix is acceptable due to the expected pattern
-        # Ideally you should use removeprefix() but it was introduced in python 3.9, and I want to keep compatibility
-        hex_string_len = h_padding[:4 - len(hex_string_len)] + hex_string_len
-        command = args.header + 'B2' + hex_string_len + args.echo
+        # the length of the payload is sent in 4 hexadecimal digits, e.g. 001A
+        command = args.header + b2_command(args.echo)
+
+    host_command = command
+    if args.scenario is not None:
+        try:
+            host_command = CommandMix.load(args.scenario, args.header,
+                                           (PARSERS if args.quiet else DECODERS) if args.decode else None)
+        except (OSError, ValueError) as e:
+            print("The scenario file", args.scenario, "cannot be used:", e)
+            sys.exit()
+        command = host_command.commands[0]
+    if args.generate:
+        verb = command[len(args.header):len(args.header) + 2]
+        if verb not in GENERATORS:
+            parser.error("--generate is supported only with --pingen, --b2 and --key.")
+        try:
+            generator = GENERATORS[verb](args, args.header)
+        except ValueError as e:
+            parser.error("--echo-size: " + str(e))
+        # the commands are generated and framed now, so the test does not spend any time on them
+        host_command = CommandRing.generate(generator, args.header, args.ring_size,
+                                            (PARSERS if args.quiet else DECODERS).get(verb) if args.decode else None)
+        command = host_command.commands[0]
 
     # IMPORTANT: At this point the 'command' needs to contain something.
     # If you want to add further command line arguments, do it before this comment block.
@@ -1360,36 +6083,145 @@ if __name__ == "__main__":
             print("WARNING: generally the TLS base port is 2500. You are instead using the port ",
                   args.port, " please check that you passed the right value to the "
                              "--port parameter")
-    if args.proto == 'tls':
-        payConnInst = PayConnector(args.host, args.port, args.proto, args.keyfile, args.crtfile)
+    if args.decode:
+        # in quiet mode the responses are only parsed, to validate them
+        decoder = (PARSERS if args.quiet else DECODERS).get(command[len(args.header):len(args.header) + 2], None)
+    else:
+        decoder = None
+
+    results = None
+    if args.sweep:
+        # the largest message the payShields accept, and the largest one the length prefix can describe
+        buffer_sizes = [query_buffer_size(PayConnector(host, port, args.proto, args.keyfile, args.crtfile,
+                                                       args.connect_timeout, args.read_timeout), args.header)
+                        for host, port, _ in args.targets]
+        if None in buffer_sizes:
+            print("The I/O buffer size of the payShield is not known: the NO command failed")
+        max_payload = min([0x7FFF] + [size for size in buffer_sizes if size is not None]) - len(args.header) - 6
+        sweep_sizes = sorted({min(size, max_payload) for size in args.sweep_sizes})
+        if max(args.sweep_sizes) > max_payload:
+            print(f"The payloads larger than {max_payload} bytes, the most the I/O buffer allows, are reduced to it")
+        try:
+            results = ResultsWriter(args.results_file) if args.results_file is not None else None
+        except OSError as e:
+            print("The results file", args.results_file, "cannot be created:", e)
+            sys.exit()
+        sweep_results = {}
+        try:
+            run_sweep(args, sweep_sizes, args.sweep_connections, sweep_results, results)
+        except KeyboardInterrupt:
+            print("")
+            print("Interrupted")
+        close_results(results)
+        print_sweep_matrix(sweep_results, sweep_sizes, args.sweep_connections)
+        print("DONE")
+        sys.exit()
+    if args.find_max:
+        try:
+            results = ResultsWriter(args.results_file) if args.results_file is not None else None
+        except OSError as e:
+            print("The results file", args.results_file, "cannot be created:", e)
+            sys.exit()
+        # the loading of the first payShield is read with J2 on its own connection, at the start and end of each step
+        if len(args.targets) > 1:
+            print("NOTE: the HSM utilisation is read only from the first payShield,", args.host + ":" + str(args.port))
+        sampler = HsmSampler(PayConnector(args.host, args.port, args.proto, args.keyfile, args.crtfile,
+                                          args.connect_timeout, args.read_timeout, args.backoff, args.backoff_max),
+                             args.header, args.step_duration, [])
+        steps = []
+        try:
+            find_max_rate(args, host_command, steps, decoder, sampler, results)
+        except KeyboardInterrupt:
+            print("")
+            print("Interrupted")
+        sampler.connector.close()
+        close_results(results)
+        print_find_max_summary(steps)
+        print("DONE")
+        sys.exit()
+    if args.agents is not None:
+        # each agent creates its own connections and its own results file
+        stats_list = [LoadStats() for _ in args.agents]
+        try:
+            agent_connections = start_agents(args, host_command, None if args.forever or profile else args.times)
+        except OSError as e:
+            print("The test cannot be started:", e)
+            sys.exit()
+        load_funct = lambda times: run_agents(agent_connections, stats_list)
+    elif args.workers > 1:
+        # each worker creates its own connections and its own results file
+        stats_list = [LoadStats() for _ in range(args.workers)]
+        load_funct = lambda times: run_workers(args, host_command, profile, times, stats_list)
     else:
-        payConnInst = PayConnector(args.host, args.port, args.proto)
+        connectors = create_connectors(args)
+        try:
+            results = ResultsWriter(args.results_file) if args.results_file is not None else None
+        except OSError as e:
+            print("The results file", args.results_file, "cannot be created:", e)
+            sys.exit()
+        stats_list = [LoadStats(connection_id + 1, results) for connection_id in range(len(connectors))]
+        load_funct = lambda times: run_configured_load(args, connectors, host_command, times, stats_list, profile,
+                                                       decoder)
 
+    if args.metrics_port is not None:
+        try:
+            MetricsExporter(stats_list, args.metrics_port, args.metrics_address)
+        except OSError as e:
+            print("The metrics cannot be served on port", args.metrics_port, ":", e)
+            sys.exit()
+    sampler = None
+    if args.hsm_stats is not None:
+        if len(args.targets) > 1:
+            print("NOTE: the HSM telemetry covers only the first payShield,", args.host + ":" + str(args.port) +
+                  ", while the client figures cover all of them")
+        sampler = HsmSampler(PayConnector(args.host, args.port, args.proto, args.keyfile, args.crtfile,
+                                          args.connect_timeout, args.read_timeout, args.backoff, args.backoff_max),
+                             args.header, args.hsm_stats, stats_list)
+        sampler.start()
+    tcp_sockets = None
+    if args.churn is not None:
+        # the sockets of a cluster are the sum of the sockets of its payShields
+        target_sockets = [query_tcp_sockets(PayConnector(host, port, args.proto, args.keyfile, args.crtfile,
+                                                         args.connect_timeout, args.read_timeout), args.header)
+                          for host, port, _ in args.targets]
+        tcp_sockets = None if None in target_sockets else sum(target_sockets)
+    stats_label = "Agent" if args.agents is not None else "Worker" if args.workers > 1 else "Connection"
+    stop_status = threading.Event()
+    if (args.quiet or args.pipeline is not None or args.workers > 1) and args.status_interval > 0:
+        threading.Thread(target=report_status, args=(stats_list, args.status_interval, stop_status),
+                         daemon=True).start()
+    t1 = time.perf_counter(), time.process_time()
     if args.forever:
-        i = 1
-        while True:
-            print("Iteration: ", i)
-            if args.decode:
-                run_test(payConnInst, command, len(args.header),
-                         DECODERS.get(command[len(args.header):len(args.header) + 2], None))
-            else:
-                run_test(payConnInst, command, len(args.header), None)
-
-            i = i + 1
-            print("")
+        try:
+            load_funct(None)
+        except KeyboardInterrupt:
+            pass
+        # with --forever the test ends only when it is interrupted
+        print("")
+        print("Interrupted")
+        close_results(results)
+        print_load_summary(stats_list, time.perf_counter() - t1[0], args.rate, profile, stats_label,
+                           args.proto == 'udp')
+        if args.churn is not None:
+            print_churn_summary(stats_list, time.perf_counter() - t1[0], tcp_sockets)
+        if sampler is not None:
+            sampler.stop()
+            sampler.print_summary()
     else:
-        t1 = time.perf_counter(), time.process_time()
-        for i in range(0, args.times):
-            print("Iteration: ", i + 1, " of ", args.times)
-            if args.decode:
-                run_test(payConnInst, command, len(args.header),
-                         DECODERS.get(command[len(args.header):len(args.header) + 2], None))
-            else:
-                run_test(payConnInst, command, len(args.header), None)
-            print("")
+        load_funct(args.times)
         t2 = time.perf_counter(), time.process_time()
+        stop_status.set()
+        close_results(results)
+        if (args.connections > 1 or processes > 1 or args.pipeline is not None or args.timing or args.quiet or
+                args.rate or profile or args.churn or len(args.targets) > 1):
+            print_load_summary(stats_list, t2[0] - t1[0], args.rate, profile, stats_label, args.proto == 'udp')
+        if args.churn is not None:
+            print_churn_summary(stats_list, t2[0] - t1[0], tcp_sockets)
+        if sampler is not None:
+            sampler.stop()
+            sampler.print_summary()
         if args.timing:
-            print(f"Operations performed: {args.times}")
+            print(f"Operations performed: {sum(stats.operations for stats in stats_list)}")
             print(f" Real time: {t2[0] - t1[0]:.2f} seconds")
             print(f" CPU time: {t2[1] - t1[1]:.2f} seconds")
         print("DONE")